@@ -28,6 +28,8 @@ for embedded projects.
 The command line interface has many dependencies including PIL (Pillow)
 and FFmpeg. Excellent builds of FFMpeg are available at
 http://ffmpeg.zeranoe.com/builds/
+Neither is needed to decode YUV4MPEG2 (.y4m) or raw luma captures, which
+are read directly.
 
 If you use the command line tool - it's worth providing it with access
 to a fast temporary area for writing data to, by default it will use
@@ -72,56 +74,95 @@ OTHER DEALINGS IN THE SOFTWARE.
 For more information, please refer to <http://unlicense.org/>
 """
 
-from PIL import Image  # Note using Pillow rather than PIL
 import atexit
 import os
-import argparse
+import contextlib
+import itertools
 import shutil
-import subprocess
 import sys
 import tempfile
-import time
+import threading
 import lib.cc_decode
 from lib.cc_decode import decode_image_list_to_srt, decode_captions_raw, decode_captions_to_scc, decode_captions_debug
-from lib.cc_decode import FileImageWrapper, decode_xds_packets, decode_image_list_to_srt_roll
+from lib.cc_decode import FileImageWrapper, decode_xds_packets, DecodeCheckpoint
+from lib.cc_decode import decode_captions_to_diff, decode_captions_to_webvtt, decode_captions_to_json_lines
+from lib.cc_decode import iter_captions, iter_caption_events, iter_caption_bytes, iter_xds_packets, exclusive_decode
+from lib.cc_decode import demux_caption_channels, channel_frames, skip_pulldown_repeats, CC_FILTER_TO_TXT
+from lib.cc_decode import DECODED_CHANNELS, iter_exclusive
+from lib.cc_frames import DirectoryWatcher, BacklogThrottle, prefetch, read_y4m_frames, read_raw_luma_frames, pump
+from lib.cc_frames import FollowedFile, position_to_frame
+from lib.cc_frames import ffmpeg_profile, FFMPEG_PRESETS, ProgressMeter, ffprobe_path, probe_video, count_y4m_frames
+# Pillow, subprocess, argparse, multiprocessing, lib.cc_jobs, lib.cc_ring and lib.cc_bench are imported where they
+# are needed, so that starting up to decode a short y4m clip doesn't pay for an HTTP server, process pools or ffmpeg
+# handling it won't use
 
 # Defaults - won't work everywehere, that's why we allow it to be manually set
 FFMPEG_LOC = {
-    'win32': os.path.join(os.environ["ProgramFiles"], 'ffmpeg', 'ffmpeg.exe'),
-    'cygwin': os.path.join(os.environ["ProgramFiles"], 'ffmpeg', 'ffmpeg.exe'),
+    'win32': os.path.join(os.environ.get('ProgramFiles', 'C:\\Program Files'), 'ffmpeg', 'ffmpeg.exe'),
+    'cygwin': os.path.join(os.environ.get('ProgramFiles', 'C:\\Program Files'), 'ffmpeg', 'ffmpeg.exe'),
+    'linux': os.path.join(os.path.sep + 'usr', 'local', 'bin', 'ffmpeg'),
     'linux2': os.path.join(os.path.sep + 'usr', 'local', 'bin', 'ffmpeg'),
     'darwin': os.path.join(os.path.sep + 'usr', 'local', 'bin', 'ffmpeg'),
 }
 
 
+def find_ffmpeg():
+    """ The ffmpeg to use when none is given - the usual place for the platform (FFMPEG_LOC), otherwise whichever
+        ffmpeg is on the PATH. None if there isn't one """
+    default = FFMPEG_LOC.get(sys.platform)
+    if default and os.path.exists(default):
+        return default
+    return shutil.which('ffmpeg')
+
+
 class PilImageWrapper(FileImageWrapper):
     """ Since we might want to hook the caption decoder up to live streams, etc, decouple the image object from the
         decoding function """
 
     def __init__(self, filename):
+        from PIL import Image  # Note using Pillow rather than PIL. Imported here as y4m/raw decoding doesn't need it
         super(PilImageWrapper, self).__init__(filename)
         img = Image.open(self.file_name)  # .transpose(Image.FLIP_TOP_BOTTOM)
-        self.width, self.height = img.size
-        if img.size[0] != 720:
-            img.resize((720, img.size[1]))  # If the image is not 720px wide, resize
-        self.image = img.convert('RGB').load()
+        self.width, self.height = img.size  # Any width, lib.cc_decode scales where it samples to suit
+        self.rgb = img.convert('RGB')
+        self.image = self.rgb.load()
+        self.luma = None
 
     def get_pixel_luma(self, x, y):
         """ Return a pixels luma value normalized to the range 0 (black) to 255 (white) """
         r, g, b, = self.image[int(x), int(y)]
         return (r + g + b) / 3
 
+    def get_row(self, y):
+        """ Return row y as bytes of luma values, (r + g + b) / 3 as for get_pixel_luma """
+        if self.luma is None:
+            self.luma = self.rgb.convert('L', (1 / 3, 1 / 3, 1 / 3, 0)).tobytes()
+        return self.luma[int(y) * self.width:(int(y) + 1) * self.width]
+
 
 class ClosedCaptionFileDecoder(object):
     DECODERS = {'srt': decode_image_list_to_srt,
-                'srtroll': decode_image_list_to_srt_roll,
+                'srtroll': decode_image_list_to_srt,  # Old name, srt handles roll-up captions too
                 'scc': decode_captions_to_scc,
                 'raw': decode_captions_raw,
                 'debug': decode_captions_debug,
+                'diff': decode_captions_to_diff,
+                'webvtt': decode_captions_to_webvtt,
+                'jsonl': decode_captions_to_json_lines,
                 'xds': decode_xds_packets}
-
-    def __init__(self, ffmpeg_path=None, temp_path=None, ccformat=None, start_line=0, lines=10, fixed_line=None, ccfilter=0):
-        self.ffmpeg_path = ffmpeg_path or FFMPEG_LOC.get(sys.platform)
+    CHANNEL_FORMATS = ('srt', 'srtroll', 'webvtt', 'jsonl', 'diff')  # Formats that can be limited to a channel
+    ITERATORS = {'captions': iter_captions,
+                 'events': iter_caption_events,
+                 'bytes': iter_caption_bytes,
+                 'xds': iter_xds_packets}
+
+    def __init__(self, ffmpeg_path=None, temp_path=None, ccformat=None, start_line=0, lines=10, fixed_line=None, ccfilter=0,
+                 output_path=None, checkpoint_path=None, checkpoint_interval=1800, fps=30000 / 1001,
+                 max_backlog_frames=300, max_backlog_bytes=0, prefetch_depth=4, raw_size=None, raw_frame_bytes=None,
+                 full_range=False, ffmpeg_profile=None, demux=False, progress_interval=0, metrics_path=None,
+                 metrics_interval=5, skip_pulldown=True, follow=False, follow_idle=60, start=None, end=None,
+                 preroll=10, ring_frames=64, flush_captions=False):
+        self.ffmpeg_path = ffmpeg_path or find_ffmpeg()
         self.temp_dir_path = temp_path or tempfile.gettempdir()
         self.format = ccformat or 'srt'
         self.lines = lines
@@ -130,95 +171,648 @@ class ClosedCaptionFileDecoder(object):
         self.start_line = start_line
         self.workingdir = ''
         self.ccfilter=ccfilter
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.fps = fps
+        self.max_backlog_frames = max_backlog_frames
+        self.max_backlog_bytes = max_backlog_bytes
+        self.prefetch_depth = prefetch_depth
+        self.raw_size = raw_size
+        self.raw_frame_bytes = raw_frame_bytes
+        self.full_range = full_range
+        self.ffmpeg_profile = ffmpeg_profile  # FfmpegProfile, or the name of one of FFMPEG_PRESETS
+        self.demux = demux  # Write each caption channel to its own file, see decode_demuxed
+        self.progress_interval = progress_interval  # Seconds between progress lines on stderr, 0 for none
+        self.metrics_path = metrics_path  # File to keep progress metrics in, see ProgressMeter
+        self.metrics_interval = metrics_interval
+        self.skip_pulldown = skip_pulldown  # Don't read the captions of pulldown duplicate frames again
+        self.follow = follow  # Keep reading as the input grows, see followed_frames
+        self.follow_idle = follow_idle  # Seconds without new frames before a followed recording is finished
+        self.start = start  # Part of the video to decode, a frame number or timestamp (see position_to_frame)
+        self.end = end
+        self.preroll = preroll  # Seconds before start read to pick up captions already loaded, see frame_range
+        self.ring_frames = ring_frames  # Frames the reader may get ahead of the slowest output, see decode_outputs
+        self.flush_captions = flush_captions  # Write each caption line to the output file as it is decoded
 
     def _cleanup(self):
         """ If we terminate unexpectedly, make sure we stop ffmpeg generating files """
         if self.fpid and self.fpid.poll() is None:  # Still running
             self.fpid.kill()
+            self.fpid.wait()
+        self.fpid = None
         if self.workingdir:
-            shutil.rmtree(self.workingdir)
+            shutil.rmtree(self.workingdir, ignore_errors=True)
+            self.workingdir = ''
 
-    def stream_decode_file_list(self, input_file, start_line=0, lines=5, image_wrapper=None):
+    def stream_decode_file_list(self, input_file, start_line=0, lines=5, image_wrapper=None, start_frame=0,
+                                input_stream=None, frame_count=None):
         """ Returns a generator of image objects based on ffmpeg decoding the top 10 lines of the passed input_file.
             Run ffmpeg in a subprocess generating tiffs of the video frame until ffmpeg finishes and we run out of
-            frames.
+            frames. We wake as new frames land in the working directory, and pause ffmpeg whenever more than
+            max_backlog_frames (or max_backlog_bytes) of frames are waiting for us, so disk use stays bounded.
+            The next prefetch_depth frames are loaded on a thread pool while the current frame is decoded.
              input_file - input video file. Anything that ffmpeg understands
              tempdir    - where to write the tiffs to, ideally somewhere that can sustain high throughput, and has space
              start_line - the line number to start capturing (default 0)
              lines      - the number of lines to write to the tiff, counting from the start line (default 5)
-             image_wrapper - the class to wrap the image file name with, default is PilImageWrapper """
+             image_wrapper - the class to wrap the image file name with, default is PilImageWrapper
+             start_frame - the frame number to start decoding from, ffmpeg seeks to it (default 0)
+             input_stream - a binary file object to feed to ffmpeg's stdin instead of reading input_file
+             frame_count - stop after this many frames, None for the whole video """
 
+        if not self.ffmpeg_path:
+            raise RuntimeError('Could not find ffmpeg, install it or give its path with --ffmpeg')
         if not os.path.exists(self.ffmpeg_path):
             raise RuntimeError('Could not find ffmpeg at %s' % self.ffmpeg_path)
         image_wrapper = image_wrapper or PilImageWrapper
         self.workingdir = tempfile.mkdtemp(dir=self.temp_dir_path)
         tempfile_name_structure = 'ccdecode%07d.tif'
-        ffmpeg_cmd = '%s -i "%s" -vf "scale=720:ih, crop=iw:%d:0:%d" -pix_fmt rgb24 -f image2 "%s"' % \
-                     (self.ffmpeg_path, input_file, start_line + lines, start_line,
-                      os.path.join(self.workingdir, tempfile_name_structure))
+        seek = None
+        if start_frame:
+            # Seek half a frame early, so rounding can't land us on the frame after start_frame
+            seek = (start_frame - 0.5) / self.fps
+        ffmpeg_cmd = ffmpeg_profile(self.ffmpeg_profile).argv(
+            self.ffmpeg_path, 'pipe:0' if input_stream else input_file, os.path.join(self.workingdir, tempfile_name_structure),
+            'crop=iw:%d:0:%d' % (start_line + lines, start_line), seek=seek, frames=frame_count)
 
         def next_file_name(file_num):
             return os.path.join(self.workingdir, (tempfile_name_structure % file_num))
 
-        with open(os.devnull, 'wb') as devnull:
-            atexit.register(self._cleanup)
-            self.fpid = subprocess.Popen(ffmpeg_cmd, stderr=devnull)
+        # Registered once per stream, and removed again however the stream ends (including the consumer abandoning
+        # it part way through), so decoding many files in one process doesn't pile up exit handlers
+        atexit.register(self._cleanup)
+        images = prefetch(self._ffmpeg_frame_files(ffmpeg_cmd, next_file_name, input_stream), image_wrapper,
+                          depth=self.prefetch_depth)
+        try:
+            for image in images:
+                yield image
+        finally:
+            images.close()  # Wait for any loader threads before removing their files
+            self._cleanup()
+            atexit.unregister(self._cleanup)
+
+    def _ffmpeg_frame_files(self, ffmpeg_cmd, next_file_name, input_stream=None):
+        """ Run ffmpeg, yielding the name of each frame file it writes once the file is complete. input_stream, if
+            given, is copied to ffmpeg's stdin on a thread """
+        watcher = DirectoryWatcher(self.workingdir)
+        import subprocess
+        with tempfile.TemporaryFile() as errors:
+            self.fpid = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE if input_stream else subprocess.DEVNULL,
+                                         stderr=errors)
+            if input_stream:
+                threading.Thread(target=pump, args=(input_stream, self.fpid.stdin), daemon=True).start()
+            throttle = BacklogThrottle(self.fpid, next_file_name, max_frames=self.max_backlog_frames,
+                                       max_bytes=self.max_backlog_bytes)
             file_number = 1
             while self.fpid.poll() is None:  # While ffmpeg is running
-                if os.path.exists(next_file_name(file_number)) and os.path.exists(next_file_name(file_number + 1)):
+                if os.path.exists(next_file_name(file_number + 1)):
                     # Latch on the existence of the n+1 file, which wouldn't exist until the n file is fully written
-                    yield image_wrapper(next_file_name(file_number))
+                    yield next_file_name(file_number)
                     file_number += 1
+                    throttle.update(file_number)
                 else:
-                    time.sleep(0.25)  # Take a nap for a moment, since we must have caught up with FFMpeg
-        # FFMpeg must have exited - process all remaining files
-        self.fpid = None
+                    throttle.resume()  # Never leave ffmpeg paused while we are waiting on it
+                    watcher.wait()  # Caught up with FFMpeg, sleep until it writes another file
+            # FFMpeg must have exited - process all remaining files
+            watcher.close()
+            if self.fpid.returncode and file_number == 1 and not os.path.exists(next_file_name(1)):
+                # Nothing decoded at all, i.e. a missing file or a share that went away. Frames followed by an
+                # error, i.e. a truncated capture, are still worth decoding
+                errors.seek(0)
+                raise RuntimeError('ffmpeg failed with exit code %d: %s' % (
+                    self.fpid.returncode, errors.read()[-2000:].decode('utf-8', 'replace').strip()))
         while os.path.exists(next_file_name(file_number)):
-            yield image_wrapper(next_file_name(file_number))
+            yield next_file_name(file_number)
             file_number += 1
-        os.rmdir(self.workingdir)
-        self.workingdir = ''
-
-    def decode(self, filename):
-        imagewrapper_generator = self.stream_decode_file_list(
-            filename, lines=self.lines, start_line=self.start_line)
 
-        if self.format in self.DECODERS:
-            decoder_func = self.DECODERS.get(self.format)
-            decoder_func(imagewrapper_generator, ccfilter=self.ccfilter)
+    def frame_source(self, filename, start_frame=0, frame_count=None, skip_pulldown=True):
+        """ Returns a generator of image objects for the passed file. YUV4MPEG2 files (or '-' for a y4m stream on
+            stdin) and raw luma files (when raw_size is set) are read directly, anything else goes through ffmpeg.
+            Pulldown duplicates are swapped for RepeatedFrames, unless skip_pulldown is off. When following, filename
+            is a recording that is still being written (or a glob pattern for its segment files), see FollowedFile
+             start_frame   - the first frame wanted, ffmpeg seeks to it
+             frame_count   - how many frames are wanted, None for the rest of the video
+             skip_pulldown - False to leave pulldown duplicates to whoever decodes the frames """
+        if self.follow:
+            images = self.followed_frames(filename, start_frame=start_frame)
+        elif self.raw_size:
+            width, height = self.raw_size
+            images = read_raw_luma_frames(filename, width, height, start_line=self.start_line, lines=self.lines,
+                                          start_frame=start_frame, frame_bytes=self.raw_frame_bytes,
+                                          full_range=self.full_range)
+        elif filename == '-' or filename.lower().endswith('.y4m'):
+            images = read_y4m_frames(filename, start_line=self.start_line, lines=self.lines, start_frame=start_frame)
         else:
-            raise RuntimeError('Unknown output format %s, try one of %s' % (format, self.DECODERS.keys()))
+            images = self.stream_decode_file_list(filename, lines=self.lines, start_line=self.start_line,
+                                                  start_frame=start_frame, frame_count=frame_count)
+        if frame_count is not None:
+            images = itertools.islice(images, frame_count)
+        if self.skip_pulldown and skip_pulldown:
+            images = skip_pulldown_repeats(images, fixed_line=self.fixed_line)
+        return images
+
+    def followed_frames(self, filename, start_frame=0):
+        """ frame_source for a recording that is still being written. Frames are read as they land, and the stream
+            ends once nothing new has been written for follow_idle seconds """
+        source = FollowedFile(filename, idle_seconds=self.follow_idle)
+        try:
+            if self.raw_size:
+                width, height = self.raw_size
+                images = read_raw_luma_frames(source, width, height, start_line=self.start_line, lines=self.lines,
+                                              start_frame=start_frame, frame_bytes=self.raw_frame_bytes,
+                                              full_range=self.full_range)
+            elif filename.lower().endswith('.y4m'):
+                images = read_y4m_frames(source, start_line=self.start_line, lines=self.lines,
+                                         start_frame=start_frame)
+            else:
+                images = self.stream_decode_file_list(filename, lines=self.lines, start_line=self.start_line,
+                                                      start_frame=start_frame, input_stream=source)
+            for image in images:
+                yield image
+        finally:
+            source.close()
+
+    def count_frames(self, filename):
+        """ The number of frames in filename, None if it can't be told (i.e. a stream on stdin). Uses ffprobe, from
+            alongside ffmpeg, for anything but y4m and raw files """
+        if filename == '-' or self.follow:
+            return None
+        if self.raw_size:
+            width, height = self.raw_size
+            return os.path.getsize(filename) // (self.raw_frame_bytes or width * height)
+        if filename.lower().endswith('.y4m'):
+            return count_y4m_frames(filename)
+        if not self.ffmpeg_path:
+            return None
+        _, frames = probe_video(ffprobe_path(self.ffmpeg_path), filename,
+                                stream=ffmpeg_profile(self.ffmpeg_profile).stream)
+        return frames
+
+    def frame_range(self):
+        """ The part of the video to decode, as (first frame to read, preroll frames, frames to read - None for the
+            rest of the video). The preroll frames before start are read to pick up captions already loaded """
+        start = position_to_frame(self.start or 0, self.fps)
+        end = None if self.end is None else position_to_frame(self.end, self.fps)
+        if end is not None and end <= start:
+            raise RuntimeError('The end of the part to decode (%s) must come after its start (%s)'
+                               % (self.end, self.start or 0))
+        first = max(0, start - int(round(self.preroll * self.fps)))
+        return first, start - first, None if end is None else end - first
+
+    def monitored_frame_source(self, filename, start_frame=0, frame_count=None):
+        """ frame_source, reporting progress as the frames are decoded if progress_interval or metrics_path are set """
+        images = self.frame_source(filename, start_frame=start_frame, frame_count=frame_count)
+        if not (self.progress_interval or self.metrics_path):
+            return images
+        total_frames = self.count_frames(filename) if frame_count is None else start_frame + frame_count
+        meter = ProgressMeter(lib.cc_decode.decodeStats, total_frames=total_frames, fps=self.fps,
+                              interval=self.progress_interval, metrics_path=self.metrics_path,
+                              metrics_interval=self.metrics_interval, name=filename, start_frame=start_frame)
+        return meter.watch(images)
+
+    def _open_output(self, checkpoint):
+        """ Open the output file, when resuming discard anything written after the checkpoint was taken. When
+            following a recording (or flushing captions) the file is line buffered, so captions can be read as soon
+            as they are decoded """
+        buffering = 1 if self.follow or self.flush_captions else -1
+        if checkpoint and checkpoint.state and os.path.exists(self.output_path):
+            output = open(self.output_path, 'r+', encoding='utf-8', buffering=buffering)
+            output.seek(checkpoint.output_offset)
+            output.truncate()
+            return output
+        return open(self.output_path, 'w', encoding='utf-8', buffering=buffering)
+
+    def decode(self, filename, resume=False):
+        """ Decode the closed captions in filename, writing them to the output file (or stdout). Only one decode may
+            run in a process at a time, see exclusive_decode
+             resume - carry on from the last checkpoint, if there is one """
+        with exclusive_decode(filename):
+            return self._decode(filename, resume)
+
+    def _decode(self, filename, resume):
+        outputs = self.outputs()
+        if len(outputs) > 1:
+            if resume or self.demux:
+                raise RuntimeError('Decodes to several outputs can not be resumed or demuxed')
+            return self.decode_outputs(filename, outputs)
+        ccformat, channel = outputs[0]
+        if channel and self.demux:
+            raise RuntimeError('Demuxing decodes every caption channel, %s names one' % self.format)
+        decoder_func = self.DECODERS.get(ccformat)
+        ccfilter = channel or self.ccfilter
+
+        ranged = self.start or self.end is not None
+        if resume and (self.demux or ranged):
+            raise RuntimeError('Only whole, undemuxed decodes can be resumed')
+        if self.demux:
+            return self.decode_demuxed(filename)
+        checkpoint = None
+        if self.checkpoint_path and not ranged:  # Decodes of part of a video are short, and not worth resuming
+            checkpoint = DecodeCheckpoint(self.checkpoint_path, interval=self.checkpoint_interval)
+            if resume:
+                if not self.output_path:
+                    raise RuntimeError('Resuming requires an output file, stdout cannot be rewound')
+                checkpoint.load()
+
+        with contextlib.ExitStack() as stack:
+            if self.output_path:
+                output = stack.enter_context(self._open_output(checkpoint))
+                stack.enter_context(contextlib.redirect_stdout(output))
+                if checkpoint:
+                    checkpoint.output = output
+            if checkpoint and checkpoint.state:
+                imagewrapper_generator = self.monitored_frame_source(filename, start_frame=checkpoint.frame)
+                decoder_func(imagewrapper_generator, fixed_line=self.fixed_line, ccfilter=ccfilter,
+                             checkpoint=checkpoint)
+            else:
+                first_frame, preroll, frame_count = self.frame_range()
+                imagewrapper_generator = self.monitored_frame_source(filename, start_frame=first_frame,
+                                                                     frame_count=frame_count)
+                decoder_func(imagewrapper_generator, fixed_line=self.fixed_line, ccfilter=ccfilter,
+                             checkpoint=checkpoint, first_frame=first_frame, preroll=preroll)
+
+        if checkpoint:
+            checkpoint.remove()  # Finished, nothing to resume
+
+    def channel_output_path(self, filename, channel):
+        """ Where decode_demuxed writes a caption channel - the output path, or the video file with the extension for
+            the format, with .cc1 (etc) before the extension """
+        from lib.cc_jobs import caption_path
+        root, extension = os.path.splitext(self.output_path or caption_path(filename, self.format))
+        return '%s.%s%s' % (root, CC_FILTER_TO_TXT[channel].lower(), extension)
+
+    def decode_demuxed(self, filename):
+        """ Read the closed captions in filename once, then decode each caption channel found to its own file (see
+            channel_output_path), so bilingual captions take one pass rather than one per channel. Returns the paths
+            written """
+        if self.format == 'xds':
+            raise RuntimeError('XDS data belongs to no caption channel, decode it without demuxing')
+        if filename == '-' and not self.output_path:
+            raise RuntimeError('Demuxing stdin requires an output path to name the channel files after')
+        decoder_func = self.DECODERS.get(self.format)
+        first_frame, preroll, frame_count = self.frame_range()
+        frames, channels = demux_caption_channels(self.monitored_frame_source(filename, start_frame=first_frame,
+                                                                              frame_count=frame_count),
+                                                  fixed_line=self.fixed_line)
+        paths = []
+        for channel in channels:
+            path = self.channel_output_path(filename, channel)
+            with open(path, 'w', encoding='utf-8') as output, contextlib.redirect_stdout(output):
+                decoder_func(channel_frames(frames, channel), ccfilter=channel, first_frame=first_frame,
+                             preroll=preroll)
+            paths.append(path)
+        return paths
+
+    def outputs(self):
+        """ The (format, channel) of each output asked for - the format may be a comma separated list, each format
+            limited to a caption channel with :1 or :2, i.e. 'srt:1,srt:2,scc,xds'. channel is None for all """
+        outputs = []
+        for spec in self.format.split(','):
+            ccformat, _, channel = spec.strip().partition(':')
+            if ccformat not in self.DECODERS:
+                raise RuntimeError('Unknown output format %s, try one of %s' % (ccformat, list(self.DECODERS.keys())))
+            if channel and (ccformat not in self.CHANNEL_FORMATS or not channel.isdigit()
+                            or int(channel) not in DECODED_CHANNELS):
+                raise RuntimeError('%s can not be limited to caption channel %s' % (ccformat, channel))
+            outputs.append((ccformat, int(channel) if channel else None))
+        return outputs
+
+    def output_paths(self, filename, outputs):
+        """ Where decode_outputs writes each (format, channel) output - the output path, or the video file, with the
+            extension for the format and any channel (.cc1, etc) before it """
+        from lib.cc_jobs import caption_path
+        if filename == '-' and not self.output_path:
+            raise RuntimeError('Decoding stdin to several outputs requires an output path to name them after')
+        paths = []
+        for ccformat, channel in outputs:
+            root, extension = os.path.splitext(caption_path(self.output_path or filename, ccformat))
+            path = '%s.%s%s' % (root, CC_FILTER_TO_TXT[channel].lower(), extension) if channel else root + extension
+            if path in paths:
+                raise RuntimeError('Two of the outputs %s would be written to %s' % (self.format, path))
+            paths.append(path)
+        return paths
+
+    def decode_outputs(self, filename, outputs):
+        """ Decode filename to several outputs at once, each in a process of its own, while the video is read only
+            once - this process reads the frames into a FrameRing (see lib.cc_ring) in shared memory, and the
+            decoding processes all read them from there. The ring holds ring_frames frames, the reader waits for
+            the slowest output when it is full. Progress is reported by the first output's process. Returns the paths
+            written (see output_paths)
+             outputs - (format, channel) of each output, see outputs """
+        import multiprocessing
+        from lib.cc_ring import FrameRing
+        paths = self.output_paths(filename, outputs)
+        for path in paths:
+            open(path, 'w').close()  # Can't be written is best found out here, before reading any of the video
+        first_frame, preroll, frame_count = self.frame_range()
+        options = {'fixed_line': self.fixed_line, 'first_frame': first_frame, 'preroll': preroll,
+                   'skip_pulldown': self.skip_pulldown, 'bitlevel': lib.cc_decode.LUMA_THRESHOLD}
+        progress = None
+        if self.progress_interval or self.metrics_path:
+            total_frames = self.count_frames(filename) if frame_count is None else first_frame + frame_count
+            progress = {'total_frames': total_frames, 'fps': self.fps, 'interval': self.progress_interval,
+                        'metrics_path': self.metrics_path, 'metrics_interval': self.metrics_interval,
+                        'name': filename, 'start_frame': first_frame}
+        images = self.frame_source(filename, start_frame=first_frame, frame_count=frame_count, skip_pulldown=False)
+        try:
+            first = next(images, None)
+            ring = FrameRing.create(first.width if first else 1, first.height if first else 1, len(outputs),
+                                    slots=self.ring_frames)
+            context = multiprocessing.get_context('spawn')  # Safe alongside ffmpeg's threads, and on every platform
+            processes = [context.Process(target=run_ring_decode, args=(ring.name, consumer, ccformat, path,
+                                                                       dict(options, ccfilter=channel or self.ccfilter),
+                                                                       progress if consumer == 0 else None))
+                         for consumer, ((ccformat, channel), path) in enumerate(zip(outputs, paths))]
+            try:
+                for process in processes:
+                    process.start()
+                for image in itertools.chain([first] if first else [], images):
+                    ring.put(image, alive=lambda consumer: processes[consumer].is_alive())
+                    image.unlink()
+                ring.finish()
+            except BaseException:
+                ring.finish(failed=True)
+                raise
+            finally:
+                for process in processes:
+                    if process.pid is not None:
+                        process.join()
+                ring.close()
+                ring.unlink()
+        finally:
+            images.close()
+        failed = [path for path, process in zip(paths, processes) if process.exitcode]
+        if failed:
+            raise RuntimeError('Decoding to %s failed' % ', '.join(failed))
+        return paths
+
+    def iter_decode(self, filename, format='captions'):
+        """ Returns a generator of the closed captions in filename, decoded as they are read. It has the decoder to
+            itself from its first item until it is exhausted or closed, see exclusive_decode
+             format - 'captions' for Captions, 'events' for CaptionEvents as the displayed captions change,
+                      'bytes' for the CaptionBytes of each frame, or 'xds' for XdsPackets """
+        if format not in self.ITERATORS:
+            raise RuntimeError('Unknown format %s, try one of %s' % (format, list(self.ITERATORS.keys())))
+        iterator_func = self.ITERATORS[format]
+        first_frame, preroll, frame_count = self.frame_range()
+        kwargs = {'fixed_line': self.fixed_line, 'ccfilter': self.ccfilter, 'first_frame': first_frame,
+                  'preroll': preroll}
+        if format in ('captions', 'events'):
+            kwargs['frames_per_second'] = self.fps
+        return iter_exclusive(filename, iterator_func(self.frame_source(filename, start_frame=first_frame,
+                                                                        frame_count=frame_count), **kwargs))
+
+
+def decode_file(path, format='captions', **opts):
+    """ Decode the closed captions in a video file without going through the command line, i.e.
+
+            for caption in decode_file('video.mpg', ffmpeg_path='/usr/bin/ffmpeg'):
+                print(caption.start_time, caption.text)
+
+        Returns a lazy iterator, frames are only read as it is consumed, and stopping early (or closing it) stops
+        ffmpeg and removes its temporary files. The decoder's state is per process, so iterate one at a time - starting
+        a second while another is still open raises RuntimeError.
+         path   - input video file, as for the command line
+         format - 'captions' (default) for Captions, 'events' for CaptionEvents, 'bytes' for CaptionBytes or 'xds'
+                  for XdsPackets
+         opts   - any ClosedCaptionFileDecoder options, i.e. ffmpeg_path, temp_path, start_line, lines, fixed_line,
+                  ccfilter, fps, raw_size """
+    return ClosedCaptionFileDecoder(**opts).iter_decode(path, format)
+
+
+def _warm_worker():
+    """ Pay the one off costs of a decode up front, so a decode service worker's first job is as quick as the rest """
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        pass  # Only y4m and raw inputs can be decoded, the job will report it
+
+
+def run_decode_job(filename, ccformat, options, output_path):
+    """ Decode filename to output_path, run in a decode service worker process. Captions are flushed to the file as
+        they are decoded, so a streamed job can send them on as they come
+         options - ClosedCaptionFileDecoder keyword arguments, plus bitlevel """
+    options = dict(options)
+    lib.cc_decode.LUMA_THRESHOLD = options.pop('bitlevel', 80)  # Workers are reused, so always set it
+    if options.get('raw_size'):
+        options['raw_size'] = tuple(options['raw_size'])
+    ClosedCaptionFileDecoder(ccformat=ccformat, output_path=output_path, flush_captions=True,
+                             **options).decode(filename)
+
+
+def run_ring_decode(ring_name, consumer, ccformat, output_path, options, progress=None):
+    """ Decode the frames in a FrameRing to output_path, run in a process of its own by decode_outputs
+         consumer - which of the ring's consumers this is
+         options  - fixed_line, ccfilter, first_frame, preroll, skip_pulldown and bitlevel
+         progress - ProgressMeter keyword arguments, to report progress """
+    from lib.cc_ring import FrameRing
+    lib.cc_decode.LUMA_THRESHOLD = options['bitlevel']
+    ring = FrameRing.attach(ring_name)
+    frames = ring.frames(consumer)
+    try:
+        images = frames
+        if options['skip_pulldown']:
+            images = skip_pulldown_repeats(images, fixed_line=options['fixed_line'])
+        if progress:
+            images = ProgressMeter(lib.cc_decode.decodeStats, **progress).watch(images)
+        with open(output_path, 'w', encoding='utf-8') as output, contextlib.redirect_stdout(output):
+            ClosedCaptionFileDecoder.DECODERS[ccformat](images, fixed_line=options['fixed_line'],
+                                                        ccfilter=options['ccfilter'],
+                                                        first_frame=options['first_frame'],
+                                                        preroll=options['preroll'])
+    finally:
+        frames.close()  # Stop holding the reader up, even if decoding failed part way through
+        ring.close()
 
 
 def main():
+    import argparse
+    import shlex
     p = argparse.ArgumentParser(description='Extract visible closed captions in a video file')
 
-    ffmpeg = FFMPEG_LOC.get(sys.platform, '')
+    ffmpeg = find_ffmpeg()
     tempdir = tempfile.gettempdir()
-    p.add_argument('videofile', help='Input video file name')
-    p.add_argument('--ffmpeg', default=ffmpeg, help='Path to a copy of the ffmpeg binary (default %s)' % ffmpeg)
+    p.add_argument('videofile', nargs='?', help='Input video file name, .y4m files and "-" (y4m on stdin) are read without ffmpeg')
+    p.add_argument('--ffmpeg', default=ffmpeg, help='Path to a copy of the ffmpeg binary (default %s)' % (ffmpeg or 'none found'))
     p.add_argument('--temp', default=tempdir, help='Path to temporary working area (default %s)' % tempdir)
-    p.add_argument('--ccformat', default='srt', help='Output format xds, srt, scc, srtroll or debug (default srt)')
+    p.add_argument('--ccformat', default='srt',
+        help='Output format xds, srt, scc, srtroll, webvtt, jsonl, diff or debug (default srt). Several comma '
+             'separated formats, i.e. srt,scc,xds, are decoded at once from one read of the video, each by a process '
+             'of its own, to files named after --output or the video. srt:1 (etc) limits an output to one channel')
     p.add_argument('--lines', default=3, type=int,
         help='Number of lines to search for CC in the video, starting at the start line (default 3)')
     p.add_argument('--start_line', default=0, type=int, help='Start at a particular line 0=topmost line')
-    p.add_argument('--ccfilter', default=0, type=int,
-        help='Filter for a particular closed caption stream 1=CC1, 2=CC2, etc. Only honored in srt mode (default 0=All)')
+    p.add_argument('--ccfilter', default=0, type=int, choices=(0,) + DECODED_CHANNELS,
+        help='Filter for a particular closed caption stream 1=CC1, 2=CC2 (CC3 and CC4 are not decoded). Only honored in srt, webvtt, jsonl and diff modes (default 0=All), see --demux for the rest')
     p.add_argument('--bitlevel', default=80, type=int,
         help='The R+G+B/3 level that ccdecode reads as "1". 97 according to spec (50 IRE +/- 12 = 38 IRE),' +
             'but we default to 80 (29 IRE) which is seems to work well, adjust lower if your source material is dim.')
+    p.add_argument('--output', default=None, help='Write captions to this file rather than stdout')
+    p.add_argument('--demux', action='store_true',
+        help='Write each caption channel found to its own file, i.e. movie.cc1.srt and movie.cc2.srt, in one pass. '
+             'Named after --output, or the video file')
+    p.add_argument('--checkpoint', default=None,
+        help='Periodically save decoder state to this file (default <output>.checkpoint when --output is given)')
+    p.add_argument('--checkpoint_interval', default=1800, type=int,
+        help='Number of frames between checkpoints (default 1800, about a minute of video)')
+    p.add_argument('--resume', action='store_true',
+        help='Resume an interrupted decode from its checkpoint, requires --output')
+    p.add_argument('--max_backlog_frames', default=300, type=int,
+        help='Pause ffmpeg when this many decoded frames are waiting in the temporary area (default 300, 0=no limit)')
+    p.add_argument('--max_backlog_bytes', default=0, type=int,
+        help='Pause ffmpeg when this many bytes of frames are waiting in the temporary area (default 0=no limit)')
+    p.add_argument('--raw', default=None, metavar='WIDTHxHEIGHT',
+        help='Input is headerless raw video of this size, each frame starting with an 8 bit luma plane')
+    p.add_argument('--raw_frame_bytes', default=None, type=int,
+        help='Total bytes per raw frame including any chroma planes (default width*height, i.e. gray)')
+    p.add_argument('--full_range', action='store_true', help='Raw luma is 0-255 rather than studio swing 16-235')
+    p.add_argument('--prefetch', default=4, type=int,
+        help='Number of frames to load and convert ahead of the decoder on background threads (default 4, 0=off)')
+    p.add_argument('--ffmpeg_preset', default='default', choices=sorted(FFMPEG_PRESETS),
+        help='How to run ffmpeg for the source type (default default)')
+    p.add_argument('--ffmpeg_threads', default=None, type=int,
+        help='ffmpeg decoder threads (default one per core, or 1 with --serve, --watch and --shard)')
+    p.add_argument('--video_stream', default=None, type=int,
+        help='Which video stream to decode, 0 is the first (default 0)')
+    p.add_argument('--ffmpeg_input_args', default=None,
+        help='Extra ffmpeg arguments for the input, i.e. "-hwaccel auto"')
+    p.add_argument('--ffmpeg_filter', default=None, help='Extra ffmpeg video filters, applied after the crop')
+    p.add_argument('--serve', default=None, metavar='ADDRESS',
+        help='Run as a decode service on host:port (localhost HTTP) or a Unix socket path, rather than decoding '
+             'videofile. The options above become the defaults for each job')
+    p.add_argument('--output_root', default=None, metavar='FOLDER',
+        help='With --serve, jobs may write their output anywhere under this folder (default only beside the input)')
+    p.add_argument('--watch', default=None, metavar='FOLDER',
+        help='Watch a folder, decoding each video file that arrives to a caption file next to it')
+    p.add_argument('--shard', default=None, metavar='MANIFEST',
+        help='Decode the video files listed in MANIFEST, sharing them with --shard workers on other machines that '
+             'mount the same file system. Locks and completion markers go in MANIFEST.state')
+    p.add_argument('--lease_seconds', default=120, type=int,
+        help='Seconds without a heartbeat before a --shard worker is presumed dead and its files reclaimed '
+             '(default 120)')
+    p.add_argument('--workers', default=None, type=int,
+        help='Number of decodes run at once by --serve, --watch and --shard (default one per CPU)')
+    p.add_argument('--retries', default=3, type=int,
+        help='Times --watch or --shard retries a failed decode (default 3)')
+    p.add_argument('--stable_seconds', default=10, type=float,
+        help='Seconds a file must stop changing before --watch decodes it (default 10)')
+    p.add_argument('--priority', default=[], action='append', metavar='PATTERN=N',
+        help='Priority for --watch files matching a glob pattern, i.e. "*promo*=10", higher goes first (default 0)')
+    p.add_argument('--decode_repeats', action='store_true',
+        help='Read the captions of every frame, rather than reusing them for frames that repeat the frame before '
+             'in a 3:2 pulldown cadence')
+    p.add_argument('--progress', default=None, type=float, metavar='SECONDS',
+        help='Report frames decoded, realtime factor, caption lock, captions and ETA on stderr this often '
+             '(default 10 when stderr is a terminal, otherwise 0=off)')
+    p.add_argument('--metrics', default=None, metavar='FILE',
+        help='Keep the progress figures in FILE, Prometheus text format if it ends .prom, otherwise JSON')
+    p.add_argument('--metrics_interval', default=5, type=float,
+        help='Seconds between updates of the --metrics file (default 5)')
+    p.add_argument('--start', default=None, metavar='POSITION',
+        help='Decode from this point, a timestamp [HH:]MM:SS[.fff] or a frame number. ffmpeg seeks straight to it, '
+             'times in the output stay those of the whole video')
+    p.add_argument('--end', default=None, metavar='POSITION',
+        help='Stop decoding at this point, a timestamp or frame number as for --start')
+    p.add_argument('--preroll', default=10, type=float, metavar='SECONDS',
+        help='With --start, read this far before it (without output) to pick up captions already loaded or on '
+             'screen (default 10)')
+    p.add_argument('--follow', action='store_true',
+        help='videofile is still being recorded, keep decoding as it grows. Give a quoted glob pattern, i.e. '
+             '"capture-*.ts", to follow a rotating set of segment files')
+    p.add_argument('--follow_idle', default=60, type=float, metavar='SECONDS',
+        help='With --follow, the recording has finished once nothing new is written for this long (default 60)')
+    p.add_argument('--benchmark', action='store_true',
+        help='Rather than decoding videofile, measure byte and caption error rates and frames/sec of the decode '
+             'settings against synthetic captions with noise, drop-outs, dim luma and drift. --output saves the '
+             'results as JSON')
+    p.add_argument('--benchmark_repeats', default=4, type=int,
+        help='Times --benchmark repeats its sample captions, more is slower but steadier (default 4)')
+    p.add_argument('--benchmark_baseline', default=None, metavar='RESULTS',
+        help='Results saved by an earlier --benchmark, exit with status 1 if any are now less accurate')
 
     args = p.parse_args()
 
     # Prime stdout for unicode UTF-8 output
-    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stdout.reconfigure(encoding='utf-8', line_buffering=True if args.follow else None)
 
     # Set video level
     lib.cc_decode.LUMA_THRESHOLD = args.bitlevel
 
-    if args.videofile:
+    raw_size = None
+    if args.raw:
+        raw_size = tuple(int(dimension) for dimension in args.raw.lower().split('x'))
+
+    checkpoint = args.checkpoint
+    if checkpoint is None and args.output:
+        checkpoint = args.output + '.checkpoint'
+
+    threads = args.ffmpeg_threads
+    if threads is None and (args.serve or args.watch or args.shard):
+        threads = 1  # Our workers are already using the cores
+    profile = ffmpeg_profile(args.ffmpeg_preset, threads=threads, stream=args.video_stream,
+                             input_args=shlex.split(args.ffmpeg_input_args) if args.ffmpeg_input_args else None,
+                             filter_args=(args.ffmpeg_filter,) if args.ffmpeg_filter else None)
+
+    progress = args.progress
+    if progress is None:
+        progress = 10 if sys.stderr.isatty() else 0
+
+    if args.benchmark:
+        from lib.cc_bench import benchmark, format_results, save_results, load_results, regressions
+        results = benchmark(repeats=args.benchmark_repeats)
+        print(format_results(results))
+        if args.output:
+            save_results(results, args.output)
+        if args.benchmark_baseline:
+            messages = regressions(results, load_results(args.benchmark_baseline))
+            for message in messages:
+                print('Regression: %s' % message)
+            if messages:
+                sys.exit(1)
+    elif args.serve or args.watch or args.shard:
+        from lib.cc_jobs import serve, watch, shard
+        if (args.watch or args.shard) and ',' in args.ccformat:
+            p.error('--watch and --shard decode each video to one caption file, --ccformat %s names several'
+                    % args.ccformat)
+        options = dict(ffmpeg_path=args.ffmpeg, temp_path=args.temp, lines=args.lines, start_line=args.start_line,
+                       ccfilter=args.ccfilter, max_backlog_frames=args.max_backlog_frames,
+                       max_backlog_bytes=args.max_backlog_bytes, prefetch_depth=args.prefetch, raw_size=raw_size,
+                       raw_frame_bytes=args.raw_frame_bytes, full_range=args.full_range, bitlevel=args.bitlevel,
+                       ffmpeg_profile=profile, skip_pulldown=not args.decode_repeats)
+        if args.serve:
+            serve(args.serve, run_decode_job, workers=args.workers, initializer=_warm_worker, default_options=options,
+                  output_root=args.output_root, formats=sorted(ClosedCaptionFileDecoder.DECODERS))
+        elif args.shard:
+            shard(args.shard, run_decode_job, args.ccformat, workers=args.workers, initializer=_warm_worker,
+                  default_options=options, lease_seconds=args.lease_seconds, retries=args.retries)
+        else:
+            priorities = [(pattern, int(priority)) for pattern, _, priority in
+                          (value.rpartition('=') for value in args.priority)]
+            watch(args.watch, run_decode_job, args.ccformat, workers=args.workers, initializer=_warm_worker,
+                  default_options=options, stable_seconds=args.stable_seconds, retries=args.retries,
+                  priorities=priorities)
+    elif args.videofile:
         decoder = ClosedCaptionFileDecoder(ffmpeg_path=args.ffmpeg, temp_path=args.temp, ccformat=args.ccformat,
-                                           lines=args.lines, start_line=args.start_line, ccfilter=args.ccfilter)
-        decoder.decode(args.videofile)
-
-main()
\ No newline at end of file
+                                           lines=args.lines, start_line=args.start_line, ccfilter=args.ccfilter,
+                                           output_path=args.output, checkpoint_path=checkpoint,
+                                           checkpoint_interval=args.checkpoint_interval,
+                                           max_backlog_frames=args.max_backlog_frames,
+                                           max_backlog_bytes=args.max_backlog_bytes,
+                                           prefetch_depth=args.prefetch, raw_size=raw_size,
+                                           raw_frame_bytes=args.raw_frame_bytes, full_range=args.full_range,
+                                           ffmpeg_profile=profile, demux=args.demux,
+                                           skip_pulldown=not args.decode_repeats,
+                                           progress_interval=progress, metrics_path=args.metrics,
+                                           metrics_interval=args.metrics_interval, follow=args.follow,
+                                           follow_idle=args.follow_idle, start=args.start, end=args.end,
+                                           preroll=args.preroll)
+        paths = decoder.decode(args.videofile, resume=args.resume)
+        for path in paths or []:
+            print('Wrote %s' % path, file=sys.stderr)
+    else:
+        p.error('videofile is required, unless running with --serve, --watch, --shard or --benchmark')
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
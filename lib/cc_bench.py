@@ -0,0 +1,310 @@
+#!/usr/local/bin/python
+# coding: utf-8
+"""
+Accuracy against speed for ccDecoder - renders known caption byte streams into synthetic line 21 rows, impairs them
+the way worn tape and poor captures do (noise, drop-outs, dim or hot luma, horizontal drift) and measures how well,
+and how fast, each decode configuration reads them back. Only the standard library is used.
+
+Public domain / Unlicense
+But attribution is always appreciated where possible.
+"""
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+import collections
+import contextlib
+import json
+import math
+import random
+import time
+import lib.cc_decode
+from lib.cc_decode import memoize, BaseImageWrapper, CaptionEngine, CaptionCollector, NO_PARITY_TO_ODD_PARITY, \
+    SYNC_SIGNAL_LOCATIONS_HIGH, BIT_PITCH, NOMINAL_WIDTH, reset_row_lock, extract_closed_caption_bytes, \
+    RepeatedControlFilter
+
+CC_HIGH = 128  # 50 IRE, as the standard asks for, in full range luma
+CC_LOW = 0
+DATA_START = 280  # Pixel the start bit ends and the first data bit begins, in 720 pixel wide video
+DRIFT_PERIOD = 150  # Frames for horizontal drift to wander out and back
+NOISE_SAMPLES = 1 << 16  # Gaussian noise is drawn from a table this long, at a random place for each row
+CAPTION_FRAME_TOLERANCE = 2  # A caption a frame or two late (one of a doubled control code lost) still counts
+
+SAMPLE_CAPTIONS = [
+    'THE QUICK BROWN FOX',
+    'JUMPS OVER THE LAZY DOG.',
+    'Pack my box with five',
+    'dozen liquor jugs!',
+    '(SIGHS) 1, 2, 3 - GO?',
+]
+
+Impairment = collections.namedtuple('Impairment', 'name noise dropout luma_scale drift pitch')
+Impairment.__doc__ = """ How a synthetic source is degraded
+     noise      - standard deviation of Gaussian noise added to every pixel, in 8 bit luma levels
+     dropout    - chance of each frame's caption row having a drop-out (a streak of black or white across it)
+     luma_scale - gain applied to the whole row, under 1 for a dim capture, over 1 for a hot one
+     drift      - how far (in pixels of 720 pixel wide video) the row wanders left and right, over DRIFT_PERIOD frames
+     pitch      - pixels per bit of the source, for a tape running slow or fast """
+
+SCENARIOS = [
+    Impairment('clean', 0, 0, 1.0, 0, BIT_PITCH),
+    Impairment('noisy', 24, 0, 1.0, 0, BIT_PITCH),
+    Impairment('dropouts', 0, 0.05, 1.0, 0, BIT_PITCH),
+    Impairment('dim', 8, 0, 0.7, 0, BIT_PITCH),
+    Impairment('drifting', 4, 0, 1.0, 10, BIT_PITCH * 1.02),
+    Impairment('worn tape', 16, 0.02, 0.8, 6, BIT_PITCH * 0.98),
+]
+
+BenchResult = collections.namedtuple('BenchResult',
+                                     'scenario config frames byte_error_rate caption_error_rate frames_per_second')
+BenchResult.__doc__ = """ How a decode configuration did on a scenario
+     byte_error_rate    - fraction of sent bytes not read back, a frame where no captions were found loses both
+     caption_error_rate - captions missed or mangled (or spurious, if more), as a fraction of the captions sent
+     frames_per_second  - decode speed, rendering the frames is not counted """
+
+
+class DecodeConfig(object):
+    """ A way of decoding, lib.cc_decode settings to trade accuracy for speed
+         name       - name to report it by
+         row_access - let the decoder slice whole rows (get_row), rather than read pixel by pixel
+         settings   - lib.cc_decode module settings to override, i.e. SAMPLE_SIZE=1 or LUMA_THRESHOLD=60 """
+
+    def __init__(self, name, row_access=True, **settings):
+        self.name = name
+        self.row_access = row_access
+        self.settings = settings
+
+    @contextlib.contextmanager
+    def applied(self):
+        """ Use this configuration, and a fresh row lock, for the duration of the with block """
+        saved = {setting: getattr(lib.cc_decode, setting) for setting in self.settings}
+        for setting, value in self.settings.items():
+            setattr(lib.cc_decode, setting, value)
+        reset_row_lock()
+        try:
+            yield
+        finally:
+            for setting, value in saved.items():
+                setattr(lib.cc_decode, setting, value)
+            reset_row_lock()
+
+
+CONFIGS = [
+    DecodeConfig('default'),
+    DecodeConfig('per-pixel', row_access=False),
+    DecodeConfig('1 sample', SAMPLE_SIZE=1),
+    DecodeConfig('5 samples', SAMPLE_SIZE=5),
+    DecodeConfig('no tracking', BIT_CLOCK_GAIN=0),
+    DecodeConfig('narrow scan', PREAMBLE_SCAN_RANGE=range(-4, 5)),
+    DecodeConfig('bitlevel 60', LUMA_THRESHOLD=60),
+    DecodeConfig('bitlevel 97', LUMA_THRESHOLD=97),
+]
+
+
+class SyntheticImage(BaseImageWrapper):
+    """ A frame of rendered rows of full range luma
+         rows       - a bytes object per row
+         row_access - serve whole rows through get_row, otherwise only get_pixel_luma works """
+
+    def __init__(self, rows, row_access=True):
+        self.rows = rows
+        self.row_access = row_access
+        self.height = len(rows)
+        self.width = len(rows[0])
+
+    def get_pixel_luma(self, x, y):
+        return self.rows[int(y)][int(x)]
+
+    def get_row(self, y):
+        return self.rows[int(y)] if self.row_access else None
+
+    def unlink(self):
+        pass
+
+
+def caption_byte_stream(captions=None, hold_frames=60, gap_frames=15):
+    """ The byte pairs, one per frame, to show each caption pop-on on the bottom row for hold_frames, with
+        gap_frames of nothing in between. Control codes are sent twice, as broadcasters do """
+    null, erase, load, flip = (0, 0), (0x14, 0x2c), (0x14, 0x20), (0x14, 0x2f)
+    pairs = [null] * gap_frames
+    for text in captions or SAMPLE_CAPTIONS:
+        if len(text) % 2:
+            text += ' '  # Pad to whole pairs, CC_TABLE[0] would drop a character
+        pairs += [load, load, (0x14, 0x70), (0x14, 0x70)]  # Row 15, column 0
+        pairs += [(ord(text[i]), ord(text[i + 1])) for i in range(0, len(text), 2)]
+        pairs += [flip, flip] + [null] * hold_frames + [erase, erase] + [null] * gap_frames
+    return pairs
+
+
+@memoize
+def render_row(byte1, byte2, phase=0.0, pitch=BIT_PITCH, width=NOMINAL_WIDTH):
+    """ A line 21 row carrying the passed (7 bit) bytes as full range luma values, odd parity added. The run-in is a
+        sine wave and the data bits square, phase and pitch move and stretch the lot as a wandering tape would.
+        Memoized, without drift most frames are the same few rows """
+    bits = [True] + [bool(byte & (1 << i)) for byte in (NO_PARITY_TO_ODD_PARITY[byte1 & 0x7f],
+                                                         NO_PARITY_TO_ODD_PARITY[byte2 & 0x7f]) for i in range(8)]
+    start = SYNC_SIGNAL_LOCATIONS_HIGH[0] + phase  # First run-in peak
+    data_cycles = (DATA_START - SYNC_SIGNAL_LOCATIONS_HIGH[0]) / BIT_PITCH
+    scale = NOMINAL_WIDTH / width
+    row = []
+    for x in range(width):
+        cycles = (x * scale - start) / pitch
+        if -0.5 <= cycles < 6.5:
+            row.append((CC_HIGH + CC_LOW) / 2 + (CC_HIGH - CC_LOW) / 2 * math.cos(2 * math.pi * cycles))
+        else:
+            bit = math.floor(cycles - data_cycles) + 1  # The start bit, then the data bits
+            row.append(CC_HIGH if 0 <= bit < len(bits) and bits[bit] else CC_LOW)
+    return tuple(row)
+
+
+def impair(row, impairment, rand, noise):
+    """ Noise, drop-out and luma scaling applied to a rendered row, returned as bytes
+         noise - NOISE_SAMPLES Gaussian values with a standard deviation of 1 """
+    row = [v * impairment.luma_scale for v in row]
+    if impairment.dropout and rand.random() < impairment.dropout:
+        start = rand.randrange(len(row))
+        length = rand.randint(len(row) // 30, len(row) // 6)
+        level = rand.choice((0, 255))
+        row[start:start + length] = [level] * len(row[start:start + length])
+    if impairment.noise:
+        start = rand.randrange(len(noise) - len(row))
+        row = [v + n * impairment.noise for v, n in zip(row, noise[start:start + len(row)])]
+    return bytes(min(255, max(0, int(round(v)))) for v in row)
+
+
+def render_frames(pairs, impairment, width=NOMINAL_WIDTH, height=3, row_number=1, seed=21):
+    """ Rows for a frame per byte pair, captions on row_number and black (plus the noise) on the others. The same
+        seed renders the same frames, so configurations are compared on identical input """
+    rand = random.Random(seed)
+    noise = [rand.gauss(0, 1) for _ in range(NOISE_SAMPLES)] if impairment.noise else None
+    black = [CC_LOW] * width
+    frames = []
+    for frame, (byte1, byte2) in enumerate(pairs):
+        phase = impairment.drift * math.sin(2 * math.pi * frame / DRIFT_PERIOD)
+        caption_row = render_row(byte1, byte2, phase, impairment.pitch, width)
+        frames.append([impair(caption_row if row == row_number else black, impairment, rand, noise) for row in range(height)])
+    return frames
+
+
+def captions_from_pairs(pairs):
+    """ The (start frame, text) of each caption a stream of byte pairs, None where none were read, shows """
+    engine = CaptionEngine(channels=(1,))
+    collector = CaptionCollector()
+    repeats = RepeatedControlFilter()
+    for frame, (byte1, byte2) in enumerate(pairs):
+        if byte1 is not None and not repeats.is_repeat(byte1, byte2):
+            for event in engine.feed(byte1, byte2, frame):
+                collector.write(event)
+    for event in engine.flush(len(pairs)):
+        collector.write(event)
+    collector.finish(len(pairs))
+    return [(caption.start_frame, caption.text) for caption in collector.items]
+
+
+def caption_error_rate(sent, read):
+    """ Captions of sent not found in read (allowing CAPTION_FRAME_TOLERANCE frames of lateness), or of read that
+        weren't sent if there are more of those, as a fraction of sent. A mangled caption counts once, not twice """
+    unmatched = list(read)
+    missed = 0
+    for start_frame, text in sent:
+        match = next((caption for caption in unmatched if caption[1] == text and
+                      abs(caption[0] - start_frame) <= CAPTION_FRAME_TOLERANCE), None)
+        if match:
+            unmatched.remove(match)
+        else:
+            missed += 1
+    return max(missed, len(unmatched)) / max(1, len(sent))
+
+
+def run_config(config, frames, pairs, sent_captions, scenario_name=''):
+    """ Decode the rendered frames with a DecodeConfig, returning a BenchResult """
+    images = [SyntheticImage(rows, config.row_access) for rows in frames]
+    with config.applied():
+        started = time.perf_counter()
+        read = [extract_closed_caption_bytes(image, drop_repeats=False)[2:] for image in images]
+        elapsed = time.perf_counter() - started
+    byte_errors = sum((b1 != sent1) + (b2 != sent2) for (b1, b2), (sent1, sent2) in zip(read, pairs))
+    return BenchResult(scenario_name, config.name, len(pairs), byte_errors / (2 * len(pairs)),
+                       caption_error_rate(sent_captions, captions_from_pairs(read)),
+                       len(pairs) / elapsed if elapsed else float('inf'))
+
+
+def benchmark(scenarios=None, configs=None, repeats=1, width=NOMINAL_WIDTH, seed=21, captions=None):
+    """ Run every configuration against every scenario, returning a list of BenchResults
+         scenarios - Impairments to render, default SCENARIOS
+         configs   - DecodeConfigs to decode with, default CONFIGS
+         repeats   - how many times to repeat the sample captions, more gives steadier figures
+         width     - frame width to render at
+         captions  - caption texts to send, default SAMPLE_CAPTIONS """
+    pairs = caption_byte_stream((captions or SAMPLE_CAPTIONS) * repeats)
+    sent_captions = captions_from_pairs(pairs)
+    results = []
+    for impairment in scenarios or SCENARIOS:
+        frames = render_frames(pairs, impairment, width=width, seed=seed)
+        for config in configs or CONFIGS:
+            results.append(run_config(config, frames, pairs, sent_captions, impairment.name))
+    return results
+
+
+def format_results(results):
+    """ Results as a table, configurations side by side for each scenario """
+    lines = ['%-12s %-14s %10s %12s %10s' % ('scenario', 'config', 'byte err', 'caption err', 'frames/s')]
+    for result in results:
+        lines.append('%-12s %-14s %9.2f%% %11.2f%% %10.0f'
+                     % (result.scenario, result.config, result.byte_error_rate * 100,
+                        result.caption_error_rate * 100, result.frames_per_second))
+    return '\n'.join(lines)
+
+
+def save_results(results, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([result._asdict() for result in results], f, indent=1)
+
+
+def load_results(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [BenchResult(**result) for result in json.load(f)]
+
+
+def regressions(results, baseline, tolerance=0.005):
+    """ Where results are less accurate than a baseline (i.e. from save_results before a change) by more than
+        tolerance, as messages. Speed isn't compared - it depends on the machine """
+    previous = {(result.scenario, result.config): result for result in baseline}
+    messages = []
+    for result in results:
+        before = previous.get((result.scenario, result.config))
+        if before is None:
+            continue
+        for measure in ('byte_error_rate', 'caption_error_rate'):
+            if getattr(result, measure) > getattr(before, measure) + tolerance:
+                messages.append('%s / %s: %s %.2f%% was %.2f%%' % (result.scenario, result.config, measure,
+                                                                   getattr(result, measure) * 100,
+                                                                   getattr(before, measure) * 100))
+    return messages
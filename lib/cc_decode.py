@@ -45,20 +45,41 @@ __version__ = "1.0.0"
 __maintainer__ = "Max Smith"
 __email__ = None  # Sorry, I get far too much spam as it is. Track me down at http://www.notonbluray.com
 
+import collections
+import contextlib
+import itertools
+import math
+import operator
 import os
+import threading
 
-# Assumes 27 pixel wide 'bit' starting at pixel 280 - assumes 720 pixel wide video (enforced elsewhere)
+# Nominal width of a bit, and of a cycle of the run-in clock, in pixels of 720 pixel wide video. Locations below are
+# all for 720 pixel wide video, and are scaled to the actual width of each frame as it is read, so frames never need
+# resizing. Worn tapes with timebase error stretch or shrink the pitch a little, so the actual pitch is tracked
+NOMINAL_WIDTH = 720
+BIT_PITCH = 27
+BIT_PITCH_RANGE = (BIT_PITCH * 0.95, BIT_PITCH * 1.05)
+
+# Assumes 27 pixel wide 'bit' starting at pixel 280
 # Odd parity on the rightmost bit, we sample central pixels of the bit and average
-BYTE1_LOCATIONS = [285 + (i * 27) for i in range(0, 8)]
-BYTE2_LOCATIONS = [285 + (i * 27) for i in range(8, 16)]
+BYTE1_LOCATIONS = [285 + (i * BIT_PITCH) for i in range(0, 8)]
+BYTE2_LOCATIONS = [285 + (i * BIT_PITCH) for i in range(8, 16)]
+SAMPLE_SIZE = 3  # Pixels averaged to read each bit, more rides out noise and drop-outs but costs time
 
 # Sine wave preamble indicates presence of captions
-SYNC_SIGNAL_LOCATIONS_HIGH = [28 + (i * 27) for i in range(0, 7)]  # White
-SYNC_SIGNAL_LOCATIONS_LOW = [14 + (i * 27) for i in range(0, 7)]   # Black
+SYNC_SIGNAL_LOCATIONS_HIGH = [28 + (i * BIT_PITCH) for i in range(0, 7)]  # White
+SYNC_SIGNAL_LOCATIONS_LOW = [14 + (i * BIT_PITCH) for i in range(0, 7)]   # Black
 
-# When searching for preamble - search in this range
+# When searching for preamble - search in this range, nearest the last known offset first
 PREAMBLE_SCAN_RANGE = range(-13, 30)
 
+# How much of each measured phase/pitch error is corrected per frame, less than 1 to average out noise
+BIT_CLOCK_GAIN = 0.5
+
+# While no row has captions, only the last row they were on is checked each frame. Searching every row happens
+# less and less often - after 1, 2, 4 ... frames - up to once every this many frames
+ROW_SEARCH_MAX_INTERVAL = 16
+
 # Bit value of 1 above this 'luma' level, 0 below
 LUMA_THRESHOLD = 80  # Standard is 50IRE +/- 12
                      # which is an 8 bit pixel level of around 97 - 99 depending on if 16-235 or 0-255 is used
@@ -270,6 +291,18 @@ def _cc_preamble_table():
             table[(CC2_PREAMBLE_COLS[col], row_code)] = 'CC2 %s row %d' % (text, (col + 1))
     return table
 
+SCREEN_ROWS = 15
+SCREEN_COLUMNS = 32
+
+# Preamble address code (first byte, second byte is 0x60-0x7F) -> screen row, counting from 0 at the top
+PAC_ROWS = {(CC1_PREAMBLE_COLS[row], COL_PREAMBLE[row] is EVEN_PREAMBLE): row for row in range(SCREEN_ROWS)}
+
+# Caption modes
+POP_ON = 'pop-on'
+ROLL_UP = 'roll-up'
+PAINT_ON = 'paint-on'
+TEXT_MODE = 'text'
+
 # Achieving compatibility with Python2 and 3 makes us do strange things
 ALL_CC_CONTROL_CODES = _cc_preamble_table()
 ALL_CC_CONTROL_CODES.update(CC1_CONTROL_CODES)
@@ -394,6 +427,21 @@ XDS_MONTH = {
     0xc : 'Dec',
     }
 
+# XDS packet start codes (the continue code for each class is one higher) and the classes they introduce
+XDS_CLASSES = {
+    0x01: 'Current',
+    0x03: 'Future',
+    0x05: 'Channel',
+    0x07: 'Miscellaneous',
+    0x09: 'Public Service',
+    0x0b: 'Reserved',
+    0x0d: 'Private Data',
+}
+
+XDS_MAX_PACKET_PAIRS = 18  # Start, 32 informational characters and end. Anything longer is corrupt
+
+DECODED_CHANNELS = (1, 2)  # CC3 and CC4 are on the second field, which isn't read
+
 CC_FILTER_TO_TXT = {
     1: 'CC1',
     2: 'CC2',
@@ -403,8 +451,75 @@ CC_FILTER_TO_TXT = {
 
 
 
-lastPreambleOffset = 0  # Global cache last preamble offset
+lastPreambleOffset = 0  # Global cache last preamble offset (phase), in fractions of a pixel
+lastBitPitch = BIT_PITCH  # Global, tracked pixels per bit
 lastRowFound = 0  # Global, cache the last row we found cc's on
+trackedPreamble = (None, None)  # Global, (lastPreambleOffset, lastBitPitch, width) and the run-in pixel positions
+rowSearchInterval = 1  # Global, frames between searches of every row, while captions are absent
+framesUntilRowSearch = 0  # Global, frames to go until the next search of every row
+lastCaptionBytes = (None, None)  # Global, the bytes last read from a frame, what a RepeatedFrame repeated
+lastParityErrors = (False, False)  # Global, whether each byte last read from a frame failed its parity check
+lastControlRepeated = False  # Global, whether the pair last extracted repeated the control code before it
+
+
+class RepeatedControlFilter(object):
+    """ Control codes are transmitted twice in a row, so one lost to noise is still received. Spots the copies after
+        the first of a run of identical codes, so it is acted on once - however long the run (a duplicated frame can
+        make three). Padding between copies doesn't end a run, a different code or text does """
+
+    def __init__(self):
+        self.last_control = None
+
+    def reset(self):
+        self.last_control = None
+
+    def is_repeat(self, byte1, byte2):
+        """ True if the passed pair repeats the control code before it """
+        if 0x10 <= byte1 <= 0x1f:
+            if (byte1, byte2) == self.last_control:
+                return True
+            self.last_control = (byte1, byte2)
+        elif byte1 or byte2:
+            self.last_control = None
+        return False
+
+
+class DecodeStats(object):
+    """ Running totals of a decode, for progress reports - frames read, frames captions were found on, frames with
+        parity errors and captions shown (pop-on captions flipped on screen and roll-up lines) """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.locked_frames = 0
+        self.repeated_frames = 0  # Pulldown repeats, not decoded
+        self.captions = 0
+        self.parity_errors = 0
+
+    def update(self, byte1, byte2, repeat=False, duplicate=False, parity_error=False):
+        """ Count a frame
+             repeat       - a pulldown repeat, not read
+             duplicate    - a repeat of a control code (see RepeatedControlFilter), or a pulldown repeat's bytes
+             parity_error - either byte failed its parity check """
+        self.frames += 1
+        self.repeated_frames += repeat
+        self.parity_errors += parity_error
+        if byte1 is None:
+            return
+        self.locked_frames += 1
+        if duplicate or not 0x10 <= byte1 <= 0x1f:
+            return
+        code = ALL_CC_CONTROL_CODES.get((byte1, byte2))
+        if code and ('End of Caption' in code or 'Carriage Return' in code):
+            self.captions += 1
+
+
+decodeStats = DecodeStats()  # Global, reset with the row lock
+controlRepeats = RepeatedControlFilter()  # Global, drops the second copy of control codes as they are extracted
+decodeOwner = None  # Global, what the state above belongs to while a decode is running, see exclusive_decode
+decodeOwnerLock = threading.Lock()
 
 
 def memoize(f):
@@ -426,6 +541,12 @@ class BaseImageWrapper(object):
         """ Return a pixels luma value normalized to the range 0 (black) to 255 (white) """
         raise NotImplemented('get_pixel_luma must be overridden')
 
+    def get_row(self, y):
+        """ Optionally return a whole row of luma values normalized to the range 0 (black) to 255 (white), as bytes
+            (or any bytes-like object of 8 bit values). Where an image can, decoding slices the row rather than
+            calling get_pixel_luma for every pixel - several times faster. None means it can't """
+        return None
+
     def unlink(self):
         """ Delete the underlying file, and/or release the resource held """
         raise NotImplemented('unlink must be overridden')
@@ -445,6 +566,119 @@ class FileImageWrapper(BaseImageWrapper):
         os.unlink(self.file_name)
 
 
+class DecodedFrame(BaseImageWrapper):
+    """ A frame whose closed caption bytes have already been read, i.e. from demux_caption_channels. Decoders take
+        the bytes as they are rather than reading them from the image
+         byte1, byte2 - the bytes, None for a frame without captions """
+    def __init__(self, byte1, byte2):
+        self.caption_bytes = (byte1, byte2)
+        self.width = NOMINAL_WIDTH
+        self.height = 1
+
+    def get_pixel_luma(self, x, y):
+        return 0
+
+    def unlink(self):
+        pass
+
+
+class RepeatedFrame(DecodedFrame):
+    """ A frame whose caption row repeats the frame before's exactly, i.e. a pulldown duplicate. Its bytes were
+        sent once, with the frame it repeats, so it is read as padding - only the frame count moves on. See
+        skip_pulldown_repeats """
+    def __init__(self):
+        super(RepeatedFrame, self).__init__(0, 0)
+
+
+class DecodeCheckpoint(object):
+    """ Periodically saves decoder state to disk, so that a long decode which dies part way through can be resumed
+        from the last checkpoint rather than from the first frame.
+         path     - file to write the checkpoint to (written atomically via a temporary file)
+         interval - number of frames between checkpoints
+         output   - file object the captions are being written to, its offset is saved with each checkpoint """
+
+    def __init__(self, path, interval=1800, output=None):
+        self.path = path
+        self.interval = interval
+        self.output = output
+        self.state = None
+
+    def load(self):
+        """ Read a previously saved checkpoint and restore the row/phase lock, with the row search back-off and the
+            bytes last read, so the resumed decode reads the same frames the uninterrupted one would have. Returns
+            the saved state or None """
+        global lastPreambleOffset, lastBitPitch, lastRowFound, rowSearchInterval, framesUntilRowSearch, lastCaptionBytes
+        if not os.path.exists(self.path):
+            return None
+        import json  # Imported here, as only checkpoints and jsonl output need it
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self.state = json.load(f)
+        lastPreambleOffset = self.state['preamble_offset']
+        lastBitPitch = self.state.get('bit_pitch', BIT_PITCH)
+        lastRowFound = self.state['row']
+        rowSearchInterval = self.state.get('row_search_interval', 1)
+        framesUntilRowSearch = self.state.get('frames_until_row_search', 0)
+        lastCaptionBytes = tuple(self.state.get('last_bytes', (None, None)))
+        last_control = self.state.get('last_control')
+        controlRepeats.last_control = last_control and tuple(last_control)
+        return self.state
+
+    @property
+    def frame(self):
+        """ The frame number to resume decoding from """
+        return self.state['frame'] if self.state else 0
+
+    @property
+    def output_offset(self):
+        """ The offset into the output file that had been written at the time of the checkpoint """
+        return self.state['output_offset'] if self.state else 0
+
+    def restore(self, decoder):
+        """ Return the saved state for the named decoder, or an empty dict if there isn't any """
+        if not self.state:
+            return {}
+        if self.state['decoder'] != decoder:
+            raise RuntimeError('Checkpoint %s was written by the %s decoder, not %s'
+                               % (self.path, self.state['decoder'], decoder))
+        return dict(self.state['decoder_state'], frame=self.state['frame'])
+
+    def due(self, frame):
+        return self.interval > 0 and frame % self.interval == 0
+
+    def save(self, decoder, frame, **decoder_state):
+        """ Save the state of the named decoder - which must be JSON serializable - as of the passed frame """
+        output_offset = 0
+        if self.output is not None:
+            self.output.flush()
+            output_offset = self.output.tell()
+        self.state = {'decoder': decoder, 'frame': frame, 'preamble_offset': lastPreambleOffset,
+                      'bit_pitch': lastBitPitch, 'row': lastRowFound, 'row_search_interval': rowSearchInterval,
+                      'frames_until_row_search': framesUntilRowSearch, 'last_bytes': lastCaptionBytes,
+                      'last_control': controlRepeats.last_control,
+                      'output_offset': output_offset, 'decoder_state': decoder_state}
+        temp_path = self.path + '.tmp'
+        import json
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        """ Decoding completed - the checkpoint is no longer needed """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def warm_up(image_list, frames, fixed_line=None, delete_image_after=True):
+    """ Read the closed captions of the first frames images only to lock on to the caption row, i.e. for a preroll
+        before the part of a video wanted. Returns an iterator of the rest of the images """
+    images = iter(image_list)
+    for image in itertools.islice(images, frames):
+        extract_closed_caption_bytes(image, fixed_line)
+        if delete_image_after:
+            image.unlink()
+    return images
+
+
 @memoize
 def decode_byte_pair(byte1, byte2):
     """ Decode a pair of bytes"""
@@ -457,55 +691,164 @@ def decode_byte_pair(byte1, byte2):
            CC_TABLE.get(byte2, '?b2(%02x)' % (byte2))
 
 
-def decode_byte(image, bit_locations, sample_size, row_number, offset=0):
+def luma_row(image, row_number):
+    """ The image's row of luma values if it can provide one (see BaseImageWrapper.get_row), otherwise None """
+    get_row = getattr(image, 'get_row', None)
+    return get_row(row_number) if get_row else None
+
+
+def decode_byte(image, bit_locations, sample_size, row_number, offset=0, parity=False):
     """ Decode a single byte from a closed caption images
          bit_locations - where to start sampling for each bit
          sample_size   - how many pixels to average for each bit
          row_number    - which row number to look at
-         offset       """
-    def pixel_avg(x):
-        return sum(image.get_pixel_luma(i + offset, row_number) for i in range(x, x + sample_size)) / sample_size
+         offset        - column offset added to each location
+         parity        - include the parity bit, returning all 8 bits rather than the 7 data bits """
+    row = luma_row(image, row_number)
+    if row is not None:
+        # Comparing the sum rather than the average saves a division per bit
+        threshold = LUMA_THRESHOLD * sample_size
+        b = [sum(row[col + offset:col + offset + sample_size]) > threshold for col in bit_locations]
+    else:
+        def pixel_avg(x):
+            return sum(image.get_pixel_luma(i + offset, row_number) for i in range(x, x + sample_size)) / sample_size
+
+        b = [pixel_avg(col) > LUMA_THRESHOLD for col in bit_locations]
+    value = b[0] + b[1] * 2 + b[2] * 4 + b[3] * 8 + b[4] * 16 + b[5] * 32 + b[6] * 64
+    return value + b[7] * 128 if parity else value
+
+
+def strip_parity(byte1, byte2):
+    """ Check the odd parity of two bytes read with their parity bit, noting the result in lastParityErrors. Returns
+        the bytes' 7 data bits """
+    global lastParityErrors
+    lastParityErrors = (NO_PARITY_TO_ODD_PARITY[byte1 & 0x7f] != byte1, NO_PARITY_TO_ODD_PARITY[byte2 & 0x7f] != byte2)
+    return byte1 & 0x7f, byte2 & 0x7f
+
+
+def bit_positions(locations, offset=0, pitch=BIT_PITCH):
+    """ Where the passed nominal locations are, for a run-in clock offset and stretched (or shrunk) to the pitch.
+        Positions are relative to the first run-in peak, so it is the only one that only moves with offset """
+    anchor = SYNC_SIGNAL_LOCATIONS_HIGH[0]
+    scale = pitch / BIT_PITCH
+    return [anchor + offset + (loc - anchor) * scale for loc in locations]
 
-    b = [pixel_avg(col) > LUMA_THRESHOLD for col in bit_locations]
-    return b[0] + b[1] * 2 + b[2] * 4 + b[3] * 8 + b[4] * 16 + b[5] * 32 + b[6] * 64  # TODO parity
 
+def pixel_positions(positions, width):
+    """ Scale positions in 720 pixel wide video to whole pixels in a frame width pixels wide """
+    scale = width / NOMINAL_WIDTH
+    return [int(x * scale + 0.5) for x in positions]
 
-def decode_row(image, sample_size=3, row_number=1, offset=0):
+
+def decode_row(image, sample_size=None, row_number=1, offset=0, pitch=BIT_PITCH, parity=False):
     """ Attempt to pull two bytes worth of CC values out of a passed row of luma values
-          sample_size - how many pixels wide to read each bit (Noise/drop-out reduction)
+          sample_size - how many pixels wide to read each bit (Noise/drop-out reduction), default SAMPLE_SIZE
           row_number  - which row (y) of video to read as line 21 (typically row 1)
-          offset      - column (x) starting offset, default is zero which reflects typical starting point """
-    return (decode_byte(image, BYTE1_LOCATIONS, sample_size, row_number, offset),
-            decode_byte(image, BYTE2_LOCATIONS, sample_size, row_number, offset))
+          offset      - column (x) starting offset, default is zero which reflects typical starting point
+          pitch       - pixels per bit, default is nominal
+          parity      - include each byte's parity bit, see decode_byte
+          Offset and pitch are in pixels of 720 pixel wide video, whatever the width of the image """
+    sample_size = sample_size or SAMPLE_SIZE
+    if not offset and pitch == BIT_PITCH and image.width == NOMINAL_WIDTH:
+        return (decode_byte(image, BYTE1_LOCATIONS, sample_size, row_number, parity=parity),
+                decode_byte(image, BYTE2_LOCATIONS, sample_size, row_number, parity=parity))
+    last = image.width - sample_size  # A long way off nominal, keep reading within the image
+    return tuple(decode_byte(image, [min(x, last) for x in pixel_positions(bit_positions(locations, offset, pitch),
+                                                                            image.width)], sample_size, row_number,
+                             parity=parity)
+                 for locations in (BYTE1_LOCATIONS, BYTE2_LOCATIONS))
+
+
+def track_bit_clock(image, row_number):
+    """ Refine the phase (lastPreambleOffset) and pitch (lastBitPitch) of the bit clock from the run-in on a row we
+        know has captions. Each run-in peak is sampled a quarter cycle either side of where we expect it - if the
+        peak is where we expect the two match, if it has moved their difference says which way and (for a sine)
+        how far. A straight line through the errors of the seven peaks gives the phase error (where it crosses the
+        first peak) and pitch error (its slope). Only part of each error is corrected, to ride out noise """
+    global lastPreambleOffset, lastBitPitch
+    scale = image.width / NOMINAL_WIDTH
+    row = luma_row(image, row_number)
+
+    def pixel(x):
+        if row is not None:
+            return row[int(x * scale + 0.5)]
+        return image.get_pixel_luma(int(x * scale + 0.5), row_number)
+
+    highs = bit_positions(SYNC_SIGNAL_LOCATIONS_HIGH, lastPreambleOffset, lastBitPitch)
+    lows = bit_positions(SYNC_SIGNAL_LOCATIONS_LOW, lastPreambleOffset, lastBitPitch)
+    amplitude = (sum(pixel(x) for x in highs) - sum(pixel(x) for x in lows)) / (2 * len(highs))
+    if amplitude <= 0:
+        return
+    quarter = lastBitPitch / 4
+    errors = []
+    for x in highs:
+        difference = (pixel(x + quarter) - pixel(x - quarter)) / (2 * amplitude)
+        errors.append(lastBitPitch / (2 * math.pi) * math.asin(max(-1.0, min(1.0, difference))))
+    middle = (len(errors) - 1) / 2
+    slope = sum((i - middle) * error for i, error in enumerate(errors)) / \
+        sum((i - middle) ** 2 for i in range(len(errors)))
+    phase_error = sum(errors) / len(errors) - middle * slope
+    lastBitPitch = max(BIT_PITCH_RANGE[0], min(BIT_PITCH_RANGE[1], lastBitPitch + BIT_CLOCK_GAIN * slope))
+    lastPreambleOffset = max(PREAMBLE_SCAN_RANGE[0], min(PREAMBLE_SCAN_RANGE[-1],
+                                                         lastPreambleOffset + BIT_CLOCK_GAIN * phase_error))
+
+
+def preamble_positions(offset, pitch, width):
+    """ Pixel positions of the run-in peaks and troughs in a frame width pixels wide, and getters to pull the values
+        at them out of a row in one go """
+    highs = tuple(pixel_positions(bit_positions(SYNC_SIGNAL_LOCATIONS_HIGH, offset, pitch), width))
+    lows = tuple(pixel_positions(bit_positions(SYNC_SIGNAL_LOCATIONS_LOW, offset, pitch), width))
+    return highs, lows, operator.itemgetter(*highs), operator.itemgetter(*lows)
+
+
+@memoize
+def search_preamble_positions(offset, pitch_sixteenths, width):
+    """ preamble_positions, for the whole pixel offsets of a search. Pitch is in 1/16ths of a pixel, so a tracked
+        pitch can't grow the cache without bound """
+    return preamble_positions(offset, pitch_sixteenths / 16, width)
+
+
+@memoize
+def preamble_search_order(offset, scan_range):
+    """ The offsets of scan_range (i.e. PREAMBLE_SCAN_RANGE), nearest the passed whole pixel offset first """
+    return tuple(sorted(scan_range, key=lambda o: abs(o - offset)))
 
 
 def is_cc_present(image, row_number=1):
-    """ Looks for the sine CC timing signal at the start of a row """
+    """ Looks for the sine CC timing signal at the start of a row. While it is found where we last saw it, follow
+        any drift in its phase and pitch, so we stay locked onto it """
     def pixel(im, x, y):
         return im.get_pixel_luma(x, y)
 
-    def scan_preamble(img, row_num, h_offset, tthreshold):
-        for loc in SYNC_SIGNAL_LOCATIONS_HIGH:
-            if pixel(img, loc + h_offset, row_num) < tthreshold:
+    def scan_preamble(img, row_num, positions, tthreshold):
+        highs, lows, get_highs, get_lows = positions
+        if row is not None:
+            return min(get_highs(row)) >= tthreshold and max(get_lows(row)) <= tthreshold
+        for loc in highs:
+            if pixel(img, loc, row_num) < tthreshold:
                 return False
-        for loc in SYNC_SIGNAL_LOCATIONS_LOW:
-            if pixel(img, loc + h_offset, row_num) > tthreshold:
+        for loc in lows:
+            if pixel(img, loc, row_num) > tthreshold:
                 return False
         return True
 
-    global lastPreambleOffset
-    if scan_preamble(image, row_number, lastPreambleOffset, LUMA_THRESHOLD):
-        return True  # Optimisation - assume preamble doesn't drift
+    global lastPreambleOffset, trackedPreamble
+    row = luma_row(image, row_number)
+    tracking = (lastPreambleOffset, lastBitPitch, image.width)
+    if trackedPreamble[0] != tracking:  # Only changes once a frame, when locked
+        trackedPreamble = (tracking, preamble_positions(*tracking))
+    if scan_preamble(image, row_number, trackedPreamble[1], LUMA_THRESHOLD):
+        track_bit_clock(image, row_number)
+        return True
 
-    for offset in PREAMBLE_SCAN_RANGE:
-        if scan_preamble(image, row_number, offset, LUMA_THRESHOLD):
+    # Lost it - the nearest offsets to where it was are the most likely, so try those first
+    pitch_sixteenths = int(round(lastBitPitch * 16))
+    for offset in preamble_search_order(int(round(lastPreambleOffset)), PREAMBLE_SCAN_RANGE):
+        if scan_preamble(image, row_number, search_preamble_positions(offset, pitch_sixteenths, image.width),
+                         LUMA_THRESHOLD):
             lastPreambleOffset = offset
-            ## Found a match - but let's optimize - scan forwards until we break
-            for tweak in range(12):
-                if not scan_preamble(image, row_number, offset + tweak, LUMA_THRESHOLD):
-                    ## Found a negative match, take the middle of the range between the start and end of the match
-                    lastPreambleOffset = int(offset + (0.5 * tweak))
-                    break
+            for _ in range(4):  # Pull in to the centre of the run-in peaks, before reading this frame
+                track_bit_clock(image, row_number)
             return True
     return False
 
@@ -518,44 +861,180 @@ def is_end_code(code):
     return 'End of Caption (flip memory)' in code or 'Erase Displayed Memory' in code
 
 
+def reset_row_lock():
+    """ Forget the row and bit clock captions were last found at, and the decodeStats, i.e. before decoding an
+        unrelated video """
+    global lastPreambleOffset, lastBitPitch, lastRowFound, rowSearchInterval, framesUntilRowSearch, lastCaptionBytes
+    global lastParityErrors, lastControlRepeated
+    lastPreambleOffset = 0
+    lastBitPitch = BIT_PITCH
+    lastRowFound = 0
+    rowSearchInterval = 1
+    framesUntilRowSearch = 0
+    lastCaptionBytes = (None, None)
+    lastParityErrors = (False, False)
+    lastControlRepeated = False
+    decodeStats.reset()
+    controlRepeats.reset()
+
+
+@contextlib.contextmanager
+def exclusive_decode(name):
+    """ Reset the decode state (see reset_row_lock) and hold it for one decode. The row lock, decodeStats and the
+        rest are module globals, so only one decode may run in a process at a time - starting another while one is
+        running (i.e. a lazy iterator that hasn't been exhausted or closed) raises RuntimeError rather than have
+        them corrupt each other
+         name - what is being decoded, for the error """
+    global decodeOwner
+    with decodeOwnerLock:
+        if decodeOwner is not None:
+            raise RuntimeError('Can not decode %s while %s is still being decoded, only one decode may run in a '
+                               'process at a time - finish or close() the other first' % (name, decodeOwner))
+        decodeOwner = name
+    try:
+        reset_row_lock()
+        yield
+    finally:
+        decodeOwner = None
+
+
+def iter_exclusive(name, iterator):
+    """ Generator of the items of a lazy decode, holding the decode state (see exclusive_decode) from the first
+        item until it is exhausted or closed """
+    with exclusive_decode(name):
+        yield from iterator
+
+
 def find_and_decode_row(img, fixed_line=None):
-    """ Search for a closed caption row in the passed image, if one is present decode and return the bytes present """
-    global lastRowFound
+    """ Search for a closed caption row in the passed image, if one is present decode and return the bytes present.
+        Searching every row is expensive, so while captions are absent (adverts, credits, leader) it is done
+        progressively less often, up to every ROW_SEARCH_MAX_INTERVAL frames - in between only the last row
+        captions were found on is checked. Each byte's parity is checked, see strip_parity """
+    global lastRowFound, lastBitPitch, rowSearchInterval, framesUntilRowSearch, lastParityErrors
+    lastParityErrors = (False, False)
     if lastRowFound >= img.height:
         lastRowFound = 0  # Protect against streams suddenly losing a few rows
     row_target = fixed_line or lastRowFound
     if not(is_cc_present(img, row_number=row_target) or fixed_line is not None):
+        if framesUntilRowSearch > 0:
+            framesUntilRowSearch -= 1
+            return None, None
         for row in range(0, img.height-1):
             if is_cc_present(img, row_number=row):
                 lastRowFound = row
-                return decode_row(img, row_number=lastRowFound)
+                rowSearchInterval = 1
+                return strip_parity(*decode_row(img, row_number=lastRowFound, offset=lastPreambleOffset,
+                                                pitch=lastBitPitch, parity=True))
+        lastBitPitch = BIT_PITCH  # Lost it everywhere, look for it afresh at the nominal pitch
+        framesUntilRowSearch = rowSearchInterval - 1
+        rowSearchInterval = min(rowSearchInterval * 2, ROW_SEARCH_MAX_INTERVAL)
         return None, None
     else:
-        return decode_row(img, row_number=row_target)
-
-
-def extract_closed_caption_bytes(img, fixed_line=None):
-    """ Returns a tuple of byte values from the passed image object that supports get_pixel_luma """
-    byte1, byte2 = find_and_decode_row(img, fixed_line)
+        framesUntilRowSearch = 0
+        rowSearchInterval = 1
+        return strip_parity(*decode_row(img, row_number=row_target, offset=lastPreambleOffset, pitch=lastBitPitch,
+                                        parity=True))
+
+
+PULLDOWN_CYCLE = 5  # 3:2 pulldown repeats one frame in every five
+
+
+def skip_pulldown_repeats(image_list, fixed_line=None, lock_cycles=3):
+    """ Pass the images through, swapping frames that are pulldown duplicates of the frame before for RepeatedFrames,
+        so their captions aren't read - or acted on - twice, decoders see padding for them. Frame numbers (and so
+        caption timings) are unchanged. A frame is taken to be a duplicate when its caption row is byte for byte the same as the frame
+        before's, that frame had captions on that row, and frames at the same point of the last lock_cycles
+        pulldown cycles were duplicates too - the cadence. Repeats off the cadence (control codes are sent twice)
+        are read as usual. Only images with get_row are checked
+         image_list  - list (or generator) of image objects, as for the decode_ functions
+         fixed_line  - the row captions are on, as for the decode_ functions, otherwise the row they were last
+                       found on
+         lock_cycles - cycles the cadence must hold for before frames are skipped """
+    repeats = [0] * PULLDOWN_CYCLE  # Consecutive cycles with a duplicate at each point in the cycle
+    previous = (None, None)  # Row number and row of the frame before
+    for frame, image in enumerate(image_list):
+        row_number = lastRowFound if fixed_line is None else fixed_line
+        row = luma_row(image, row_number)
+        phase = frame % PULLDOWN_CYCLE
+        if row is not None and previous == (row_number, row) and lastCaptionBytes[0] is not None:
+            repeats[phase] += 1
+        else:
+            repeats[phase] = 0
+        previous = (row_number, row and bytes(row))
+        if repeats[phase] > lock_cycles:
+            image.unlink()
+            yield RepeatedFrame()
+        else:
+            yield image
+
+
+def correct_parity_errors(byte1, byte2, errors):
+    """ What a receiver makes of a pair with parity errors (errors says which bytes). A character that fails is
+        shown as a solid block (0x7f). Control codes, XDS and padding that fail are dropped - padding (0, 0) is
+        returned - as the copy of a control code sent in the next frame will do instead """
+    if byte1 < 0x20:
+        return 0, 0
+    return 0x7f if errors[0] else byte1, 0x7f if errors[1] else byte2
+
+
+PARITY_ERROR_NOTES = {(False, False): '', (True, False): ' (parity error byte 1)',
+                      (False, True): ' (parity error byte 2)', (True, True): ' (parity error both bytes)'}
+DROPPED_PAIR = ('', False, 0, 0)  # What extract_closed_caption_bytes returns for a dropped pair, the same as padding
+
+
+def extract_closed_caption_bytes(img, fixed_line=None, drop_repeats=True):
+    """ Returns a tuple of the code, whether it is a control code and the byte values from the passed image object
+        that supports get_pixel_luma. Bytes failing parity are corrected (see correct_parity_errors) and noted in
+        lastParityErrors, and whether the pair repeats the control code before it in lastControlRepeated. A pulldown
+        repeat (RepeatedFrame) is always padding
+         drop_repeats - return repeats of a control code (see RepeatedControlFilter) as padding, so they needn't be
+                        looked up or acted on """
+    global lastCaptionBytes, lastParityErrors, lastControlRepeated
+    if isinstance(img, RepeatedFrame):
+        # Locked on if the frame repeated was, but its bytes were counted with it
+        decodeStats.update(*lastCaptionBytes, repeat=True, duplicate=True)
+        lastParityErrors, lastControlRepeated = (False, False), False
+        return DROPPED_PAIR
+    if isinstance(img, DecodedFrame):
+        byte1, byte2 = img.caption_bytes  # Already read, and counted
+        lastParityErrors = (False, False)
+    else:
+        byte1, byte2 = find_and_decode_row(img, fixed_line)
+        if lastParityErrors[0] or lastParityErrors[1]:
+            byte1, byte2 = correct_parity_errors(byte1, byte2, lastParityErrors)
+        lastCaptionBytes = byte1, byte2
+    duplicate = byte1 is not None and controlRepeats.is_repeat(byte1, byte2)
+    lastControlRepeated = duplicate
+    if not isinstance(img, DecodedFrame):
+        decodeStats.update(byte1, byte2, duplicate=duplicate, parity_error=lastParityErrors[0] or lastParityErrors[1])
     if byte1 is None and byte2 is None:
         return None, False, None, None
+    elif duplicate and drop_repeats:
+        return DROPPED_PAIR
     else:
         code = decode_byte_pair(byte1, byte2)
         control = (byte1, byte2) in ALL_CC_CONTROL_CODES
         return code, control, byte1, byte2
 
 
-def decode_captions_raw(image_list, fixed_line=None, merge_text=False, delete_image_after=True, ccfilter=None):
+def decode_captions_raw(image_list, fixed_line=None, merge_text=False, delete_image_after=True, ccfilter=None,
+                        checkpoint=None, first_frame=0, preroll=0):
     """ Raw output, show the frame caption codes and frame numbers
          image_list         - list (or generator) of image objects with a get_pixel_luma method
          merge_text         - merge runs of text together and display in a block
          delete_image_after - delete passed images after they've been processed
          fixed_line         - check a particular line for cc-signal (and no others)
-         ccfilter           - ignored """
-    buff = ''  # CC Buffer
-    frame = 0
+         ccfilter           - ignored
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, only read to lock on to the
+                              caption row """
+    saved = checkpoint.restore('raw') if checkpoint else {}
+    image_list = warm_up(image_list, preroll, fixed_line, delete_image_after)
+    buff = saved.get('buff', '')  # CC Buffer
+    frame = saved.get('frame', first_frame + preroll)
     for image in image_list:
-        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line)
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line, drop_repeats=False)
         if code is None:
             print('%i skip - no preamble' % frame)
         else:
@@ -572,27 +1051,39 @@ def decode_captions_raw(image_list, fixed_line=None, merge_text=False, delete_im
         frame += 1
         if delete_image_after:
             image.unlink()
+        if checkpoint and checkpoint.due(frame):
+            checkpoint.save('raw', frame, buff=buff)
 
 
-def decode_captions_debug(image_list, fixed_line=None, delete_image_after=True, ccfilter=None):
+def decode_captions_debug(image_list, fixed_line=None, delete_image_after=True, ccfilter=None, checkpoint=None,
+                          first_frame=0, preroll=0):
     """ Debug output, show the frame caption codes and frame numbers
          image_list         - list (or generator) of image objects with a get_pixel_luma method
          delete_image_after - delete passed images after they've been processed
          fixed_line         - check a particular line for cc-signal (and no others)
          ccfilter           - ignored
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from. Only codes
+                              decoded since the checkpoint are returned
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, only read to lock on to the
+                              caption row
          """
-    frame = 0
+    image_list = warm_up(image_list, preroll, fixed_line, delete_image_after)
+    frame = checkpoint.restore('debug').get('frame', 0) if checkpoint else first_frame + preroll
     codes = []
     for image in image_list:
-        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line)
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line, drop_repeats=False)
         if code is None:
             print('%i skip - no preamble' % frame)
         else:
-            print('%i (%i,%i) - bytes: 0x%02x 0x%02x : %s' % (frame, lastPreambleOffset, lastRowFound, b1, b2, code))
+            print('%i (%i,%i) - bytes: 0x%02x 0x%02x : %s%s' % (frame, lastPreambleOffset, lastRowFound, b1, b2, code,
+                                                                 PARITY_ERROR_NOTES[lastParityErrors]))
             codes.append([b1, b2])
         frame += 1
         if delete_image_after:
             image.unlink()
+        if checkpoint and checkpoint.due(frame):
+            checkpoint.save('debug', frame)
     return codes
 
 
@@ -613,114 +1104,707 @@ def dump_srt_caption(caption_text, start_frame, end_frame, fps, subtitle_count=N
     print('%s --> %s\n%s\n' % (timestamp(start_frame, fps), timestamp(end_frame, fps), caption_text))
 
 
-def decode_image_list_to_srt_roll(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True, ccfilter=None):
-    """ Decode a passed list of images to a stream of SRT subtitles. Assumes Roll-up format closed captions
-         image_list         - list of image file paths
-         frames_per_second  - how many fps is the passed list of images
-         delete_image_after - delete the image file after we have done processing it
-         fixed_line         - check a particular line for cc-signal (and no others)
-         ccfilter           - ignored for now
-    """
-    buffer = ['', '', '', '']
-    buffer_len = 4
-    frame = 0
-    subtitle_start_frame = 0
-    subtitle_count = 1
+CaptionEvent = collections.namedtuple('CaptionEvent', 'frame channel mode changed lines')
+CaptionEvent.__doc__ = """ The displayed captions on a caption channel changed
+     frame   - frame number the change happened on
+     channel - 'CC1' or 'CC2'
+     mode    - caption mode, POP_ON, ROLL_UP or PAINT_ON
+     changed - (row, column, text) for each displayed row that changed, text is '' for a row that was cleared
+     lines   - (row, column, text) for every row now displayed. Rows and columns count from 0 at the top left """
+
+
+def _blank_memory():
+    return [[''] * SCREEN_COLUMNS for _ in range(SCREEN_ROWS)]
+
+
+def _row_text(cells):
+    """ Returns (column, text) for a row of caption memory, where column is that of the first character """
+    text = ''.join(cell or ' ' for cell in cells).rstrip()
+    stripped = text.lstrip()
+    return len(text) - len(stripped), stripped
+
+
+class CaptionScreen(object):
+    """ EIA-608 caption memory for a single caption channel. Holds the displayed and non-displayed memories of
+        15 rows of 32 columns and the cursor, and applies characters and control codes to them following the pop-on,
+        roll-up and paint-on rules. Tracks which displayed rows have changed, so only those need to be rendered """
+
+    def __init__(self):
+        self.displayed = _blank_memory()
+        self.non_displayed = _blank_memory()
+        self.mode = None  # Nothing is captioned until a control code selects a mode
+        self.roll_rows = 0
+        self.row = SCREEN_ROWS - 1
+        self.column = 0
+        self.dirty = set()  # Displayed rows changed since the last call to changes()
+        self.shown = [(0, '')] * SCREEN_ROWS  # What we last reported each displayed row contains
+
+    def _memory(self):
+        """ The memory characters are written to, pop-on captions are built off screen """
+        return self.non_displayed if self.mode == POP_ON else self.displayed
+
+    def _touch(self, memory, row):
+        if memory is self.displayed:
+            self.dirty.add(row)
+
+    def write(self, text):
+        """ Write characters at the cursor """
+        if self.mode is None or self.mode == TEXT_MODE:
+            return
+        memory = self._memory()
+        cells = memory[self.row]
+        for char in text:
+            cells[self.column] = char
+            self.column = min(self.column + 1, SCREEN_COLUMNS - 1)
+        self._touch(memory, self.row)
+
+    def backspace(self):
+        if self.mode is None or self.mode == TEXT_MODE:
+            return
+        self.column = max(self.column - 1, 0)
+        memory = self._memory()
+        memory[self.row][self.column] = ''
+        self._touch(memory, self.row)
+
+    def delete_to_end_of_row(self):
+        memory = self._memory()
+        memory[self.row][self.column:] = [''] * (SCREEN_COLUMNS - self.column)
+        self._touch(memory, self.row)
+
+    def erase(self, memory):
+        for row, cells in enumerate(memory):
+            if any(cells):
+                memory[row] = [''] * SCREEN_COLUMNS
+                self._touch(memory, row)
+
+    def end_of_caption(self):
+        """ Flip the displayed and non-displayed memories """
+        self.displayed, self.non_displayed = self.non_displayed, self.displayed
+        self.dirty.update(range(SCREEN_ROWS))
+        self.mode = POP_ON
+
+    def roll_up(self, rows):
+        if self.mode != ROLL_UP:
+            self.erase(self.displayed)
+            self.erase(self.non_displayed)
+            self.row = SCREEN_ROWS - 1
+            self.column = 0
+        self.mode = ROLL_UP
+        self.roll_rows = rows
+        self.row = max(self.row, rows - 1)
+        for row in range(0, self.row - rows + 1):  # Anything above the window goes
+            if any(self.displayed[row]):
+                self.displayed[row] = [''] * SCREEN_COLUMNS
+                self.dirty.add(row)
+
+    def carriage_return(self):
+        """ Roll the roll-up window up a row """
+        if self.mode != ROLL_UP:
+            return
+        top = max(self.row - self.roll_rows + 1, 0)
+        self.displayed[top:self.row] = self.displayed[top + 1:self.row + 1]
+        self.displayed[self.row] = [''] * SCREEN_COLUMNS
+        self.dirty.update(range(top, self.row + 1))
+        self.column = 0
+
+    def preamble(self, row, b2):
+        """ Preamble address code - move the cursor to the start of a row, and possibly indent """
+        attribute = b2 & 0x1f
+        if self.mode == ROLL_UP:
+            row = max(row, self.roll_rows - 1)
+            if row != self.row:  # Move the roll-up window, keeping its contents
+                top = max(self.row - self.roll_rows + 1, 0)
+                window = self.displayed[top:self.row + 1]
+                self.erase(self.displayed)
+                self.displayed[row - len(window) + 1:row + 1] = window
+                self.dirty.update(range(row - len(window) + 1, row + 1))
+        self.row = row
+        self.column = (attribute & 0x0e) * 2 if attribute & 0x10 else 0
+
+    def command(self, b2):
+        """ Miscellaneous control codes """
+        if b2 == 0x20:  # Resume caption loading
+            self.mode = POP_ON
+        elif b2 == 0x21:
+            self.backspace()
+        elif b2 == 0x24:
+            self.delete_to_end_of_row()
+        elif 0x25 <= b2 <= 0x27:
+            self.roll_up(b2 - 0x23)
+        elif b2 == 0x29:  # Resume direct captioning
+            self.mode = PAINT_ON
+        elif b2 == 0x2a or b2 == 0x2b:  # Text restart, resume text display. Text service rather than captions
+            self.mode = TEXT_MODE
+        elif b2 == 0x2c:
+            self.erase(self.displayed)
+        elif b2 == 0x2d:
+            self.carriage_return()
+        elif b2 == 0x2e:
+            self.erase(self.non_displayed)
+        elif b2 == 0x2f:
+            self.end_of_caption()
+
+    def control(self, b1, b2):
+        """ Apply a control code, b1 is normalized to the channel 1 range 0x10-0x17 """
+        if b2 >= 0x40:
+            row = PAC_ROWS.get((b1, b2 >= 0x60))
+            if row is not None:
+                self.preamble(row, b2)
+        elif b2 < 0x20:
+            return  # Not a valid control code
+        elif b1 == 0x14 or b1 == 0x15:  # 0x15 for field two
+            self.command(b2)
+        elif b1 == 0x17 and 0x21 <= b2 <= 0x23:  # Tab offset
+            self.column = min(self.column + b2 - 0x20, SCREEN_COLUMNS - 1)
+        elif b1 == 0x11:
+            self.write(' ' if b2 < 0x30 else SPECIAL_CHARS_TABLE.get(b2, ''))  # Mid-row codes occupy a space
+        elif b1 == 0x12:
+            self.backspace()  # Extended characters replace the standard character sent before them
+            self.write(EXTENDED_SPANISH_FRENCH.get(b2, ''))
+        elif b1 == 0x13:
+            self.backspace()
+            self.write(EXTENDED_PORTUGUESE_GERMAN_DANISH.get(b2, ''))
+        # Background and foreground attributes don't change the text
+
+    def changes(self):
+        """ Returns (changed, lines) for the displayed memory since the last call, see CaptionEvent """
+        changed = []
+        for row in sorted(self.dirty):
+            rendered = _row_text(self.displayed[row])
+            if rendered != self.shown[row]:
+                self.shown[row] = rendered
+                changed.append((row,) + rendered)
+        self.dirty.clear()
+        lines = tuple((row,) + shown for row, shown in enumerate(self.shown) if shown[1])
+        return tuple(changed), lines
+
+    def get_state(self):
+        """ Return the screen state as something JSON serializable """
+        return {'displayed': self.displayed, 'non_displayed': self.non_displayed, 'mode': self.mode,
+                'roll_rows': self.roll_rows, 'row': self.row, 'column': self.column, 'dirty': sorted(self.dirty),
+                'shown': self.shown}
+
+    def set_state(self, state):
+        """ Restore state previously returned by get_state """
+        self.displayed = state['displayed']
+        self.non_displayed = state['non_displayed']
+        self.mode = state['mode']
+        self.roll_rows = state['roll_rows']
+        self.row = state['row']
+        self.column = state['column']
+        self.dirty = set(state['dirty'])
+        self.shown = [tuple(shown) for shown in state['shown']]
+
+
+class CaptionEngine(object):
+    """ Feeds byte pairs to a CaptionScreen per caption channel, returning a CaptionEvent whenever the captions
+        displayed on a channel change. Control codes carry their channel, characters belong to the channel of the
+        last control code
+         channels - caption channels to decode, 1 for CC1 and 2 for CC2 (default both) """
+
+    def __init__(self, channels=(1, 2)):
+        self.screens = {channel: CaptionScreen() for channel in channels}
+        self.channel = 1
+        self.in_xds = False
+        self.pending = {}  # channel -> frame that characters were first painted directly on screen, not yet reported
+
+    def feed(self, b1, b2, frame):
+        """ Process a byte pair from the passed frame, returns a list of CaptionEvents. The second copy of each control
+            code must already have been dropped, as extract_closed_caption_bytes does """
+        if 0x10 <= b1 <= 0x1f:
+            self.in_xds = False
+            self.channel = 2 if b1 & 0x08 else 1
+            screen = self.screens.get(self.channel)
+            if screen is None:
+                return []
+            events = self._pending_events(self.channel, screen)
+            screen.control(b1 & 0x17, b2)
+            return events + self._events(frame, self.channel, screen)
+        if 0x01 <= b1 <= 0x0f:
+            self.in_xds = True  # XDS data on field two, until the next caption control code
+        elif b1 >= 0x20 and not self.in_xds:
+            screen = self.screens.get(self.channel)
+            if screen is not None:
+                screen.write(CC_TABLE.get(b1, '') + CC_TABLE.get(b2, ''))
+                if screen.dirty and self.channel not in self.pending:
+                    self.pending[self.channel] = frame  # Roll-up or paint-on, report when the next code arrives
+        return []
+
+    def _pending_events(self, channel, screen):
+        """ Report characters painted on screen since the last control code, as of when they were painted """
+        if channel in self.pending:
+            return self._events(self.pending.pop(channel), channel, screen)
+        return []
+
+    def _events(self, frame, channel, screen):
+        changed, lines = screen.changes()
+        if changed:
+            return [CaptionEvent(frame, CC_FILTER_TO_TXT[channel], screen.mode, changed, lines)]
+        return []
+
+    def flush(self, frame):
+        """ Report any changes not yet reported, i.e. characters painted on since the last control code """
+        events = []
+        for channel, screen in sorted(self.screens.items()):
+            events.extend(self._pending_events(channel, screen))
+            events.extend(self._events(frame, channel, screen))
+        return events
+
+    def get_state(self):
+        """ Return the engine state as something JSON serializable """
+        return {'screens': [[channel, screen.get_state()] for channel, screen in self.screens.items()],
+                'channel': self.channel, 'in_xds': self.in_xds,
+                'pending': [[channel, frame] for channel, frame in self.pending.items()]}
+
+    def set_state(self, state):
+        """ Restore state previously returned by get_state """
+        for channel, screen_state in state['screens']:
+            self.screens[channel].set_state(screen_state)
+        self.channel = state['channel']
+        self.in_xds = state['in_xds']
+        self.pending = {channel: frame for channel, frame in state['pending']}
+
+
+def caption_channels(ccfilter):
+    """ Caption channels to decode for a ccfilter value. Only line 21 of the first field is read, so CC3 and CC4 -
+        the same codes as CC1 and CC2, but on the second field - can't be """
+    if ccfilter and ccfilter not in DECODED_CHANNELS:
+        raise ValueError('Can not decode caption channel %s, only CC1 and CC2 (on the first field) are decoded'
+                         % CC_FILTER_TO_TXT.get(ccfilter, ccfilter))
+    if ccfilter:
+        return ccfilter,
+    return DECODED_CHANNELS
+
+
+def caption_text(lines):
+    """ The text of the rows of a CaptionEvent, one line per row """
+    return '\n'.join(text for _, _, text in lines)
+
+
+class CaptionWriter(object):
+    """ Base for writers of CaptionEvents, see decode_caption_events """
+
+    def __init__(self, frames_per_second=29.97):
+        self.frames_per_second = frames_per_second
+
+    def start(self):
+        """ Start of the output, not called when resuming from a checkpoint """
+        pass
+
+    def write(self, event):
+        raise NotImplementedError('write must be overridden')
+
+    def finish(self, frame):
+        """ End of the video at the passed frame """
+        pass
+
+    def get_state(self):
+        """ Return the writer state as something JSON serializable """
+        return {}
+
+    def set_state(self, state):
+        """ Restore state previously returned by get_state """
+        pass
+
+
+class SrtCaptionWriter(CaptionWriter):
+    """ Writes a subtitle each time the displayed captions change, lasting until the next change """
+
+    def __init__(self, frames_per_second=29.97):
+        super(SrtCaptionWriter, self).__init__(frames_per_second)
+        self.subtitle_count = 1
+        self.showing = {}  # channel -> [start frame, text, lines]
+
+    def write(self, event):
+        text = caption_text(event.lines)
+        showing = self.showing.get(event.channel)
+        if showing and showing[1] == text:
+            return
+        if showing and showing[1]:
+            self._dump(event.channel, showing, event.frame)
+        self.showing[event.channel] = [event.frame, text, event.lines]
+
+    def _dump(self, channel, showing, end_frame):
+        dump_srt_caption(showing[1], showing[0], end_frame, self.frames_per_second, self.subtitle_count)
+        self.subtitle_count += 1
+
+    def finish(self, frame):
+        """ End of the video, close any captions still showing """
+        for channel, showing in sorted(self.showing.items()):
+            if showing[1]:
+                self._dump(channel, showing, frame)
+        self.showing = {}
+
+    def get_state(self):
+        return {'subtitle_count': self.subtitle_count, 'showing': self.showing}
+
+    def set_state(self, state):
+        self.subtitle_count = state['subtitle_count']
+        self.showing = state['showing']
+
+
+class WebVttCaptionWriter(SrtCaptionWriter):
+    """ Writes a WebVTT cue each time the displayed captions change, positioned at the row and column of the first
+        caption row. The caption area is the middle 80% of the screen, as for broadcast captions """
+
+    def start(self):
+        print('WEBVTT\n', flush=True)
+
+    def _dump(self, channel, showing, end_frame):
+        start_frame, text, lines = showing
+        row, column = lines[0][0], min(column for _, column, _ in lines)
+        print('%i\n%s --> %s line:%.2f%% position:%.2f%% align:start\n%s\n'
+              % (self.subtitle_count, timestamp(start_frame, self.frames_per_second).replace(',', '.'),
+                 timestamp(end_frame, self.frames_per_second).replace(',', '.'),
+                 10 + row * 80.0 / SCREEN_ROWS, 10 + column * 80.0 / SCREEN_COLUMNS, text), flush=True)
+        self.subtitle_count += 1
+
+
+class JsonLinesCaptionWriter(CaptionWriter):
+    """ Writes each CaptionEvent as a line of JSON, as it happens. Rows count from 1 at the top, columns from 0 """
+
+    def __init__(self, frames_per_second=29.97):
+        import json
+        super(JsonLinesCaptionWriter, self).__init__(frames_per_second)
+        self.encode = json.JSONEncoder(ensure_ascii=False).encode
+
+    def write(self, event):
+        def rows(row_list):
+            return [{'row': row + 1, 'column': column, 'text': text} for row, column, text in row_list]
+        print(self.encode({'frame': event.frame, 'time': round(event.frame / self.frames_per_second, 3),
+                          'channel': event.channel, 'mode': event.mode, 'changed': rows(event.changed),
+                          'lines': rows(event.lines)}), flush=True)
+
+
+class DiffCaptionWriter(CaptionWriter):
+    """ Writes only the displayed rows that change, as they change """
+
+    def write(self, event):
+        for row, column, text in event.changed:
+            print('%s %s row %02d col %02d: %s' % (timestamp(event.frame, self.frames_per_second), event.channel,
+                                                  row + 1, column, text))
+
+
+class PrerollWriter(CaptionWriter):
+    """ Passes CaptionEvents on to writer from frame output_from, holding back those before it. Whatever is showing
+        at output_from is passed on as appearing then, so a decode of part of a video doesn't miss the captions
+        already on screen as it starts """
+
+    def __init__(self, writer, output_from):
+        super(PrerollWriter, self).__init__(writer.frames_per_second)
+        self.writer = writer
+        self.output_from = output_from
+        self.held = {}  # channel -> the last event before output_from
+
+    def write(self, event):
+        if event.frame < self.output_from:
+            self.held[event.channel] = event
+            return
+        self.release()
+        self.writer.write(event)
+
+    def release(self):
+        """ Pass on the captions showing at output_from """
+        for channel, event in sorted(self.held.items()):
+            if event.lines:
+                self.writer.write(event._replace(frame=self.output_from, changed=event.lines))
+        self.held = {}
+
+    def finish(self, frame):
+        self.release()
+        self.writer.finish(max(frame, self.output_from))
+
+
+Caption = collections.namedtuple('Caption', 'index start_frame end_frame start_time end_time channel text lines')
+Caption.__doc__ = """ A caption, as displayed on screen from start_frame up to end_frame
+     index       - running count of captions, from 1
+     start_time  - start_frame in seconds
+     end_time    - end_frame in seconds
+     channel     - 'CC1' or 'CC2'
+     text        - caption text, one line per row
+     lines       - (row, column, text) for each row, as for CaptionEvent """
+
+CaptionBytes = collections.namedtuple('CaptionBytes', 'frame byte1 byte2 code control parity_error')
+CaptionBytes.__doc__ = """ The closed caption byte pair read from a frame, code is its description. parity_error is
+    True if either byte failed its parity check - a character that did is a solid block, a control code is dropped
+    (as padding) """
+
+
+class CaptionCollector(SrtCaptionWriter):
+    """ Collects Captions, rather than writing them out, for iter_captions """
+
+    def __init__(self, frames_per_second=29.97):
+        super(CaptionCollector, self).__init__(frames_per_second)
+        self.items = collections.deque()
+
+    def _dump(self, channel, showing, end_frame):
+        start_frame, text, lines = showing
+        self.items.append(Caption(self.subtitle_count, start_frame, end_frame, start_frame / self.frames_per_second,
+                                  end_frame / self.frames_per_second, channel, text,
+                                  tuple(tuple(line) for line in lines)))
+        self.subtitle_count += 1
+
+
+class CaptionEventCollector(CaptionWriter):
+    """ Collects CaptionEvents, for iter_caption_events """
+
+    def __init__(self, frames_per_second=29.97):
+        super(CaptionEventCollector, self).__init__(frames_per_second)
+        self.items = collections.deque()
+
+    def write(self, event):
+        self.items.append(event)
+
+
+def _drive_caption_engine(image_list, engine, writer, frame=0, fixed_line=None, delete_image_after=True):
+    """ Feed the passed images through engine, passing the CaptionEvents to writer. Yields the number of frames
+        processed after each image, so the caller can work between frames """
     for image in image_list:
-        code, control, _, _ = extract_closed_caption_bytes(image, fixed_line=fixed_line)
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line=fixed_line)
         if code is not None:
-        # PROCESS:
-            if not control:
-                buffer[0] += code  # Assumed to be text
-            elif control and code != prevcode:
-                if code in ROLL_UP_LEN:
-                    subtitle_start_frame = frame
-                    if buffer_len != ROLL_UP_LEN[code]:
-                        buffer_len = ROLL_UP_LEN[code]
-                        buffer = [''] * buffer_len
-                    else:  #Probably the start of a comamnd sequence
-                        pass
-                elif code.endswith('Erase Displayed Memory'):
-                    dump_srt_caption('\n'.join(reversed(buffer)), subtitle_start_frame, frame, frames_per_second, subtitle_count)
-                    subtitle_count += 1
-                    subtitle_start_frame = frame
-                    buffer = [''] * buffer_len
-                elif code.endswith('Carriage Return'):
-                    dump_srt_caption('\n'.join(reversed(buffer)), subtitle_start_frame, frame, frames_per_second, subtitle_count)
-                    subtitle_start_frame = frame
-                    subtitle_count += 1
-                    # Roll-up subs
-                    if buffer_len >= 4:
-                        buffer[3] = buffer[2]
-                    if buffer_len >= 3:
-                        buffer[2] = buffer[1]
-                    buffer[1] = buffer[0]
-                    buffer[0] = ''
-
-        prevcode = code
+            for event in engine.feed(b1, b2, frame):
+                writer.write(event)
         frame += 1
         if delete_image_after:
             image.unlink()
+        yield frame
+    for event in engine.flush(frame):
+        writer.write(event)
+    writer.finish(frame)
 
-def match_code_filter(code, txt_to_match, cc_filter):
-    if txt_to_match in code:
-        if cc_filter:
-            return CC_FILTER_TO_TXT[cc_filter] in code
-        return True
 
-def decode_image_list_to_srt(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True, ccfilter=None):
-    """ Decode a passed list of images to a stream of SRT subtitles. Assumes Pop-on format closed captions
-         image_list         - list of image file paths
+def decode_caption_events(name, image_list, writer, fixed_line=None, delete_image_after=True, ccfilter=None,
+                          checkpoint=None, first_frame=0, preroll=0):
+    """ Run the passed images through a CaptionEngine, passing each CaptionEvent to writer
+         name               - decoder name, recorded with checkpoints
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
+         writer             - a CaptionWriter
+         fixed_line         - check a particular line for cc-signal (and no others)
+         delete_image_after - delete the image file after we have done processing it
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. They are decoded so captions already
+                              loaded or showing as the part starts are picked up, but nothing is written for them """
+    saved = checkpoint.restore(name) if checkpoint else {}
+    engine = CaptionEngine(caption_channels(ccfilter))
+    if saved:
+        engine.set_state(saved['engine'])
+        writer.set_state(saved['writer'])
+    else:
+        writer.start()
+    if preroll:
+        writer = PrerollWriter(writer, first_frame + preroll)
+    for frame in _drive_caption_engine(image_list, engine, writer, saved.get('frame', first_frame), fixed_line,
+                                       delete_image_after):
+        if checkpoint and checkpoint.due(frame):
+            checkpoint.save(name, frame, engine=engine.get_state(), writer=writer.get_state())
+
+
+def _iter_collected(image_list, collector, fixed_line, delete_image_after, ccfilter, first_frame=0, preroll=0):
+    """ Yield what collector collects from the passed images, as it collects it """
+    engine = CaptionEngine(caption_channels(ccfilter))
+    writer = PrerollWriter(collector, first_frame + preroll) if preroll else collector
+    for _ in _drive_caption_engine(image_list, engine, writer, first_frame, fixed_line, delete_image_after):
+        while collector.items:
+            yield collector.items.popleft()
+    while collector.items:
+        yield collector.items.popleft()
+
+
+def iter_captions(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True, ccfilter=None,
+                  first_frame=0, preroll=0):
+    """ Returns a generator of Captions decoded from the passed images, each yielded once it has left the screen
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
          frames_per_second  - how many fps is the passed list of images
          delete_image_after - delete the image file after we have done processing it
          fixed_line         - check a particular line for cc-signal (and no others)
-         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions"""
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, see decode_caption_events"""
+    return _iter_collected(image_list, CaptionCollector(frames_per_second), fixed_line, delete_image_after, ccfilter,
+                           first_frame, preroll)
 
-    offscreen_buffer = ''
-    onscreen_buffer = ''
-    prevcode = None
-    frame = 0
-    subtitle_start_frame = 0
-    subtitle_count = 1
-    accumulate = False  # Do not start collecting captions until we see RCL
 
-    for image in image_list:
-        code, control, _, _ = extract_closed_caption_bytes(image, fixed_line=fixed_line)
+def iter_caption_events(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True, ccfilter=None,
+                        first_frame=0, preroll=0):
+    """ Returns a generator of CaptionEvents decoded from the passed images, as the displayed captions change
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
+         frames_per_second  - how many fps is the passed list of images
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, see decode_caption_events"""
+    return _iter_collected(image_list, CaptionEventCollector(frames_per_second), fixed_line, delete_image_after,
+                           ccfilter, first_frame, preroll)
+
+
+def iter_caption_bytes(image_list, fixed_line=None, delete_image_after=True, ccfilter=None, first_frame=0, preroll=0):
+    """ Returns a generator of CaptionBytes, one for each of the passed images that carries closed captions
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - ignored
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, only read to lock on to the
+                              caption row """
+    image_list = warm_up(image_list, preroll, fixed_line, delete_image_after)
+    for frame, image in enumerate(image_list, first_frame + preroll):
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line, drop_repeats=False)
+        if delete_image_after:
+            image.unlink()
         if code is not None:
-            # PROCESS
-            if not control and accumulate:
-                offscreen_buffer += code  # Must be text
-            elif control and code != prevcode:
-                if 'Resume Caption Loading' in code:
-                    if match_code_filter(code, 'Resume Caption Loading', ccfilter):
-                        accumulate = True  # Start collection captions, as we match ccfilter
-                    else:
-                        accumulate = False  # We are interleaving with another caption stream
-                elif match_code_filter(code, 'End of Caption', ccfilter):
-                    onscreen_buffer = offscreen_buffer
-                    offscreen_buffer = ''
-                    subtitle_start_frame = frame
-                    accumulate = False
-                elif accumulate and onscreen_buffer and match_code_filter(code, 'Erase Displayed Memory', ccfilter):
-                    dump_srt_caption(onscreen_buffer, subtitle_start_frame, frame, frames_per_second, subtitle_count)
-                    subtitle_count += 1
-                    onscreen_buffer = ''
-                elif accumulate and offscreen_buffer and offscreen_buffer[-1:] != '\n':
-                    offscreen_buffer += '\n'  # Some random command code. Assume it's just a newline
-        # CLEANUP
-        prevcode = code
-        frame += 1
+            yield CaptionBytes(frame, b1, b2, code, control, lastParityErrors[0] or lastParityErrors[1])
+
+
+class CaptionChannelTracker(object):
+    """ Follows which caption channel byte pairs belong to, as CaptionEngine does. Control codes carry their channel,
+        characters belong to the channel of the last control code and XDS data to no channel, until the next control
+        code """
+
+    def __init__(self):
+        self.channel = 1
+        self.in_xds = False
+
+    def channel_of(self, b1, b2):
+        """ The channel, 1 for CC1 or 2 for CC2, of the passed pair. None for padding and XDS """
+        if 0x10 <= b1 <= 0x1f:
+            self.in_xds = False
+            self.channel = 2 if b1 & 0x08 else 1
+            return self.channel
+        if 0x01 <= b1 <= 0x0f:
+            self.in_xds = True
+        elif b1 >= 0x20 and not self.in_xds:
+            return self.channel
+        return None
+
+
+def demux_caption_channels(image_list, fixed_line=None, delete_image_after=True):
+    """ Read the closed caption bytes of each of the passed images once, splitting them between caption channels.
+        Returns the (byte1, byte2, channel) of each frame - None, None, None where no captions were found - and the
+        channels that control codes were seen for. See channel_frames to decode a channel
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others) """
+    tracker = CaptionChannelTracker()
+    frames = []
+    channels = set()
+    for image in image_list:
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line, drop_repeats=False)
+        if code is None:
+            frames.append((None, None, None))
+        else:
+            channel = tracker.channel_of(b1, b2)
+            if channel and 0x10 <= b1 <= 0x1f:
+                channels.add(channel)
+            frames.append((b1, b2, channel))
         if delete_image_after:
             image.unlink()
+    return frames, sorted(channels)
+
+
+def channel_frames(frames, channel):
+    """ DecodedFrames of one caption channel from demux_caption_channels frames, for any of the decode_ functions.
+        Other channels' bytes (and XDS) become padding, so frame numbers, and so timings, are unchanged """
+    controlRepeats.reset()  # Each channel's repeated control codes are dropped afresh
+    for b1, b2, frame_channel in frames:
+        if b1 is None:
+            yield DecodedFrame(None, None)
+        elif frame_channel == channel:
+            yield DecodedFrame(b1, b2)
+        else:
+            yield DecodedFrame(0, 0)
 
 
-def decode_captions_to_scc(image_list, fixed_line=None, delete_image_after=True, ccfilter=None):
+def match_code_filter(code, txt_to_match, cc_filter):
+    if txt_to_match in code:
+        if cc_filter:
+            return CC_FILTER_TO_TXT[cc_filter] in code
+        return True
+
+
+def decode_image_list_to_srt(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True, ccfilter=None,
+                             checkpoint=None, first_frame=0, preroll=0):
+    """ Decode a passed list of images to a stream of SRT subtitles. Pop-on, roll-up and paint-on captions are all
+        handled, a subtitle is written for each change of the displayed captions
+         image_list         - list of image file paths
+         frames_per_second  - how many fps is the passed list of images
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. They are decoded so captions already
+                              loaded or showing as the part starts are picked up, but nothing is written for them"""
+    decode_caption_events('srt', image_list, SrtCaptionWriter(frames_per_second), fixed_line=fixed_line,
+                          delete_image_after=delete_image_after, ccfilter=ccfilter, checkpoint=checkpoint,
+                          first_frame=first_frame, preroll=preroll)
+
+
+def decode_captions_to_webvtt(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True,
+                              ccfilter=None, checkpoint=None, first_frame=0, preroll=0):
+    """ Decode a passed list of images to a stream of WebVTT cues, positioned where the captions were on screen
+         image_list         - list of image file paths
+         frames_per_second  - how many fps is the passed list of images
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. They are decoded so captions already
+                              loaded or showing as the part starts are picked up, but nothing is written for them"""
+    decode_caption_events('webvtt', image_list, WebVttCaptionWriter(frames_per_second), fixed_line=fixed_line,
+                          delete_image_after=delete_image_after, ccfilter=ccfilter, checkpoint=checkpoint,
+                          first_frame=first_frame, preroll=preroll)
+
+
+def decode_captions_to_json_lines(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True,
+                                  ccfilter=None, checkpoint=None, first_frame=0, preroll=0):
+    """ Decode a passed list of images to a stream of JSON objects, one line per change of the displayed captions
+         image_list         - list of image file paths
+         frames_per_second  - how many fps is the passed list of images
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. They are decoded so captions already
+                              loaded or showing as the part starts are picked up, but nothing is written for them"""
+    decode_caption_events('jsonl', image_list, JsonLinesCaptionWriter(frames_per_second), fixed_line=fixed_line,
+                          delete_image_after=delete_image_after, ccfilter=ccfilter, checkpoint=checkpoint,
+                          first_frame=first_frame, preroll=preroll)
+
+
+def decode_captions_to_diff(image_list, fixed_line=None, frames_per_second=29.97, delete_image_after=True,
+                            ccfilter=None, checkpoint=None, first_frame=0, preroll=0):
+    """ Decode a passed list of images, showing only the displayed caption rows that change as they change
+         image_list         - list of image file paths
+         frames_per_second  - how many fps is the passed list of images
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - filter for a particular caption stream CC[1], CC[2] - None or 0 means all captions
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. They are decoded so captions already
+                              loaded or showing as the part starts are picked up, but nothing is written for them"""
+    decode_caption_events('diff', image_list, DiffCaptionWriter(frames_per_second), fixed_line=fixed_line,
+                          delete_image_after=delete_image_after, ccfilter=ccfilter, checkpoint=checkpoint,
+                          first_frame=first_frame, preroll=preroll)
+
+
+def decode_captions_to_scc(image_list, fixed_line=None, delete_image_after=True, ccfilter=None, checkpoint=None,
+                           first_frame=0, preroll=0):
     """ Decode a passed list of images to a stream of SCC subtitles. Assumes Pop-on format closed captions.
         Assumes 29.97 frames per second drop time-code
          image_list         - list of image file paths
          delete_image_after - delete the image file after we have done processing it
          fixed_line         - check a particular line for cc-signal (and no others)
-         ccfilter           - ignored"""
+         ccfilter           - ignored
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted. Only captions completed after
+                              them are written, including any that started loading during the preroll"""
 
     def drop_frame_time_code(frames):
         frame_number = frames + 18 * (frames / 17982) + 2 * max(((frames % 17982) - 2) / 1798, 0)
@@ -733,25 +1817,38 @@ def decode_captions_to_scc(image_list, fixed_line=None, delete_image_after=True,
     def dump_scc_subtitle(starting_frame, buffer):
         print('%s\t%s' % (drop_frame_time_code(starting_frame), buffer))
 
-    frame = 0
-    start_frame = 0
-    print('Scenarist_SCC V1.0\n')
-    buff = ''
-    prevcode = None
+    saved = checkpoint.restore('scc') if checkpoint else {}
+    frame = saved.get('frame', first_frame)
+    start_frame = saved.get('start_frame', 0)
+    output_from = first_frame + preroll
+    if not saved:
+        print('Scenarist_SCC V1.0\n')  # Resumed output already has a header
+    buff = saved.get('buff', '')
+    end_pending = saved.get('end_pending', False)  # The last pair was an end code, the sequence ends on its copy
     for image in image_list:
-        code, control, byte1, byte2 = extract_closed_caption_bytes(image, fixed_line=fixed_line)
-        if code is not None:
-            if code is not None and not buff:
-                start_frame = frame  # Start of a sequence (not empty and no buffer yet)
-            if code is not None or buff:
-                buff += '%x%x ' % (NO_PARITY_TO_ODD_PARITY[byte1], NO_PARITY_TO_ODD_PARITY[byte2])
-            if control and is_end_code(code) and code == prevcode:
+        code, control, byte1, byte2 = extract_closed_caption_bytes(image, fixed_line=fixed_line, drop_repeats=False)
+        if end_pending and not lastControlRepeated:  # Its copy was lost, or was a pulldown repeat
+            if frame - 1 >= output_from:
                 dump_scc_subtitle(start_frame, buff)
+            buff = ''
+        end_pending = False
+        if code is not None and not (lastControlRepeated and not buff):  # Not a third copy, after the sequence
+            if not buff:
+                start_frame = frame  # Start of a sequence (not empty and no buffer yet)
+            buff += '%x%x ' % (NO_PARITY_TO_ODD_PARITY[byte1], NO_PARITY_TO_ODD_PARITY[byte2])
+            if control and is_end_code(code) and lastControlRepeated:  # Sent twice, the sequence ends on the copy
+                if frame >= output_from:
+                    dump_scc_subtitle(start_frame, buff)
                 buff = ''
+            elif control and is_end_code(code):
+                end_pending = True
         frame += 1
-        prevcode = code
         if delete_image_after:
             image.unlink()
+        if checkpoint and checkpoint.due(frame):
+            checkpoint.save('scc', frame, start_frame=start_frame, buff=buff, end_pending=end_pending)
+    if end_pending and frame - 1 >= output_from:
+        dump_scc_subtitle(start_frame, buff)
 
 
 def compute_xds_packet_checksum(packet_bytes):
@@ -765,6 +1862,11 @@ def compute_xds_packet_checksum(packet_bytes):
     return False
 
 
+def _next_pair(pbytes):
+    """ Remove and return the first byte pair of an XDS packet buffer, in constant time when it is a deque """
+    return pbytes.popleft() if isinstance(pbytes, collections.deque) else pbytes.pop(0)
+
+
 def _assert_len(xds_inputbytes, minimum):
     """ Asserts that there are least minimum bytes in the passed xds input bytes buffer """
     if len(xds_inputbytes) * 2 < minimum:
@@ -775,7 +1877,7 @@ def decode_xds_string(pbytes):
     """ Return a string from a series of packet bytes """
     xds_string = ''
     while pbytes:
-        strbyte1, strbyte2 = pbytes.pop(0)
+        strbyte1, strbyte2 = _next_pair(pbytes)
         if strbyte1 == 0x0f:
             break
         xds_string += decode_byte_pair(strbyte1, strbyte2)
@@ -785,7 +1887,7 @@ def decode_xds_string(pbytes):
 def decode_xds_minutes_hours(pbytes, short=False):
     """ Pull minutes, then hours from a packet """
     _assert_len(pbytes, 2)
-    minb, hourb = pbytes.pop(0)
+    minb, hourb = _next_pair(pbytes)
     return minb & 63, hourb & 31 if short else hourb & 63
 
 
@@ -809,7 +1911,7 @@ def decode_xds_time_of_day(packet_bytes):
 def decode_xds_content_advisory(pbytes):
     """ Decode content advisory packet, returning a string describing the rating """
     _assert_len(pbytes, 2)
-    ca1, ca2 = pbytes.pop(0)
+    ca1, ca2 = _next_pair(pbytes)
     system = ca1 & 24 >> 3
     rating = ''
     if system == 0 or system == 2:  # MPA
@@ -836,17 +1938,17 @@ def decode_xds_content_advisory(pbytes):
 
 
 def describe_xds_packet(packet_bytes):
-    """ Given a set of bytes representing an XDS packet, describe it """
+    """ Given a set of bytes representing an XDS packet, describe it. The checksum is not checked here, that is done
+        when the packet is reassembled by XdsPacketAssembler """
     if packet_bytes:
-        #if not compute_xds_packet_checksum(packet_bytes):
-        #    return 'XDS Rejected Packet - Incorrect Checksum'
-        b1, b2 = packet_bytes.pop(0)
+        packet_bytes = collections.deque(packet_bytes)
+        b1, b2 = packet_bytes.popleft()
         if b1 <= 0x02 and b2 <= 0x03:  # TODO continues
             pref = ['Current', 'Next Program'][b1-1]
             if b2 == 0x01:  # Program identification number
                 _assert_len(packet_bytes, 4)
                 minutes, hours = decode_xds_minutes_hours(packet_bytes, short=True)
-                dateb, monthb = packet_bytes.pop(0)
+                dateb, monthb = packet_bytes.popleft()
                 tape_delay = '(Tape Delayed)' if (monthb & 16) else ''
                 return ('XDS %s Scheduled Start Time: %02i:%02i on Day %02i of Month %02i %s'
                         % (pref, hours, minutes, dateb & 31, monthb & 15, tape_delay))
@@ -858,7 +1960,7 @@ def describe_xds_packet(packet_bytes):
                     minutes, hours = decode_xds_minutes_hours(packet_bytes)
                     seconds = 0
                     if packet_bytes:
-                        seconds = packet_bytes.pop(0)[0] & 63
+                        seconds = packet_bytes.popleft()[0] & 63
                     msg += ' XDS %s Elapsed time: %02i:%02i:%02i' % (pref, hours, minutes, seconds)
                 return msg
             elif b2 == 0x03:  # Program Name
@@ -868,7 +1970,7 @@ def describe_xds_packet(packet_bytes):
             if b2 == 0x04:  # Program Type
                 program_genre = ''
                 while packet_bytes:
-                    n1, n2 = packet_bytes.pop(0)
+                    n1, n2 = packet_bytes.popleft()
                     if n1 == 0x0f:
                         break
                     program_genre += '%s %s ' % (XDS_GENRE_CODES.get(n1, ''), XDS_GENRE_CODES.get(n2, ''))
@@ -876,7 +1978,7 @@ def describe_xds_packet(packet_bytes):
             elif b2 == 0x05:  # Content advisory - Vchip !
                 return decode_xds_content_advisory(packet_bytes)
             elif b2 == 0x06:  # Audio services
-                main, sap = packet_bytes.pop(0)
+                main, sap = packet_bytes.popleft()
                 main_language = XDS_AUDIO_SERVICES_LANGUAGE[main & 56 >> 3]
                 main_type = XDS_AUDIO_SERVICES_TYPE_MAIN[main & 7]
                 sap_language = XDS_AUDIO_SERVICES_LANGUAGE[sap & 56 >> 3]
@@ -886,16 +1988,16 @@ def describe_xds_packet(packet_bytes):
                 return 'XDS Caption Services'  # TODO
             elif b2 == 0x08:  # CGMS
                 _assert_len(packet_bytes, 2)
-                c1, _ = packet_bytes.pop(0)
+                c1, _ = packet_bytes.popleft()
                 copying = XDS_CGMS[c1 & 24 >> 3]
                 protection = XDS_CGMS_APS[c1 & 7]
                 return 'XDS Copy protection: %s %s' % (copying, protection)
             elif b2 == 0x09:  # Aspect ratio
                 _assert_len(packet_bytes, 2)
-                startl, endl = packet_bytes.pop(0)
+                startl, endl = packet_bytes.popleft()
                 anamorp = False
                 if packet_bytes:
-                    anamorp, _ = packet_bytes.pop(0)
+                    anamorp, _ = packet_bytes.popleft()
                 return 'XDS Aspect Ratio: start line: %i end line: %i %s' \
                        % (22 + (startl & 63), 262 - (endl & 63), (anamorp & 1) and 'Anamorphic')
             elif b2 == 0x0c:  # Composite packet
@@ -930,27 +2032,145 @@ def describe_xds_packet(packet_bytes):
     return 'XDS - Empty Packet'
 
 
-def decode_xds_packets(image_list, fixed_line=None, delete_image_after=True, ccfilter=None):
+XdsPacket = collections.namedtuple('XdsPacket', 'frame xds_class xds_type payload valid description')
+XdsPacket.__doc__ = """ A reassembled XDS packet
+     frame       - frame number the packet was completed on
+     xds_class   - class name i.e. 'Current', 'Channel'
+     xds_type    - type code within the class
+     payload     - the informational characters, as bytes
+     valid       - the checksum was correct
+     description - human readable description of the packet """
+
+
+class XdsPacketAssembler(object):
+    """ Reassembles XDS packets from a stream of byte pairs. Packets of different classes/types may be interleaved
+        with each other (a packet is suspended when another starts, and picked up again by its continue code) and with
+        caption data (caption control codes suspend the current packet). Completed packets have their checksum
+        verified, and by default a packet identical to the last one of the same class/type is suppressed, since XDS
+        repeats the same information constantly
+         dedup          - suppress repeats of unchanged packets
+         reject_invalid - drop packets with an incorrect checksum rather than returning them with valid=False """
+
+    def __init__(self, dedup=True, reject_invalid=True):
+        self.dedup = dedup
+        self.reject_invalid = reject_invalid
+        self.partial = {}  # (start code, type) -> byte pairs received so far, starting with the start pair
+        self.current = None  # Key of the packet receiving informational characters, if any
+        self.last_packet = {}  # (start code, type) -> the last complete packet
+        self.rejected = 0
+        self.repeats = 0
+
+    def push(self, b1, b2, frame=None):
+        """ Add a byte pair, returns an XdsPacket if this completes one (that isn't a suppressed repeat), else None """
+        if b1 == 0 and b2 == 0:
+            return None  # Padding
+        if b1 <= 0x0e:
+            if b1 & 1:  # Start of a packet, any earlier incomplete packet of the same class/type is abandoned
+                self.current = (b1, b2)
+                self.partial[self.current] = [(b1, b2)]
+            else:  # Continue code, not included in the checksum
+                self.current = (b1 - 1, b2) if (b1 - 1, b2) in self.partial else None
+            return None
+        if b1 == 0x0f:
+            return self._end_packet(b1, b2, frame) if self.current else None
+        if b1 <= 0x1f:
+            self.current = None  # Caption control code, we are back to captions until we see a continue code
+        elif self.current:
+            packet = self.partial[self.current]
+            packet.append((b1, b2))
+            if len(packet) >= XDS_MAX_PACKET_PAIRS:
+                del self.partial[self.current]  # Runaway packet - we must have missed the end
+                self.current = None
+                self.rejected += 1
+        return None
+
+    def _end_packet(self, b1, b2, frame):
+        key = self.current
+        packet = self.partial.pop(key)
+        packet.append((b1, b2))
+        self.current = None
+        valid = compute_xds_packet_checksum(packet)
+        if not valid:
+            self.rejected += 1
+            if self.reject_invalid:
+                return None
+        elif self.dedup and self.last_packet.get(key) == packet:
+            self.repeats += 1
+            return None
+        if valid:
+            self.last_packet[key] = packet
+        payload = bytes(b for pair in packet[1:-1] for b in pair)
+        try:
+            description = describe_xds_packet(packet)
+        except (RuntimeWarning, IndexError, KeyError):
+            description = 'XDS Malformed packet %02x %02x' % key
+        return XdsPacket(frame, XDS_CLASSES[key[0]], key[1], payload, valid, description)
+
+    def get_state(self):
+        """ Return the assembler state as something JSON serializable """
+        return {'partial': [[list(key), packet] for key, packet in self.partial.items()],
+                'current': self.current and list(self.current),
+                'last_packet': [[list(key), packet] for key, packet in self.last_packet.items()],
+                'rejected': self.rejected, 'repeats': self.repeats}
+
+    def set_state(self, state):
+        """ Restore state previously returned by get_state """
+        self.partial = {tuple(key): [tuple(pair) for pair in packet] for key, packet in state['partial']}
+        self.current = state['current'] and tuple(state['current'])
+        self.last_packet = {tuple(key): [tuple(pair) for pair in packet] for key, packet in state['last_packet']}
+        self.rejected = state['rejected']
+        self.repeats = state['repeats']
+
+
+def iter_xds_packets(image_list, fixed_line=None, delete_image_after=True, ccfilter=None, dedup=True, first_frame=0,
+                     preroll=0):
+    """ Returns a generator of the XdsPackets decoded from a passed list of images
+         image_list         - list (or generator) of image objects with a get_pixel_luma method
+         delete_image_after - delete the image file after we have done processing it
+         fixed_line         - check a particular line for cc-signal (and no others)
+         ccfilter           - ignored
+         dedup              - only return packets which differ from the last packet of the same class/type
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, only read to lock on to the
+                              caption row """
+    assembler = XdsPacketAssembler(dedup=dedup)
+    image_list = warm_up(image_list, preroll, fixed_line, delete_image_after)
+    for frame, image in enumerate(image_list, first_frame + preroll + 1):
+        code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line)
+        if delete_image_after:
+            image.unlink()
+        if code is not None:
+            packet = assembler.push(b1, b2, frame)
+            if packet:
+                yield packet
+
+
+def decode_xds_packets(image_list, fixed_line=None, delete_image_after=True, ccfilter=None, checkpoint=None,
+                       dedup=True, first_frame=0, preroll=0):
     """ Decode a passed list of images to a stream of XDS packets.
          image_list         - list of image file paths
          delete_image_after - delete the image file after we have done processing it
          fixed_line         - check a particular line for cc-signal (and no others)
-         ccfilter           - ignored """
-    frame = 0
-    packetbuf = []
-    gather_xds_bytes = False
+         ccfilter           - ignored
+         checkpoint         - optional DecodeCheckpoint to periodically save state to, and resume from
+         dedup              - only show packets which differ from the last packet of the same class/type
+         first_frame        - frame number of the first image, when decoding part of a video
+         preroll            - how many of the images come before the part wanted, only read to lock on to the
+                              caption row """
+    saved = checkpoint.restore('xds') if checkpoint else {}
+    image_list = warm_up(image_list, preroll, fixed_line, delete_image_after)
+    frame = saved.get('frame', first_frame + preroll)
+    assembler = XdsPacketAssembler(dedup=dedup)
+    if saved:
+        assembler.set_state(saved['assembler'])
     for image in image_list:
         frame += 1
         code, control, b1, b2 = extract_closed_caption_bytes(image, fixed_line)
         if code is not None:
-            if not (b1 == 0 and b2 == 0):  # Stuffing, ignore and continue
-                if b1 <= 0x0e:  # Start of XDS packet'
-                    gather_xds_bytes = True
-                if gather_xds_bytes:
-                    packetbuf.append((b1, b2))
-                if b1 == 0x0f:  # End of XDS packet
-                    gather_xds_bytes = False
-                    print(describe_xds_packet(packetbuf))
-                    packetbuf = []
+            packet = assembler.push(b1, b2, frame)
+            if packet:
+                print(packet.description)
         if delete_image_after:
             image.unlink()
+        if checkpoint and checkpoint.due(frame):
+            checkpoint.save('xds', frame, assembler=assembler.get_state())
@@ -0,0 +1,706 @@
+#!/usr/local/bin/python
+# coding: utf-8
+"""
+Frame sources for ccDecoder - the plumbing that gets frames from a producer (typically ffmpeg) to the decoders
+in lib.cc_decode. Only the standard library is used.
+
+Public domain / Unlicense
+But attribution is always appreciated where possible.
+"""
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+import collections
+import io
+import mmap
+import os
+import select
+import signal
+import sys
+import time
+from lib.cc_decode import BaseImageWrapper
+# ctypes, glob, json, subprocess and concurrent.futures are imported where they are used. Together they take longer
+# to import than a short clip takes to decode, and most runs only need some of them
+
+# inotify event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Studio swing (16-235) luma expanded to full range (0-255), which is what LUMA_THRESHOLD is calibrated against
+STUDIO_TO_FULL_RANGE = tuple(min(255, max(0, int(round((y - 16) * 255 / 219.0)))) for y in range(256))
+FULL_RANGE = tuple(range(256))
+STUDIO_TO_FULL_RANGE_BYTES = bytes(STUDIO_TO_FULL_RANGE)  # For bytes.translate
+
+# Bytes of chroma per frame for each YUV4MPEG2 colour space, given width and height
+Y4M_CHROMA_BYTES = {
+    '420jpeg': lambda w, h: ((w + 1) // 2) * ((h + 1) // 2) * 2,
+    '420paldv': lambda w, h: ((w + 1) // 2) * ((h + 1) // 2) * 2,
+    '420mpeg2': lambda w, h: ((w + 1) // 2) * ((h + 1) // 2) * 2,
+    '420': lambda w, h: ((w + 1) // 2) * ((h + 1) // 2) * 2,
+    '411': lambda w, h: ((w + 3) // 4) * h * 2,
+    '422': lambda w, h: ((w + 1) // 2) * h * 2,
+    '444': lambda w, h: w * h * 2,
+    '444alpha': lambda w, h: w * h * 3,
+    'mono': lambda w, h: 0,
+}
+
+
+class DirectoryWatcher(object):
+    """ Wait for files to appear in a directory. Uses inotify where available so we wake as soon as a file lands,
+        otherwise falls back to polling at a short interval
+         path          - directory to watch
+         poll_interval - how long to sleep between checks when notifications are not available
+         events        - inotify events to wake for, add IN_MODIFY to wake as files grow """
+
+    def __init__(self, path, poll_interval=0.02, events=IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.fd = None
+        if sys.platform.startswith('linux'):
+            self.fd = self._inotify_watch(path, events)
+
+    @staticmethod
+    def _inotify_watch(path, events):
+        """ Returns an inotify file descriptor watching path, or None if inotify isn't usable """
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(path), events) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    @property
+    def notifying(self):
+        return self.fd is not None
+
+    def wait(self, timeout=0.25):
+        """ Block until something changes in the directory, or timeout seconds pass """
+        if self.fd is None:
+            time.sleep(min(self.poll_interval, timeout))
+            return
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):  # Drain, we only care that something happened
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FollowedFile(io.RawIOBase):
+    """ A recording that is still being written, read as a stream. Reads wait for more to be written rather than
+        ending, until nothing has been written for idle_seconds - the recording has closed. Given a glob pattern
+        rather than a file name, follows a rotating set of segment files, read one after another in name order. A
+        segment is finished with once it has been read to the end and a later one exists
+         path          - the recording, or a glob pattern matching its segments
+         idle_seconds  - seconds without anything new before the recording is taken to have finished
+         poll_interval - longest wait between checks for more """
+
+    def __init__(self, path, idle_seconds=60, poll_interval=0.5):
+        import glob
+        super(FollowedFile, self).__init__()
+        self.path = path
+        self.segmented = glob.escape(path) != path
+        self.idle_seconds = idle_seconds
+        self.poll_interval = poll_interval
+        self.current = None
+        self.current_path = None
+        self.last_data = time.monotonic()
+        self.watcher = DirectoryWatcher(os.path.dirname(path) or os.curdir, poll_interval=poll_interval,
+                                        events=IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+
+    def readable(self):
+        return True
+
+    def _next_path(self):
+        """ The file to read after the current one, None if there isn't one (yet) """
+        if not self.segmented:
+            return self.path if self.current is None and os.path.exists(self.path) else None
+        import glob
+        later = sorted(name for name in glob.glob(self.path) if self.current_path is None or name > self.current_path)
+        return later[0] if later else None
+
+    def readinto(self, buffer):
+        while not self.closed:
+            if self.current is not None:
+                count = self.current.readinto(buffer)
+                if count:
+                    self.last_data = time.monotonic()
+                    return count
+            next_path = self._next_path()  # At the end of what has been written so far - moved on to a new segment?
+            if next_path:
+                if self.current is not None:
+                    self.current.close()
+                self.current = open(next_path, 'rb', buffering=0)
+                self.current_path = next_path
+                continue
+            if time.monotonic() - self.last_data >= self.idle_seconds:
+                break  # Recording finished
+            self.watcher.wait(self.poll_interval)
+        return 0
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        self.watcher.close()
+        super(FollowedFile, self).close()
+
+
+def pump(source, sink, chunk_size=65536):
+    """ Copy source to sink until source ends (or sink is closed by its reader), then close sink. i.e. to feed a
+        FollowedFile to ffmpeg's stdin, on a thread """
+    try:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            sink.write(data)
+            sink.flush()
+    except (OSError, ValueError):
+        pass  # ffmpeg exited, or we are cleaning up
+    finally:
+        try:
+            sink.close()
+        except OSError:
+            pass
+
+
+class BacklogThrottle(object):
+    """ Pause a producer process (e.g. ffmpeg) while too many of the frames it has written are waiting to be consumed,
+        and resume it once the consumer has worked the backlog down to half the limit. Frames are files named by a
+        sequential frame number, so the backlog can be measured with a single stat rather than a directory listing.
+         process    - subprocess.Popen of the producer
+         file_name  - function returning the file name of a given frame number
+         max_frames - maximum number of unconsumed frames on disk
+         max_bytes  - maximum number of unconsumed bytes on disk, 0 or None means no byte limit """
+
+    def __init__(self, process, file_name, max_frames=300, max_bytes=None):
+        self.process = process
+        self.file_name = file_name
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.limit = max(2, max_frames)
+        self.frame_bytes = 0
+        self.paused = False
+        self.enabled = hasattr(signal, 'SIGSTOP') and bool(max_frames or max_bytes)
+
+    def _update_limit(self, next_frame):
+        """ Once we know how big a frame is, turn the byte limit into a frame count """
+        if self.max_bytes and not self.frame_bytes:
+            self.frame_bytes = os.path.getsize(self.file_name(next_frame))
+            by_size = max(2, self.max_bytes // max(self.frame_bytes, 1))
+            self.limit = min(self.limit, by_size) if self.max_frames else by_size
+
+    def update(self, next_frame):
+        """ Called as each frame is consumed, next_frame is the number of the next frame the consumer wants """
+        if not self.enabled or self.process.poll() is not None:
+            return
+        self._update_limit(next_frame)
+        if not self.paused and os.path.exists(self.file_name(next_frame + self.limit)):
+            self.process.send_signal(signal.SIGSTOP)
+            self.paused = True
+        elif self.paused and not os.path.exists(self.file_name(next_frame + max(1, self.limit // 2))):
+            self.resume()
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            if self.process.poll() is None:
+                self.process.send_signal(signal.SIGCONT)
+
+
+class FfmpegProfile(collections.namedtuple('FfmpegProfile', 'stream threads skip_other_streams input_args '
+                                                             'filter_args output_args')):
+    """ How ffmpeg is run to turn a video into frames
+         stream             - index of the video stream to decode, amongst the video streams (default 0, the first)
+         threads            - decoder threads, None leaves it to ffmpeg (typically one per core). Use 1 when running
+                              several decodes at once, so they don't fight over cores
+         skip_other_streams - don't decode audio, subtitle or data streams (-an -sn -dn)
+         input_args         - extra arguments for the input, before -i (i.e. decoder options, probe sizes)
+         filter_args        - extra filters, applied after our own
+         output_args        - extra arguments for the output """
+    __slots__ = ()
+
+    def __new__(cls, stream=0, threads=None, skip_other_streams=True, input_args=(), filter_args=(), output_args=()):
+        return super(FfmpegProfile, cls).__new__(cls, stream, threads, skip_other_streams, tuple(input_args),
+                                                 tuple(filter_args), tuple(output_args))
+
+    def argv(self, ffmpeg_path, input_file, output_file, video_filter, seek=None, pix_fmt='rgb24',
+             output_format='image2', frames=None):
+        """ The ffmpeg command line, as a list of arguments - no shell is involved, so paths need no quoting
+             video_filter - our own filters i.e. the crop to the caption lines
+             seek         - position to start from, in seconds
+             frames       - stop after this many frames, None for the whole video """
+        argv = [ffmpeg_path, '-nostdin', '-hide_banner', '-loglevel', 'error']
+        if self.threads is not None:
+            argv += ['-threads', str(self.threads)]
+        argv += list(self.input_args)
+        if seek:
+            argv += ['-ss', '%.6f' % seek]
+        argv += ['-i', input_file, '-map', '0:v:%d' % self.stream]
+        if self.skip_other_streams:
+            argv += ['-an', '-sn', '-dn']
+        argv += ['-vf', ','.join((video_filter,) + self.filter_args), '-pix_fmt', pix_fmt]
+        if frames is not None:
+            argv += ['-frames:v', str(frames)]
+        return argv + list(self.output_args) + ['-f', output_format, output_file]
+
+
+# Profiles for common sources
+FFMPEG_PRESETS = {
+    'default': FfmpegProfile(),
+    'dvd': FfmpegProfile(input_args=('-fflags', '+discardcorrupt')),
+    # Broadcast transport streams - probe further to find every program's video, drop corrupt packets
+    'ts': FfmpegProfile(input_args=('-fflags', '+discardcorrupt', '-analyzeduration', '10M', '-probesize', '10M')),
+    # Skipping the deblocking filter roughly halves H.264 decode time, the 27 pixel wide bits survive it fine
+    'h264': FfmpegProfile(input_args=('-skip_loop_filter', 'all')),
+}
+
+
+def ffmpeg_profile(profile=None, **overrides):
+    """ Returns an FfmpegProfile from a preset name (or a profile), with any of its fields overridden. Overrides of
+        None are ignored """
+    if profile is None or isinstance(profile, str):
+        if profile and profile not in FFMPEG_PRESETS:
+            raise RuntimeError('Unknown ffmpeg preset %s, try one of %s' % (profile, sorted(FFMPEG_PRESETS)))
+        profile = FFMPEG_PRESETS[profile or 'default']
+    return profile._replace(**{name: value for name, value in overrides.items() if value is not None})
+
+
+def prefetch(items, loader, depth=4, workers=None):
+    """ Yield loader(item) for each of the passed items, strictly in order, while up to depth items ahead of the
+        consumer are loaded on a thread pool. Image decoding libraries (i.e. Pillow) release the GIL while reading
+        and decoding, so disk and decode work overlaps with the caption decoding done on the consuming thread.
+         items   - iterable of things to load, typically frame file names
+         loader  - function to load an item, typically an image wrapper class
+         depth   - how many items to load ahead, 0 loads on the calling thread as each item is consumed
+         workers - number of loader threads (default depth) """
+    if depth <= 0:
+        for item in items:
+            yield loader(item)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=workers or depth)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(loader, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:  # Consumer stopped early
+            future.cancel()
+        pool.shutdown(wait=True)
+
+
+class LumaImageWrapper(BaseImageWrapper):
+    """ An image backed by a buffer of 8 bit luma samples, one byte per pixel. The buffer is typically a memoryview
+        straight into a memory mapped file, so no copy of the frame is made
+         buffer     - the luma samples, row by row
+         width      - pixels per row
+         height     - number of rows
+         stride     - bytes per row (default width)
+         full_range - luma is 0-255 rather than studio swing 16-235 """
+
+    def __init__(self, buffer, width, height, stride=None, full_range=False):
+        self.image = buffer
+        self.width = width
+        self.height = height
+        self.stride = stride or width
+        self.levels = FULL_RANGE if full_range else STUDIO_TO_FULL_RANGE
+        self.translation = None if full_range else STUDIO_TO_FULL_RANGE_BYTES
+        self.row = (None, None)  # Last row asked for, decoding asks for the same row several times
+
+    def get_pixel_luma(self, x, y):
+        """ Return a pixels luma value normalized to the range 0 (black) to 255 (white) """
+        return self.levels[self.image[int(y) * self.stride + int(x)]]
+
+    def get_row(self, y):
+        """ Return row y as bytes of luma values normalized to the range 0 (black) to 255 (white). A copy rather than a
+            view, so it can't keep the mapping open """
+        if self.row[0] != y:
+            start = int(y) * self.stride
+            row = bytes(self.image[start:start + self.width])
+            self.row = (y, row.translate(self.translation) if self.translation else row)
+        return self.row[1]
+
+    def unlink(self):
+        """ Release the view of the frame, so the underlying mapping can be closed """
+        if isinstance(self.image, memoryview):
+            self.image.release()
+        self.image = None
+        self.row = (None, None)
+
+
+def parse_y4m_header(header):
+    """ Parse a YUV4MPEG2 stream header line, returning width, height and the number of bytes of chroma per frame """
+    tokens = header.decode('ascii').split()
+    if not tokens or tokens[0] != 'YUV4MPEG2':
+        raise RuntimeError('Not a YUV4MPEG2 stream')
+    params = {token[0]: token[1:] for token in tokens[1:]}
+    width, height = int(params['W']), int(params['H'])
+    colour_space = params.get('C', '420jpeg')
+    if colour_space not in Y4M_CHROMA_BYTES:
+        raise RuntimeError('Unsupported YUV4MPEG2 colour space %s (only 8 bit formats are supported)' % colour_space)
+    full_range = 'XCOLORRANGE=FULL' in tokens
+    return width, height, Y4M_CHROMA_BYTES[colour_space](width, height), full_range
+
+
+def _close_mapping(mapping):
+    try:
+        mapping.close()
+    except BufferError:
+        pass  # A consumer still holds a frame, let the mapping go when it does
+
+
+def _read_exactly(stream, buffer):
+    """ Fill buffer from stream, returns False if the stream ends first """
+    view = memoryview(buffer)
+    got = 0
+    while got < len(view):
+        count = stream.readinto(view[got:])
+        if not count:
+            return False
+        got += count
+    return True
+
+
+def _read_stream_frames(stream, frame_header, width, skip_bytes, luma_bytes, rest_bytes, full_range):
+    """ Read frames from a non-seekable stream, keeping only the luma rows we want """
+    scratch = bytearray(max(skip_bytes, rest_bytes, 1))
+    while True:
+        if frame_header and not stream.readline().startswith(b'FRAME'):
+            return
+        luma = bytearray(luma_bytes)
+        if not (_read_exactly(stream, memoryview(scratch)[:skip_bytes]) and _read_exactly(stream, luma) and
+                _read_exactly(stream, memoryview(scratch)[:rest_bytes])):
+            return
+        yield LumaImageWrapper(memoryview(luma), width, luma_bytes // width, full_range=full_range)
+
+
+def read_y4m_frames(source, start_line=0, lines=10, start_frame=0):
+    """ Returns a generator of LumaImageWrapper images, one per frame of a YUV4MPEG2 (.y4m) file or stream. Regular
+        files are memory mapped and each image is a view straight into the mapping
+         source      - file name, '-' for stdin, or a binary file object
+         start_line  - the first row of the frame to pass to the decoder (default 0)
+         lines       - the number of rows to pass to the decoder, counting from the start line (default 10)
+         start_frame - skip this many frames before the first one returned (default 0) """
+    if source == '-':
+        source = sys.stdin.buffer
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header_end = mapping.find(b'\n')
+            width, height, chroma_bytes, full_range = parse_y4m_header(mapping[:header_end])
+            lines = min(lines, height - start_line)
+            frame_bytes = width * height + chroma_bytes
+            position = header_end + 1
+            frame = 0
+            view = memoryview(mapping)
+            while position < len(mapping):
+                data_start = mapping.find(b'\n', position) + 1
+                if not data_start or data_start + frame_bytes > len(mapping):
+                    break  # Truncated final frame
+                if frame >= start_frame:
+                    luma = view[data_start + start_line * width:data_start + (start_line + lines) * width]
+                    yield LumaImageWrapper(luma, width, lines, full_range=full_range)
+                position = data_start + frame_bytes
+                frame += 1
+            view.release()
+        finally:
+            _close_mapping(mapping)
+    else:
+        width, height, chroma_bytes, full_range = parse_y4m_header(source.readline())
+        lines = min(lines, height - start_line)
+        frames = _read_stream_frames(source, True, width, start_line * width, lines * width,
+                                     (height - start_line - lines) * width + chroma_bytes, full_range)
+        for frame, image in enumerate(frames):
+            if frame >= start_frame:
+                yield image
+
+
+def read_raw_luma_frames(source, width, height, start_line=0, lines=10, start_frame=0, frame_bytes=None,
+                         full_range=False):
+    """ Returns a generator of LumaImageWrapper images from a headerless file of raw frames, each starting with a
+        width x height plane of 8 bit luma (i.e. gray or planar yuv). Regular files are memory mapped
+         source      - file name, '-' for stdin, or a binary file object
+         width       - frame width in pixels
+         height      - frame height in pixels
+         start_line  - the first row of the frame to pass to the decoder (default 0)
+         lines       - the number of rows to pass to the decoder, counting from the start line (default 10)
+         start_frame - skip this many frames before the first one returned (default 0)
+         frame_bytes - total bytes per frame including any chroma planes (default width * height, i.e. gray)
+         full_range  - luma is 0-255 rather than studio swing 16-235 """
+    frame_bytes = frame_bytes or width * height
+    lines = min(lines, height - start_line)
+    if source == '-':
+        source = sys.stdin.buffer
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mapping)
+            for position in range(start_frame * frame_bytes, len(mapping) - frame_bytes + 1, frame_bytes):
+                luma = view[position + start_line * width:position + (start_line + lines) * width]
+                yield LumaImageWrapper(luma, width, lines, full_range=full_range)
+            view.release()
+        finally:
+            _close_mapping(mapping)
+    else:
+        frames = _read_stream_frames(source, False, width, start_line * width, lines * width,
+                                     frame_bytes - (start_line + lines) * width, full_range)
+        for frame, image in enumerate(frames):
+            if frame >= start_frame:
+                yield image
+
+
+def ffprobe_path(ffmpeg_path):
+    """ The ffprobe that comes with an ffmpeg - the same name, in the same place """
+    directory, name = os.path.split(ffmpeg_path)
+    return os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+
+
+def probe_video(ffprobe, input_file, stream=0, timeout=30):
+    """ Returns the duration in seconds and the number of frames of a video stream, as ffprobe reports them. Either
+        is None if ffprobe can't tell (or can't be run). Containers that don't record a frame count get one from the
+        duration and frame rate """
+    argv = [ffprobe, '-v', 'error', '-select_streams', 'v:%d' % stream,
+            '-show_entries', 'stream=nb_frames,avg_frame_rate,duration:format=duration', '-of', 'json', input_file]
+    import json
+    import subprocess
+    try:
+        result = subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                timeout=timeout, check=True)
+        info = json.loads(result.stdout.decode('utf-8'))
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None, None
+    video = (info.get('streams') or [{}])[0]
+
+    def number(value):
+        try:
+            numerator, _, denominator = str(value).partition('/')
+            return float(numerator) / float(denominator or 1)
+        except (ValueError, ZeroDivisionError):
+            return None
+
+    duration = number(video.get('duration')) or number(info.get('format', {}).get('duration'))
+    frames = number(video.get('nb_frames'))
+    rate = number(video.get('avg_frame_rate'))
+    if not frames and duration and rate:
+        frames = duration * rate
+    return duration, int(frames) if frames else None
+
+
+def count_y4m_frames(path):
+    """ The number of frames in a YUV4MPEG2 file, from its size. Assumes no per frame parameters """
+    with open(path, 'rb') as f:
+        header = f.readline()
+    width, height, chroma_bytes, _ = parse_y4m_header(header)
+    return (os.path.getsize(path) - len(header)) // (len(b'FRAME\n') + width * height + chroma_bytes)
+
+
+def position_to_frame(position, fps=30000 / 1001):
+    """ The frame number of a position in a video - a frame number, or a timestamp [HH:]MM:SS[.fff] which always has
+        at least one colon. Raises ValueError for anything else """
+    if isinstance(position, int):
+        return position
+    parts = position.strip().split(':')
+    try:
+        if len(parts) == 1:
+            return int(parts[0])
+        if len(parts) <= 3:
+            seconds = 0.0
+            for part in parts:
+                seconds = seconds * 60 + float(part)
+            return int(round(seconds * fps))
+    except ValueError:
+        pass
+    raise ValueError('Not a frame number or [HH:]MM:SS[.fff] timestamp: %s' % position)
+
+
+def _duration(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressMeter(object):
+    """ Reports how a decode is getting on - frames decoded, realtime factor, how much of the video captions were
+        locked onto, captions shown and ETA - as a line on stderr every interval seconds, and/or in a metrics file
+         stats            - a lib.cc_decode.DecodeStats, updated as frames are decoded
+         total_frames     - frames in the video, None if not known (then there is no ETA)
+         fps              - frames per second of the video
+         interval         - seconds between progress lines on stderr, 0 for none
+         metrics_path     - file to keep the metrics in, Prometheus text format if it ends .prom, otherwise JSON.
+                            Replaced (atomically) every metrics_interval seconds
+         name             - what is being decoded, for the report and metrics
+         start_frame      - frame decoding started at, when resuming
+         output           - where progress lines go (default stderr) """
+
+    def __init__(self, stats, total_frames=None, fps=30000 / 1001, interval=10, metrics_path=None, metrics_interval=5,
+                 name='', start_frame=0, output=None):
+        self.stats = stats
+        self.total_frames = total_frames
+        self.fps = fps
+        self.interval = interval
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self.name = name
+        self.start_frame = start_frame
+        self.output = output or sys.stderr
+        self.started = None
+        self.next_report = self.next_metrics = 0
+
+    def metrics(self, done=False):
+        """ The figures reported, as a dict """
+        elapsed = time.monotonic() - self.started
+        frames = self.stats.frames
+        rate = frames / elapsed if elapsed > 0 else 0.0
+        position = self.start_frame + frames
+        metrics = {'input': self.name, 'frames_decoded': position, 'frames_total': self.total_frames,
+                   'elapsed_seconds': round(elapsed, 3), 'realtime_factor': round(rate / self.fps, 3),
+                   'lock_ratio': round(self.stats.locked_frames / frames, 4) if frames else 0.0,
+                   'repeated_frames': self.stats.repeated_frames, 'parity_errors': self.stats.parity_errors,
+                   'captions': self.stats.captions,
+                   'eta_seconds': None, 'done': done}
+        if done:
+            metrics['eta_seconds'] = 0
+        elif self.total_frames and rate:
+            metrics['eta_seconds'] = round(max(0, self.total_frames - position) / rate, 1)
+        return metrics
+
+    def start(self):
+        """ Report the size of the job up front """
+        self.started = time.monotonic()
+        now = self.started
+        self.next_report, self.next_metrics = now + self.interval, now + self.metrics_interval
+        if self.interval:
+            if self.total_frames:
+                print('%s: %d frames, %s' % (self.name, self.total_frames, _duration(self.total_frames / self.fps)),
+                      file=self.output, flush=True)
+            else:
+                print('%s: length unknown' % self.name, file=self.output, flush=True)
+        self.write_metrics()
+
+    def update(self, done=False):
+        """ Report, if it is time to """
+        now = time.monotonic()
+        if self.interval and (done or now >= self.next_report):
+            self.next_report = now + self.interval
+            self.report(done)
+        if self.metrics_path and (done or now >= self.next_metrics):
+            self.next_metrics = now + self.metrics_interval
+            self.write_metrics(done)
+
+    def report(self, done=False):
+        metrics = self.metrics(done)
+        line = 'frame %d' % metrics['frames_decoded']
+        if self.total_frames:
+            line += '/%d (%.1f%%)' % (self.total_frames, 100.0 * metrics['frames_decoded'] / self.total_frames)
+        line += ', %.1fx realtime, locked %.1f%%, %d captions' % (metrics['realtime_factor'],
+                                                                  100 * metrics['lock_ratio'], metrics['captions'])
+        if done:
+            line += ', done in %s' % _duration(metrics['elapsed_seconds'])
+        elif metrics['eta_seconds'] is not None:
+            line += ', ETA %s' % _duration(metrics['eta_seconds'])
+        print(line, file=self.output, flush=True)
+
+    def write_metrics(self, done=False):
+        if not self.metrics_path:
+            return
+        metrics = self.metrics(done)
+        if self.metrics_path.endswith('.prom'):
+            text = prometheus_metrics(metrics)
+        else:
+            import json
+            text = json.dumps(metrics) + '\n'
+        temp_path = self.metrics_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(temp_path, self.metrics_path)
+
+    def watch(self, images):
+        """ Pass the images through, reporting as they are decoded - and once more when they run out """
+        self.start()
+        for image in images:
+            yield image
+            self.update()
+        self.update(done=True)
+
+
+PROMETHEUS_METRICS = [
+    ('frames_decoded', 'counter', 'Frames of the video decoded so far'),
+    ('frames_total', 'gauge', 'Frames in the video'),
+    ('elapsed_seconds', 'gauge', 'Seconds spent decoding'),
+    ('realtime_factor', 'gauge', 'Seconds of video decoded per second'),
+    ('lock_ratio', 'gauge', 'Fraction of frames closed captions were found on'),
+    ('repeated_frames', 'counter', 'Pulldown duplicate frames, not read again'),
+    ('parity_errors', 'counter', 'Frames read with a caption byte failing its parity check'),
+    ('captions', 'counter', 'Captions shown (pop-on captions and roll-up lines)'),
+    ('eta_seconds', 'gauge', 'Estimated seconds until decoding finishes'),
+    ('done', 'gauge', '1 once decoding has finished'),
+]
+
+
+def prometheus_metrics(metrics):
+    """ ProgressMeter metrics in the Prometheus text exposition format, labelled with the input. Unknowns are left
+        out """
+    label = '{input="%s"}' % metrics['input'].replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    lines = []
+    for name, kind, description in PROMETHEUS_METRICS:
+        value = metrics[name]
+        if value is None:
+            continue
+        lines += ['# HELP cc_decoder_%s %s' % (name, description), '# TYPE cc_decoder_%s %s' % (name, kind),
+                  'cc_decoder_%s%s %s' % (name, label, float(value))]
+    return '\n'.join(lines) + '\n'
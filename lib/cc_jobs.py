@@ -0,0 +1,711 @@
+#!/usr/local/bin/python
+# coding: utf-8
+"""
+Running many decodes - a pool of warm worker processes fed from a job queue, served over localhost HTTP or a Unix
+socket, fed from a watched folder, or shared between machines through a manifest on a shared file system. Only the
+standard library is used.
+
+Public domain / Unlicense
+But attribution is always appreciated where possible.
+"""
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+import collections
+import fnmatch
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Job(object):
+    """ A decode request, and how it is getting on
+         job_id      - unique id for the job
+         input_path  - video file to decode
+         ccformat    - output format, as for the command line
+         options     - keyword options for the decode, i.e. lines, ccfilter
+         output_path - file the captions are written to
+         priority    - jobs with a higher priority are started first """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id, input_path, ccformat='srt', options=None, output_path=None, priority=0):
+        self.id = job_id
+        self.input_path = input_path
+        self.format = ccformat
+        self.options = options or {}
+        self.output_path = output_path
+        self.priority = priority
+        self.status = Job.QUEUED
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def queue_seconds(self):
+        """ Time spent waiting for a worker, so far """
+        return (self.started or time.time()) - self.submitted
+
+    @property
+    def run_seconds(self):
+        """ Time spent decoding so far, None until a worker picks the job up """
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        return {'id': self.id, 'input': self.input_path, 'format': self.format, 'output': self.output_path,
+                'priority': self.priority, 'status': self.status, 'error': self.error,
+                'queue_seconds': self.queue_seconds, 'run_seconds': self.run_seconds}
+
+
+# Decode options a job posted to the service may set. The rest - ffmpeg_path, temp_path and the like - are the
+# service's own, set when it is started
+JOB_OPTIONS = frozenset(['lines', 'start_line', 'fixed_line', 'ccfilter', 'fps', 'raw_size', 'raw_frame_bytes',
+                         'full_range', 'bitlevel', 'skip_pulldown', 'start', 'end', 'preroll'])
+
+
+class DecodeService(object):
+    """ Runs decode jobs on a pool of worker processes that stay up between jobs, so each job only pays for the
+        decode itself - not interpreter start up, imports and table construction
+         run_job         - module level function(input_path, ccformat, options, output_path) run in a worker
+         workers         - number of worker processes (default one per CPU)
+         initializer     - function run once in each worker process as it starts, to warm it up
+         default_options - options used for every job, unless the job overrides them
+         keep_finished   - how many finished jobs to remember, for GET /jobs, before forgetting the oldest """
+
+    def __init__(self, run_job, workers=None, initializer=None, default_options=None, keep_finished=1000):
+        self.run_job = run_job
+        self.workers = workers or os.cpu_count() or 1
+        self.default_options = default_options or {}
+        self.keep_finished = keep_finished
+        self.jobs = {}
+        self.finished = collections.deque()  # Ids of finished jobs, oldest first
+        self.queue = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initializer)
+        for _ in range(self.workers):
+            self.pool.submit(int)  # Start the workers now, rather than on the first jobs
+        self.dispatchers = [threading.Thread(target=self._dispatch, daemon=True) for _ in range(self.workers)]
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+
+    def submit(self, input_path, ccformat='srt', options=None, output_path=None, priority=0):
+        """ Queue a decode, returning its Job """
+        job_options = dict(self.default_options)
+        job_options.update(options or {})
+        with self.lock:
+            job = Job(next(self._ids), input_path, ccformat, job_options, output_path, priority)
+            self.jobs[job.id] = job
+        self.queue.put((-priority, job.id, job))
+        return job
+
+    def _dispatch(self):
+        """ Hand queued jobs to the worker pool, one at a time, until a sentinel is queued by close """
+        while True:
+            priority, job_id, job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                cancelled = job.status == Job.CANCELLED
+                if not cancelled:
+                    job.started = time.time()
+                    job.status = Job.RUNNING
+            if cancelled:
+                continue
+            try:
+                self.pool.submit(self.run_job, job.input_path, job.format, job.options, job.output_path).result()
+                job.status = Job.DONE
+            except Exception as e:
+                job.status = Job.FAILED
+                job.error = '%s: %s' % (type(e).__name__, e)
+            self._finish(job)
+
+    def _finish(self, job):
+        job.finished = time.time()
+        with self.lock:
+            self.finished.append(job.id)
+            while len(self.finished) > self.keep_finished:
+                del self.jobs[self.finished.popleft()]
+        job.done.set()
+
+    def cancel(self, job):
+        """ Cancel job if it hasn't started yet, returning whether it was. A running job can't be stopped, wait on
+            job.done for it """
+        with self.lock:
+            if job.status != Job.QUEUED:
+                return False
+            job.status = Job.CANCELLED
+        self._finish(job)
+        return True
+
+    def get_job(self, job_id):
+        """ The Job with the passed id, None if there isn't one (or it finished long enough ago to be forgotten) """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        """ Every job queued, running or still remembered """
+        with self.lock:
+            return list(self.jobs.values())
+
+    def status(self):
+        """ Summary of the service - queue depth and how many jobs are in each state """
+        with self.lock:
+            jobs = list(self.jobs.values())
+        counts = collections.Counter(job.status for job in jobs)
+        return {'workers': self.workers, 'queue_depth': counts[Job.QUEUED], 'running': counts[Job.RUNNING],
+                'done': counts[Job.DONE], 'failed': counts[Job.FAILED], 'cancelled': counts[Job.CANCELLED]}
+
+    def close(self):
+        """ Finish the running jobs, abandon the queued ones and stop the workers """
+        for _ in self.dispatchers:
+            self.queue.put((float('inf'), 0, None))
+        for dispatcher in self.dispatchers:
+            dispatcher.join()
+        self.pool.shutdown()
+
+
+class DecodeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ JSON over HTTP interface to a DecodeService (server.service)
+         POST /jobs      - {"input": path, "format": "srt", "options": {...}, "output": path, "priority": 0}
+                           queues a job and returns it. With "stream": true the captions are returned as they are
+                           decoded instead (output is then optional), with "wait": true returns once the job is done.
+                           Only JSON (Content-Type: application/json) is accepted, format must be one of the
+                           server's formats, options may only be JOB_OPTIONS and output must be under the server's
+                           output_root - or without one, beside the input
+         GET /jobs       - every job
+         GET /jobs/<id>  - a single job, with its status and timings
+         GET /status     - queue depth, and number of jobs in each state """
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix-socket'
+
+    def _send_json(self, value, code=200):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/status':
+            return self._send_json(service.status())
+        if self.path == '/jobs':
+            return self._send_json([job.to_dict() for job in service.list_jobs()])
+        if self.path.startswith('/jobs/'):
+            job = service.get_job(int(self.path[6:])) if self.path[6:].isdigit() else None
+            if job:
+                return self._send_json(job.to_dict())
+        self._send_json({'error': 'Not found %s' % self.path}, 404)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self._send_json({'error': 'Not found %s' % self.path}, 404)
+        if self.headers.get_content_type() != 'application/json':
+            # A web page can only send JSON cross-origin after a preflight we never answer, so this keeps browsers
+            # out of a service listening on localhost
+            return self._send_json({'error': 'Content-Type must be application/json'}, 415)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            input_path = request['input']
+            options = request.get('options') or {}
+            if not isinstance(options, dict):
+                raise ValueError('options must be an object')
+            refused = sorted(set(options) - JOB_OPTIONS)
+        except (ValueError, KeyError) as e:
+            return self._send_json({'error': 'Bad request %s' % e}, 400)
+        if refused:
+            return self._send_json({'error': 'Bad request, jobs can not set %s' % ', '.join(refused)}, 400)
+        ccformat = request.get('format', 'srt')
+        if not isinstance(ccformat, str) or ',' in ccformat:
+            return self._send_json({'error': 'Bad request, format must name one output format'}, 400)
+        if self.server.formats is not None and ccformat.partition(':')[0] not in self.server.formats:
+            return self._send_json({'error': 'Bad request, format must be one of %s'
+                                    % ', '.join(self.server.formats)}, 400)
+        output_path = request.get('output')
+        stream = request.get('stream', False)
+        if not output_path and not stream:
+            return self._send_json({'error': 'Bad request, output is required unless streaming'}, 400)
+        if output_path and not output_allowed(input_path, output_path, self.server.output_root):
+            return self._send_json({'error': 'Bad request, output must be %s' % (
+                'under %s' % self.server.output_root if self.server.output_root else 'beside the input')}, 400)
+        if output_path and self.server.output_root:
+            output_path = os.path.join(self.server.output_root, output_path)
+        temporary = None
+        if not output_path:
+            handle, output_path = tempfile.mkstemp(prefix='ccjob', suffix=caption_path('', ccformat))
+            os.close(handle)
+            temporary = output_path
+        job = self.server.service.submit(input_path, ccformat, options, output_path,
+                                         request.get('priority', 0))
+        if stream:
+            try:
+                self._stream(job)
+            finally:
+                if temporary:
+                    # The client may have gone part way through - the job mustn't be left writing to the file
+                    if not self.server.service.cancel(job):
+                        job.done.wait()
+                    os.unlink(temporary)
+            return
+        if request.get('wait'):
+            job.done.wait()
+        self._send_json(job.to_dict(), 201)
+
+    def _stream(self, job):
+        """ Send the job's output as it is written (run_job must flush it as it goes), ending the response when the
+            job ends. Whether it succeeded is reported by GET /jobs/<X-Job-Id> """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('X-Job-Id', str(job.id))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        position = 0
+        finished = False
+        while not finished:
+            finished = job.done.wait(0.05)
+            with open(job.output_path, 'rb') as f:
+                f.seek(position)
+                data = f.read()
+            if data:
+                self.wfile.write(data)
+                self.wfile.flush()
+                position += len(data)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP on a Unix socket, i.e. curl --unix-socket """
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)  # Left behind by a previous run
+        socketserver.UnixStreamServer.server_bind(self)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def output_allowed(input_path, output_path, output_root=None):
+    """ Whether a job may write its captions to output_path - somewhere under output_root (a relative path is taken
+        as relative to it), or without one, in the same folder as the input. Never over the input itself """
+    if output_root:
+        output = os.path.realpath(os.path.join(output_root, output_path))
+        root = os.path.realpath(output_root)
+        allowed = output != root and os.path.commonpath([output, root]) == root
+    else:
+        output = os.path.realpath(output_path)
+        allowed = os.path.dirname(output) == os.path.dirname(os.path.realpath(input_path))
+    return allowed and output != os.path.realpath(input_path)
+
+
+def make_server(service, address, output_root=None, formats=None):
+    """ Returns an HTTP server for service
+         address     - 'host:port' (i.e. 'localhost:8021', port 0 picks a free port), anything else is taken as the
+                       path of a Unix socket
+         output_root - folder jobs may write their output under, by default only beside their input
+         formats     - output formats jobs may ask for (optionally limited to a channel, i.e. srt:1), by default any.
+                       A job always decodes to one """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        server = http.server.ThreadingHTTPServer((host, int(port)), DecodeRequestHandler)
+    else:
+        server = UnixHTTPServer(address, DecodeRequestHandler)
+    server.service = service
+    server.output_root = output_root
+    server.formats = formats
+    return server
+
+
+def serve(address, run_job, workers=None, initializer=None, default_options=None, output_root=None, formats=None):
+    """ Run a DecodeService on address until interrupted, see make_server and DecodeService for the arguments """
+    service = DecodeService(run_job, workers=workers, initializer=initializer, default_options=default_options)
+    server = make_server(service, address, output_root=output_root, formats=formats)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+VIDEO_EXTENSIONS = ('.avi', '.dv', '.m2ts', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.mts', '.mxf', '.ts',
+                    '.vob', '.webm', '.wmv', '.y4m')
+OUTPUT_EXTENSIONS = {'srt': '.srt', 'srtroll': '.srt', 'scc': '.scc', 'webvtt': '.vtt', 'jsonl': '.jsonl'}
+
+
+def caption_path(path, ccformat):
+    """ Where the captions for the video file path go - next to it, with an extension for the format (which may be
+        limited to a channel, i.e. srt:1) """
+    return os.path.splitext(path)[0] + OUTPUT_EXTENSIONS.get(ccformat.partition(':')[0], '.txt')
+
+
+def check_single_output(ccformat):
+    """ Raise ValueError unless ccformat names one output - watched and sharded videos are each decoded to the one
+        caption file (see caption_path) """
+    if ',' in ccformat:
+        raise ValueError('Each video is decoded to one caption file, %s names several outputs' % ccformat)
+
+
+class JobJournal(object):
+    """ Append only record of what happened to each file, one JSON object per line, so a restarted watcher knows
+        which files are already done. The last entry for a file wins
+         path - the journal file, created if need be """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Partly written when we were stopped
+                    self.entries[entry['path']] = entry
+
+    def record(self, path, size, mtime, status, attempts=0, error=None):
+        entry = {'path': path, 'size': size, 'mtime': mtime, 'status': status, 'attempts': attempts,
+                 'error': error, 'time': time.time()}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.entries[path] = entry
+
+    def finished(self, path, size, mtime):
+        """ Is there nothing more to do for this version of the file, either decoded or failed too often """
+        entry = self.entries.get(path)
+        return bool(entry and entry['status'] in (Job.DONE, Job.FAILED) and (entry['size'], entry['mtime']) ==
+                    (size, mtime))
+
+
+class HotFolder(object):
+    """ Watches a folder for video files, decoding each to a caption file next to it once it has finished arriving
+        (its size and modification time stop changing). Failed decodes are retried with exponential backoff
+         folder         - folder to watch, including sub folders
+         service        - DecodeService to run the decodes on, its workers limit how many run at once
+         ccformat       - output format, as for the command line
+         journal        - JobJournal (default .cc_decoder_journal.jsonl in folder)
+         stable_seconds - how long a file must be unchanged before it is decoded
+         retries        - how many times to retry a failed decode
+         backoff        - seconds to wait before the first retry, doubling for each one after
+         priorities     - list of (glob pattern, priority), the first pattern matching a file name sets its
+                          priority (default 0), higher priority files are decoded first """
+
+    def __init__(self, folder, service, ccformat='srt', journal=None, stable_seconds=10, retries=3, backoff=30,
+                 priorities=()):
+        check_single_output(ccformat)
+        self.folder = folder
+        self.service = service
+        self.format = ccformat
+        self.journal = journal or JobJournal(os.path.join(folder, '.cc_decoder_journal.jsonl'))
+        self.stable_seconds = stable_seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.priorities = priorities
+        self.seen = {}  # path -> (size, mtime, time first seen at this size/mtime)
+        self.running = {}  # path -> (Job, size, mtime)
+        self.retry_at = {}  # path -> earliest time to try again
+
+    def priority(self, path):
+        for pattern, priority in self.priorities:
+            if fnmatch.fnmatch(os.path.basename(path), pattern):
+                return priority
+        return 0
+
+    def videos(self):
+        """ Paths of all the video files in the folder """
+        for root, dirs, files in os.walk(self.folder):
+            for name in files:
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+    def poll(self):
+        """ Collect finished decodes and queue any files that are ready. Returns the number of files being decoded or
+            waiting to be retried """
+        for path, (job, size, mtime) in list(self.running.items()):
+            if job.done.is_set():
+                del self.running[path]
+                self._finished(path, job, size, mtime)
+
+        self.retry_at = {path: at for path, at in self.retry_at.items() if os.path.exists(path)}
+        now = time.time()
+        for path in self.videos():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed since we listed it
+            size, mtime = stat.st_size, stat.st_mtime
+            if path in self.running or self.journal.finished(path, size, mtime) or self.retry_at.get(path, 0) > now:
+                continue
+            seen = self.seen.get(path)
+            if not seen or seen[:2] != (size, mtime):
+                self.seen[path] = (size, mtime, now)  # New, or still being written
+            elif now - seen[2] >= self.stable_seconds:
+                self._start(path, size, mtime)
+        return len(self.running) + len(self.retry_at)
+
+    def _start(self, path, size, mtime):
+        self.retry_at.pop(path, None)
+        attempts = self.journal.entries.get(path, {}).get('attempts', 0) + 1
+        self.journal.record(path, size, mtime, Job.RUNNING, attempts)
+        # Decode to a partial file, so a half written caption file is never mistaken for a finished one
+        job = self.service.submit(path, self.format, output_path=caption_path(path, self.format) + '.partial',
+                                  priority=self.priority(path))
+        self.running[path] = (job, size, mtime)
+
+    def _finished(self, path, job, size, mtime):
+        attempts = self.journal.entries[path]['attempts']
+        if job.status == Job.DONE:
+            os.replace(job.output_path, caption_path(path, self.format))
+            self.journal.record(path, size, mtime, Job.DONE, attempts)
+            return
+        if os.path.exists(job.output_path):
+            os.unlink(job.output_path)
+        if attempts > self.retries:
+            self.journal.record(path, size, mtime, Job.FAILED, attempts, job.error)
+        else:
+            self.journal.record(path, size, mtime, 'retry', attempts, job.error)
+            self.retry_at[path] = time.time() + self.backoff * 2 ** (attempts - 1)
+
+    def run(self, poll_interval=2.0):
+        """ Poll the folder forever """
+        while True:
+            self.poll()
+            time.sleep(poll_interval)
+
+
+def watch(folder, run_job, ccformat='srt', workers=None, initializer=None, default_options=None, **kwargs):
+    """ Run a HotFolder until interrupted, see HotFolder and DecodeService for the arguments """
+    service = DecodeService(run_job, workers=workers, initializer=initializer, default_options=default_options)
+    try:
+        HotFolder(folder, service, ccformat, **kwargs).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+class ShardWorker(object):
+    """ Decodes the video files listed in a manifest, sharing them with any number of other ShardWorkers - on this
+        or other machines - that can see the same file system. There is no coordinator, a file is claimed by
+        atomically creating its lock file in state_dir. The lock's modification time is the lease, refreshed while
+        the file is being decoded. A lock that hasn't been refreshed for lease_seconds belongs to a dead worker, and
+        is taken over. Each worker decodes to a .partial file of its own, and when a file is decoded, if the lock is
+        still ours, its captions are moved next to it, then a .done marker is written to state_dir. A worker that
+        lost its lease throws its result away, the new owner's is used. Node clocks must agree to well within
+        lease_seconds
+         manifest      - text file listing the video files, one path per line, may be added to while running
+         service       - DecodeService to run the decodes on, one file is claimed per worker
+         ccformat      - output format, as for the command line
+         state_dir     - where lock files and markers go (default manifest + '.state')
+         node          - name for this worker, recorded in locks and markers (default host:pid)
+         lease_seconds - how long a lock lasts without a heartbeat
+         retries       - how many times a failed decode is retried, by any worker """
+
+    def __init__(self, manifest, service, ccformat='srt', state_dir=None, node=None, lease_seconds=120, retries=3):
+        check_single_output(ccformat)
+        self.manifest = manifest
+        self.service = service
+        self.format = ccformat
+        self.state_dir = state_dir or manifest + '.state'
+        self.node = node or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.retries = retries
+        self.running = {}  # path -> Job
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def entries(self):
+        with open(self.manifest, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    def marker(self, path, kind):
+        """ Path of a lock, done or failed marker for a manifest entry """
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.state_dir, '%s-%s.%s' % (digest, os.path.basename(path), kind))
+
+    def _write_marker(self, path, kind, **values):
+        values.update(path=path, node=self.node, time=time.time())
+        temporary = '%s.%s.tmp' % (self.marker(path, kind), self.node.replace(os.sep, '_'))
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(values, f)
+        os.replace(temporary, self.marker(path, kind))
+
+    def partial_path(self, path):
+        """ Where this worker decodes path to, before moving it into place - each node has its own, so a worker
+            that lost its lease can't get in the way of the one that took it over """
+        return '%s.%s.partial' % (caption_path(path, self.format), self.node.replace(os.sep, '_').replace(':', '_'))
+
+    def attempts(self, path):
+        try:
+            with open(self.marker(path, 'failed'), encoding='utf-8') as f:
+                return json.load(f)['attempts']
+        except (OSError, ValueError):
+            return 0
+
+    def claim(self, path):
+        """ Try to take the lock for path, taking over an expired one. Returns True if we now hold it """
+        lock = self.marker(path, 'lock')
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._reclaim(lock):
+                return False
+            try:
+                fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False  # Another worker reclaimed it first
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.node)
+        return True
+
+    def _reclaim(self, lock):
+        """ Remove lock if its lease has expired. Moving it aside is atomic, so only one worker gets to remove it """
+        try:
+            if time.time() - os.stat(lock).st_mtime < self.lease_seconds:
+                return False
+            expired = '%s.%s.expired' % (lock, self.node.replace(os.sep, '_'))
+            os.rename(lock, expired)
+        except OSError:
+            return False  # Released or reclaimed while we looked at it
+        if time.time() - os.stat(expired).st_mtime < self.lease_seconds:
+            # Between looking and moving, another worker reclaimed it and took a fresh lease - put it back
+            try:
+                os.link(expired, lock)
+            except OSError:
+                pass
+            os.unlink(expired)
+            return False
+        os.unlink(expired)
+        return True
+
+    def holds(self, path):
+        """ Whether the lock for path is still ours, rather than taken over after we stopped heartbeating """
+        try:
+            with open(self.marker(path, 'lock'), encoding='utf-8') as f:
+                return f.read() == self.node
+        except OSError:
+            return False
+
+    def release(self, path):
+        """ Remove our lock for path - but not one another worker has since taken over """
+        if not self.holds(path):
+            return
+        try:
+            os.unlink(self.marker(path, 'lock'))
+        except OSError:
+            pass
+
+    def heartbeat(self):
+        """ Renew the leases on the files we are decoding """
+        for path in self.running:
+            if not self.holds(path):
+                continue  # Taken over while we were stalled, what we decode will be thrown away
+            try:
+                os.utime(self.marker(path, 'lock'))
+            except OSError:
+                pass
+
+    def poll(self):
+        """ Collect finished decodes, renew our leases and claim more files while there are idle workers. Returns
+            the number of manifest entries still to be done, by us or anyone else """
+        for path, job in list(self.running.items()):
+            if job.done.is_set():
+                del self.running[path]
+                self._finished(path, job)
+        self.heartbeat()
+
+        outstanding = 0
+        for path in self.entries():
+            if os.path.exists(self.marker(path, 'done')) or self.attempts(path) > self.retries:
+                continue
+            outstanding += 1
+            if path in self.running or len(self.running) >= self.service.workers or not self.claim(path):
+                continue
+            if os.path.exists(self.marker(path, 'done')):
+                self.release(path)  # Finished by its previous owner between our looking and claiming
+                outstanding -= 1
+                continue
+            self.running[path] = self.service.submit(path, self.format, output_path=self.partial_path(path))
+        return outstanding
+
+    def _finished(self, path, job):
+        if not self.holds(path):
+            # Our lease ran out and another worker has the file now, it writes the captions and the markers
+            if os.path.exists(job.output_path):
+                os.unlink(job.output_path)
+            return
+        if job.status == Job.DONE:
+            os.replace(job.output_path, caption_path(path, self.format))
+            self._write_marker(path, 'done', output=caption_path(path, self.format), run_seconds=job.run_seconds)
+        else:
+            if os.path.exists(job.output_path):
+                os.unlink(job.output_path)
+            self._write_marker(path, 'failed', attempts=self.attempts(path) + 1, error=job.error)
+        self.release(path)
+
+    def run(self, poll_interval=1.0):
+        """ Work through the manifest, returning once every entry is done (or has failed too often) """
+        while self.poll() or self.running:
+            time.sleep(poll_interval)
+
+
+def shard(manifest, run_job, ccformat='srt', workers=None, initializer=None, default_options=None, **kwargs):
+    """ Run a ShardWorker until the manifest is finished, see ShardWorker and DecodeService for the arguments """
+    service = DecodeService(run_job, workers=workers, initializer=initializer, default_options=default_options)
+    worker = ShardWorker(manifest, service, ccformat, **kwargs)
+    try:
+        worker.run()
+    finally:
+        service.close()
+        for path in worker.running:  # Interrupted, let someone else have these straight away
+            worker.release(path)
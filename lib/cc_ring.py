@@ -0,0 +1,179 @@
+#!/usr/local/bin/python
+# coding: utf-8
+"""
+A ring of frames in shared memory, written by one process and read by several - so decoding the same video to
+several outputs (formats, or caption channels) needs one ffmpeg and one read of each frame, with each output decoded
+on its own core. Only the standard library is used.
+
+Public domain / Unlicense
+But attribution is always appreciated where possible.
+"""
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+import time
+from multiprocessing import shared_memory
+from lib.cc_frames import LumaImageWrapper
+
+# Header fields, 64 bit integers at the start of the shared memory. Each is written by one process only - the
+# writer's by the writer, a consumer's read sequence number by that consumer - so no locks are needed
+WRITE_SEQ, STATUS, WIDTH, HEIGHT, SLOTS, CONSUMERS = range(6)
+HEADER_FIELDS = 6
+SLOT_HEADER_BYTES = 8  # The sequence number of the frame in the slot
+
+WRITING, FINISHED, FAILED = 0, 1, 2  # STATUS values
+DETACHED = 1 << 62  # The read sequence number of a consumer that has gone, so it holds nobody up
+
+WAIT_MIN = 0.0002  # Seconds to sleep while waiting on the other side, doubling up to WAIT_MAX
+WAIT_MAX = 0.005
+
+
+class FrameRing(object):
+    """ Frames of luma rows in a ring of slots in shared memory. The writer puts frame after frame, each consumer
+        reads every frame in order, and the writer waits whenever the ring is full of frames the slowest consumer
+        hasn't finished with. Frames carry sequence numbers, so a consumer can tell its slot was overwritten. Frames
+        are read in place, without copying them out of the ring. Create the ring with create, and open it in the
+        consumer processes with attach
+         memory - the multiprocessing.shared_memory.SharedMemory holding the ring """
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.consumers = memory.buf[8 * CONSUMERS:8 * (CONSUMERS + 1)].cast('q')[0]
+        self.header = memory.buf[:8 * (HEADER_FIELDS + self.consumers)].cast('q')
+        self.width, self.height, self.slots = self.header[WIDTH], self.header[HEIGHT], self.header[SLOTS]
+        self.slot_bytes = SLOT_HEADER_BYTES + (self.width * self.height + 7) // 8 * 8
+        self.data_start = 8 * (HEADER_FIELDS + self.consumers)
+
+    @classmethod
+    def create(cls, width, height, consumers, slots=64):
+        """ A new ring for frames of width by height luma samples, read by consumers processes
+             slots - frames the ring holds, how far the writer may get ahead of the slowest consumer """
+        slot_bytes = SLOT_HEADER_BYTES + (width * height + 7) // 8 * 8
+        memory = shared_memory.SharedMemory(create=True, size=8 * (HEADER_FIELDS + consumers) + slots * slot_bytes)
+        header = memory.buf[:8 * (HEADER_FIELDS + consumers)].cast('q')
+        header[WIDTH], header[HEIGHT], header[SLOTS], header[CONSUMERS] = width, height, slots, consumers
+        header.release()
+        return cls(memory)
+
+    @classmethod
+    def attach(cls, name):
+        """ Open the ring created (in another process) with the passed name """
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def _slot(self, seq):
+        start = self.data_start + (seq % self.slots) * self.slot_bytes
+        return start, self.memory.buf[start + SLOT_HEADER_BYTES:start + SLOT_HEADER_BYTES + self.width * self.height]
+
+    def slowest(self):
+        """ The sequence number of the next frame the slowest consumer will read """
+        return min(self.header[HEADER_FIELDS:], default=DETACHED)
+
+    def put(self, image, alive=None):
+        """ Copy the passed image's rows (see BaseImageWrapper.get_row) into the next slot, first waiting for a
+            free one
+             alive - optional function of a consumer number, False if it has gone without detaching (i.e. its
+                     process was killed), so it is detached rather than waited for forever """
+        seq = self.header[WRITE_SEQ]
+        wait = WAIT_MIN
+        while seq - self.slowest() >= self.slots:
+            if alive:
+                for consumer in range(self.consumers):
+                    if self.header[HEADER_FIELDS + consumer] != DETACHED and not alive(consumer):
+                        self.detach(consumer)
+            time.sleep(wait)
+            wait = min(wait * 2, WAIT_MAX)
+        if (image.width, image.height) != (self.width, self.height):
+            raise RuntimeError('Frame %d is %dx%d, the ring holds %dx%d frames'
+                               % (seq, image.width, image.height, self.width, self.height))
+        start, view = self._slot(seq)
+        get_row = getattr(image, 'get_row', None)
+        for y in range(self.height):
+            row = get_row(y) if get_row else None
+            if row is None:
+                row = bytes(image.get_pixel_luma(x, y) for x in range(self.width))
+            view[y * self.width:(y + 1) * self.width] = row
+        view.release()
+        self.memory.buf[start:start + SLOT_HEADER_BYTES].cast('q')[0] = seq
+        self.header[WRITE_SEQ] = seq + 1  # Publish the frame, only once it is all there
+
+    def finish(self, failed=False):
+        """ No more frames are coming - consumers read to the last one, or if failed stop with an error """
+        self.header[STATUS] = FAILED if failed else FINISHED
+
+    def detach(self, consumer):
+        """ Stop holding the writer up for the passed consumer """
+        self.header[HEADER_FIELDS + consumer] = DETACHED
+
+    def frames(self, consumer):
+        """ Generator of the frames in the ring for the passed consumer number (from 0), as LumaImageWrappers viewing
+            the slot they are in. A frame is only valid until the next is asked for, when its slot is handed back
+            to the writer. The consumer is detached when the generator finishes, however it finishes """
+        read_seq = HEADER_FIELDS + consumer
+        seq = self.header[read_seq]
+        try:
+            while True:
+                wait = WAIT_MIN
+                while seq >= self.header[WRITE_SEQ]:
+                    status = self.header[STATUS]
+                    if status == FAILED:
+                        raise RuntimeError('Reading the frames failed')
+                    if status == FINISHED and seq >= self.header[WRITE_SEQ]:
+                        return
+                    time.sleep(wait)
+                    wait = min(wait * 2, WAIT_MAX)
+                start, view = self._slot(seq)
+                slot_seq = self.memory.buf[start:start + SLOT_HEADER_BYTES].cast('q')[0]
+                if slot_seq != seq:
+                    view.release()
+                    raise RuntimeError('Frame %d was overwritten by frame %d before it was read' % (seq, slot_seq))
+                image = LumaImageWrapper(view, self.width, self.height, full_range=True)
+                yield image
+                image.unlink()  # Decoders normally have, but make sure the view can't outlive the slot
+                seq += 1
+                self.header[read_seq] = seq
+        finally:
+            self.detach(consumer)
+
+    def close(self):
+        """ Let go of the shared memory, in this process """
+        self.header.release()
+        try:
+            self.memory.close()
+        except BufferError:
+            pass  # A frame is still held, the memory goes with this process
+
+    def unlink(self):
+        """ Remove the shared memory, once every process has finished with it. Only the creator should """
+        self.memory.unlink()
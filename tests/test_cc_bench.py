@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+import lib.cc_decode
+from lib.cc_bench import benchmark, caption_byte_stream, captions_from_pairs, render_frames, run_config, \
+    save_results, load_results, regressions, caption_error_rate, format_results, DecodeConfig, Impairment, \
+    SyntheticImage, BenchResult, SCENARIOS
+from lib.cc_decode import BIT_PITCH, decode_row
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+CLEAN, NOISY = SCENARIOS[0], SCENARIOS[1]
+
+
+class TestRendering(TestCase):
+    def test_clean_rows_decode(self):
+        pairs = [(0x14, 0x2c), (0x41, 0x42), (0x7f, 0x00)]
+        for width in (720, 1920):
+            frames = render_frames(pairs, Impairment('wide', 0, 0, 1.0, 0, BIT_PITCH), width=width)
+            for rows, pair in zip(frames, pairs):
+                self.assertEqual(decode_row(SyntheticImage(rows), row_number=1), pair)
+
+    def test_reproducible(self):
+        pairs = caption_byte_stream(['HELLO'])
+        self.assertEqual(render_frames(pairs, NOISY), render_frames(pairs, NOISY))
+        self.assertNotEqual(render_frames(pairs, NOISY), render_frames(pairs, NOISY, seed=1))
+
+    def test_caption_stream(self):
+        self.assertEqual([text for _, text in captions_from_pairs(caption_byte_stream(['ONE', 'TWO!']))],
+                         ['ONE', 'TWO!'])
+
+
+class TestMeasures(TestCase):
+    def test_caption_error_rate(self):
+        sent = [(10, 'ONE'), (50, 'TWO')]
+        self.assertEqual(caption_error_rate(sent, [(11, 'ONE'), (50, 'TWO')]), 0)
+        self.assertEqual(caption_error_rate(sent, [(10, 'ONE'), (50, 'TW0')]), 0.5)  # Mangled counts once
+        self.assertEqual(caption_error_rate(sent, [(10, 'ONE')]), 0.5)
+        self.assertEqual(caption_error_rate(sent, [(30, 'ONE'), (50, 'TWO')]), 0.5)  # Too late
+        self.assertEqual(caption_error_rate(sent, sent + [(80, 'THREE'), (90, 'FOUR')]), 1)
+
+    def test_config_restores_settings(self):
+        config = DecodeConfig('test', SAMPLE_SIZE=1, LUMA_THRESHOLD=60)
+        with config.applied():
+            self.assertEqual((lib.cc_decode.SAMPLE_SIZE, lib.cc_decode.LUMA_THRESHOLD), (1, 60))
+        self.assertEqual((lib.cc_decode.SAMPLE_SIZE, lib.cc_decode.LUMA_THRESHOLD), (3, 80))
+
+    def test_run_config(self):
+        pairs = caption_byte_stream(['HELLO', 'WORLD'])
+        sent = captions_from_pairs(pairs)
+        clean = run_config(DecodeConfig('default'), render_frames(pairs, CLEAN), pairs, sent, 'clean')
+        self.assertEqual((clean.byte_error_rate, clean.caption_error_rate), (0, 0))
+        self.assertGreater(clean.frames_per_second, 0)
+        dim = Impairment('dim', 0, 0, 0.5, 0, BIT_PITCH)  # Data high below the 80 threshold
+        missed = run_config(DecodeConfig('default'), render_frames(pairs, dim), pairs, sent, 'dim')
+        self.assertEqual((missed.byte_error_rate, missed.caption_error_rate), (1, 1))
+        found = run_config(DecodeConfig('low', LUMA_THRESHOLD=40), render_frames(pairs, dim), pairs, sent, 'dim')
+        self.assertEqual((found.byte_error_rate, found.caption_error_rate), (0, 0))
+
+    def test_per_pixel_matches_rows(self):
+        pairs = caption_byte_stream(['NOISY'])
+        frames = render_frames(pairs, NOISY)
+        sent = captions_from_pairs(pairs)
+        rows = run_config(DecodeConfig('rows'), frames, pairs, sent)
+        pixels = run_config(DecodeConfig('pixels', row_access=False), frames, pairs, sent)
+        self.assertEqual(rows.byte_error_rate, pixels.byte_error_rate)
+
+
+class TestBenchmark(TestCase):
+    def test_benchmark(self):
+        configs = [DecodeConfig('default'), DecodeConfig('1 sample', SAMPLE_SIZE=1)]
+        results = benchmark(scenarios=[CLEAN, NOISY], configs=configs, captions=['HELLO', 'WORLD'])
+        self.assertEqual([(result.scenario, result.config) for result in results],
+                         [('clean', 'default'), ('clean', '1 sample'), ('noisy', 'default'), ('noisy', '1 sample')])
+        self.assertIn('noisy        1 sample', format_results(results))
+
+    def test_regressions(self):
+        baseline = [BenchResult('noisy', 'default', 100, 0.01, 0.2, 1000.0)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'baseline.json')
+            save_results(baseline, path)
+            with open(path) as f:
+                self.assertEqual(json.load(f)[0]['config'], 'default')
+            baseline = load_results(path)
+        self.assertEqual(regressions([BenchResult('noisy', 'default', 100, 0.012, 0.2, 10.0)], baseline), [])
+        self.assertEqual(len(regressions([BenchResult('noisy', 'default', 100, 0.01, 0.4, 1000.0),
+                                          BenchResult('clean', 'default', 100, 0.5, 0.5, 1000.0)], baseline)), 1)
@@ -1,10 +1,21 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
 from unittest import TestCase
 from lib.cc_decode import decode_byte_pair, decode_byte, BYTE1_LOCATIONS, find_and_decode_row, \
     compute_xds_packet_checksum, extract_closed_caption_bytes, _assert_len, decode_xds_string, decode_xds_minutes_hours, \
     describe_xds_packet, decode_captions_debug, decode_image_list_to_srt, decode_captions_to_scc, decode_xds_packets, \
     decode_captions_raw, decode_row, decode_xds_content_advisory, BYTE2_LOCATIONS, SYNC_SIGNAL_LOCATIONS_HIGH, \
-    ALL_SPECIAL_CHARS, CC_TABLE, decode_xds_time_of_day
+    ALL_SPECIAL_CHARS, CC_TABLE, decode_xds_time_of_day, DecodeCheckpoint, XdsPacketAssembler, CaptionEngine, \
+    SrtCaptionWriter, decode_captions_to_diff, POP_ON, ROLL_UP, PAINT_ON, decode_captions_to_webvtt, \
+    decode_captions_to_json_lines, reset_row_lock, BIT_PITCH, NOMINAL_WIDTH, demux_caption_channels, channel_frames, \
+    skip_pulldown_repeats, RepeatedFrame, DecodedFrame, iter_captions, iter_caption_bytes, NO_PARITY_TO_ODD_PARITY, \
+    RepeatedControlFilter
 from random import randint
+import lib.cc_decode
+import math
 
 __author__ = "Max Smith"
 __copyright__ = "Copyright 2014-2025 Max Smith"
@@ -55,11 +66,17 @@ class RandomMockImage(MockImage):
         return randint(0,255)
 
 
+def odd_parity(value):
+    """ A byte as transmitted, with its odd parity bit. One with bit 8 already set is left as it is, to render a
+        parity error """
+    return value if value > 0x7f else NO_PARITY_TO_ODD_PARITY[value]
+
+
 class MockImageWithBytes(MockImage):
     def __init__(self, val1, val2, h=480, w=720):
         super().__init__(None)
-        self.val1 = val1
-        self.val2 = val2
+        self.val1 = odd_parity(val1)
+        self.val2 = odd_parity(val2)
         self.height = h
         self.width = w
 
@@ -78,6 +95,33 @@ class MockImageWithBytes(MockImage):
                 in_range(x, BYTE2_LOCATIONS, val=self.val2) or 0
 
 
+class DriftingMockImage(MockImage):
+    """ A line 21 row as a worn tape might give it, a sine run-in and data bits whose phase and pitch are off """
+    def __init__(self, val1, val2, phase=0.0, pitch=BIT_PITCH, h=1, w=720):
+        super().__init__(None, h=h, w=w)
+        val1, val2 = odd_parity(val1), odd_parity(val2)
+        self.bits = [True] + [bool(val1 & (1 << i)) for i in range(8)] + [bool(val2 & (1 << i)) for i in range(8)]
+        self.start = SYNC_SIGNAL_LOCATIONS_HIGH[0] + phase  # First run-in peak
+        self.pitch = pitch
+
+    def get_pixel_luma(self, x, y):
+        cycles = (x - self.start) / self.pitch
+        if -0.5 <= cycles < 6.5:
+            return 50 + 50 * math.cos(2 * math.pi * cycles)
+        bit = math.floor(cycles - (280 - 28) / BIT_PITCH) + 1  # The start bit, then the data bits from pixel 280
+        return 100 if 0 <= bit < len(self.bits) and self.bits[bit] else 0
+
+
+class ScaledMockImage(MockImage):
+    """ An image of another width, showing the same picture as a 720 pixel wide one """
+    def __init__(self, image, w):
+        super().__init__(None, h=image.height, w=w)
+        self.image = image
+
+    def get_pixel_luma(self, x, y):
+        return self.image.get_pixel_luma(x * NOMINAL_WIDTH / self.width, y)
+
+
 MOCK_IMAGE_SEQUENCE = ([MockImage(0, h=1)] * 100) + ([MockImage(0, h=5)] * 100)
 RANDOM_MOCK_IMAGE_SEQUENCE = ([RandomMockImage(0, h=1)] * 1000) + \
                              ([RandomMockImage(0, h=5)] * 1000) + \
@@ -201,9 +245,541 @@ class TestDecoding(TestCase):
         decode_captions_raw(MOCK_IMAGE_SEQUENCE)
         decode_captions_raw(RANDOM_MOCK_IMAGE_SEQUENCE)
 
+    def test_xds_packet_assembler(self):
+        assembler = XdsPacketAssembler()
+        packets = [assembler.push(b1, b2, frame) for frame, (b1, b2) in enumerate(self.xds_test_case())]
+        packets = [packet for packet in packets if packet]
+        self.assertEqual([(packet.xds_class, packet.xds_type) for packet in packets],
+                         [('Channel', 2), ('Current', 2), ('Current', 5), ('Current', 3), ('Channel', 1),
+                          ('Current', 1)])
+        self.assertTrue(all(packet.valid for packet in packets))
+        self.assertEqual(packets[3].description, 'XDS Current Program Name: Duckman')  # Interrupted, then continued
+        self.assertEqual(packets[3].payload, b'Duckman\x00')
+        self.assertEqual(packets[3].frame, 18)
+
+        # XDS repeats itself, unchanged packets are suppressed
+        repeated = [assembler.push(b1, b2) for (b1, b2) in self.xds_test_case()]
+        self.assertEqual([packet for packet in repeated if packet], [])
+        self.assertEqual(assembler.repeats, 6)
+
+    def test_xds_packet_assembler_rejects(self):
+        assembler = XdsPacketAssembler()
+        self.assertIsNone(assembler.push(0x05, 0x02))
+        self.assertIsNone(assembler.push(0x43, 0x43))
+        self.assertIsNone(assembler.push(0x0f, 0x00))  # Bad checksum
+        self.assertEqual(assembler.rejected, 1)
+        # Caption data interrupts a packet, it is ignored until the packet continues
+        for b1, b2 in [(0x05, 0x02), (0x43, 0x43), (0x14, 0x20), (0x41, 0x41), (0x06, 0x02), (0x54, 0x56),
+                       (0x0f, 0x3a)]:
+            packet = assembler.push(b1, b2)
+        self.assertEqual(packet.description, 'XDS Channel Station Call-Sign: CCTV')
+
     def test_decode_xds_content_advisory(self):
         decode_xds_content_advisory([[0x05, 0x05]])
 
     def test_decode_xds_timeofday(self):
         self.assertEquals( 'TM 18:36S ZTA Dec 06 2002 Fri',  decode_xds_time_of_day([[0x64, 0x52], [0x46, 0x7c], [0x46, 0x4c], [0x8f,0xdf]]) )
-        self.assertEquals( 'XDS Time of day (UTC): TM 18:36S ZTA Dec 06 2002 Fri', describe_xds_packet([[0x07, 0x01], [0x64, 0x52], [0x46, 0x7c], [0x46, 0x4c], [0x8f,0xdf]]) )
\ No newline at end of file
+        self.assertEquals( 'XDS Time of day (UTC): TM 18:36S ZTA Dec 06 2002 Fri', describe_xds_packet([[0x07, 0x01], [0x64, 0x52], [0x46, 0x7c], [0x46, 0x4c], [0x8f,0xdf]]) )
+
+
+def caption_pairs(*codes):
+    """ Byte pairs for a mix of control codes (sent twice, as they would be) and text """
+    pairs = []
+    for code in codes:
+        if isinstance(code, str):
+            code += ' ' * (len(code) % 2)
+            pairs += [(ord(a), ord(b)) for a, b in zip(code[::2], code[1::2])]
+        else:
+            pairs += [code, code]
+    return pairs
+
+
+class TestCaptionEngine(TestCase):
+    def feed(self, engine, pairs):
+        events = []
+        repeats = RepeatedControlFilter()  # As extract_closed_caption_bytes does
+        for frame, (b1, b2) in enumerate(pairs):
+            if not repeats.is_repeat(b1, b2):
+                events += engine.feed(b1, b2, frame)
+        return events
+
+    def test_pop_on(self):
+        events = self.feed(CaptionEngine(), caption_pairs(
+            (0x14, 0x20), (0x14, 0x2e), (0x13, 0x52), 'HI', (0x14, 0x70), 'THERE', (0x12, 0x2b), (0x14, 0x2f),
+            (0x14, 0x20), 'NEXT', (0x14, 0x2c)))
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0].mode, POP_ON)
+        self.assertEqual(events[0].lines, ((11, 4, 'HI'), (14, 0, 'THERE©')))  # Row 12 indent 4, row 15
+        self.assertEqual(events[1].changed, ((11, 0, ''), (14, 0, '')))
+        self.assertEqual(events[1].lines, ())
+
+    def test_roll_up(self):
+        events = self.feed(CaptionEngine(), caption_pairs(
+            (0x14, 0x25), (0x14, 0x2d), (0x14, 0x70), 'HELLO', (0x14, 0x2d), 'WORLD', (0x14, 0x2d), 'AGAIN',
+            (0x14, 0x2d)))
+        self.assertTrue(all(event.mode == ROLL_UP for event in events))
+        self.assertEqual([[text for _, _, text in event.lines] for event in events],
+                         [['HELLO'], ['HELLO'], ['HELLO', 'WORLD'], ['WORLD'], ['WORLD', 'AGAIN'], ['AGAIN']])
+        self.assertEqual(events[1].changed, ((13, 0, 'HELLO'), (14, 0, '')))
+
+    def test_paint_on_editing(self):
+        engine = CaptionEngine()
+        events = self.feed(engine, caption_pairs(
+            (0x14, 0x29), (0x14, 0x70), 'ABCD', (0x14, 0x21), (0x17, 0x22), 'X', (0x14, 0x70), (0x17, 0x21),
+            (0x14, 0x24)))
+        self.assertEqual([event.lines for event in events],
+                         [((14, 0, 'ABCD'),), ((14, 0, 'ABC'),), ((14, 0, 'ABC  X'),), ((14, 0, 'A'),)])
+        self.assertEqual(events[0].mode, PAINT_ON)
+        self.assertEqual(engine.flush(99), [])
+
+    def test_channels(self):
+        pairs = caption_pairs((0x14, 0x29), (0x14, 0x70), 'ONE', (0x1c, 0x29), (0x1c, 0x70), 'TWO', (0x14, 0x2d),
+                              (0x1c, 0x2d))
+        events = self.feed(CaptionEngine(), pairs)
+        self.assertEqual([(event.channel, event.lines[0][2]) for event in events], [('CC1', 'ONE'), ('CC2', 'TWO')])
+        events = self.feed(CaptionEngine(channels=(2,)), pairs)
+        self.assertEqual([event.channel for event in events], ['CC2'])
+
+    def test_state_round_trip(self):
+        pairs = caption_pairs((0x14, 0x25), (0x14, 0x2d), (0x14, 0x70), 'HELLO', (0x14, 0x2d), 'WORLD',
+                              (0x14, 0x2d))
+        engine = CaptionEngine()
+        self.feed(engine, pairs[:10])
+        restored = CaptionEngine()
+        restored.set_state(json.loads(json.dumps(engine.get_state())))
+        self.assertEqual([engine.feed(b1, b2, 10 + i) for i, (b1, b2) in enumerate(pairs[10:])],
+                         [restored.feed(b1, b2, 10 + i) for i, (b1, b2) in enumerate(pairs[10:])])
+
+    def test_decode_diff(self):
+        images = [MockImageWithBytes(b1, b2, h=1) for b1, b2 in caption_pairs((0x14, 0x29), (0x14, 0x70), 'HI',
+                                                                              (0x14, 0x2c))]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decode_captions_to_diff(images)
+        self.assertEqual(output.getvalue(), '00:00:00,133 CC1 row 15 col 00: HI\n00:00:00,166 CC1 row 15 col 00: \n')
+
+
+    def decode_pop_on(self, decoder):
+        pairs = caption_pairs((0x14, 0x20), (0x13, 0x52), 'HI', (0x14, 0x70), 'THERE', (0x14, 0x2f), (0x14, 0x2c))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decoder([MockImageWithBytes(b1, b2, h=1) for b1, b2 in pairs])
+        return output.getvalue()
+
+    def test_decode_webvtt(self):
+        self.assertEqual(self.decode_pop_on(decode_captions_to_webvtt),
+                         'WEBVTT\n\n1\n00:00:00.333 --> 00:00:00.400 line:68.67% position:10.00% align:start\n'
+                         'HI\nTHERE\n\n')
+
+    def test_decode_json_lines(self):
+        events = [json.loads(line) for line in self.decode_pop_on(decode_captions_to_json_lines).splitlines()]
+        self.assertEqual([event['frame'] for event in events], [10, 12])
+        self.assertEqual(events[0]['lines'], [{'row': 12, 'column': 4, 'text': 'HI'},
+                                              {'row': 15, 'column': 0, 'text': 'THERE'}])
+        self.assertEqual(events[0]['channel'], 'CC1')
+        self.assertEqual(events[1]['lines'], [])
+
+
+class OnRow(object):
+    """ An h=1 mock image moved to a row of a three row image, the others blank """
+    def __init__(self, image, row):
+        self.image = image
+        self.row = row
+        self.width = image.width
+        self.height = 3
+
+    def get_pixel_luma(self, x, y):
+        return self.image.get_pixel_luma(x, 0) if y == self.row else 0
+
+    def unlink(self):
+        pass
+
+
+class TestCheckpoint(TestCase):
+    def pop_on_sequence(self):
+        values = []
+        for caption in ['HELLO', 'THERE', 'WORLD']:
+            values += [[0x14, 0x20], [0x14, 0x20]]
+            values += [[ord(a), ord(b)] for a, b in zip(caption[::2], caption[1::2] + ' ')]
+            values += [[0x14, 0x2c], [0x14, 0x2c], [0x14, 0x2f], [0x14, 0x2f]] + [[0, 0]] * 5
+        values += [[0x14, 0x20], [0x14, 0x20], [0x14, 0x2c], [0x14, 0x2c]]
+        return [MockImageWithBytes(val1, val2, h=1) for val1, val2 in values]
+
+    def run_decoder(self, image_list, output, checkpoint=None):
+        with contextlib.redirect_stdout(output):
+            decode_image_list_to_srt(image_list, checkpoint=checkpoint)
+
+    def test_resume_matches_uninterrupted_run(self):
+        # Captions go for 16 frames (46-61), so rows are searched for less and less often, and come back on
+        # another row in the middle of a frame search interval - the checkpoint is saved in the interval before
+        pairs = [(0, 0)] * 6 + [(0x14, 0x20)] * 2 + [(0x41, 0x47), (0x41, 0x49), (0x4e, 0x20)] + [(0x14, 0x2f)] * 2
+        images = (self.pop_on_sequence() + [MockImage(0, h=1)] * 16 +
+                  [MockImageWithBytes(b1, b2, h=1) for b1, b2 in pairs])
+        images = [OnRow(image, 1 if i >= 62 else 0) for i, image in enumerate(images)]
+        reset_row_lock()
+        uninterrupted = io.StringIO()
+        self.run_decoder(images, uninterrupted)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'decode.checkpoint')
+            interrupted = io.StringIO()
+            reset_row_lock()
+            self.run_decoder(images[:58], interrupted, DecodeCheckpoint(path, interval=4, output=interrupted))
+
+            reset_row_lock()  # As a fresh process would be
+            checkpoint = DecodeCheckpoint(path, interval=4)
+            self.assertIsNotNone(checkpoint.load())
+            self.assertEqual(checkpoint.frame, 56)
+            resumed = io.StringIO(interrupted.getvalue()[:checkpoint.output_offset])
+            resumed.seek(0, io.SEEK_END)
+            checkpoint.output = resumed
+            self.run_decoder(images[checkpoint.frame:], resumed, checkpoint)
+
+        self.assertEqual(resumed.getvalue(), uninterrupted.getvalue())
+        self.assertIn('WORLD', uninterrupted.getvalue())
+
+    def test_restore_wrong_decoder(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            checkpoint = DecodeCheckpoint(os.path.join(tempdir, 'decode.checkpoint'))
+            checkpoint.save('scc', 10)
+            self.assertRaises(RuntimeError, checkpoint.restore, 'srt')
+            checkpoint.remove()
+            self.assertFalse(os.path.exists(checkpoint.path))
+
+
+class TestBitClock(TestCase):
+    def setUp(self):
+        reset_row_lock()
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def test_locks_to_offset(self):
+        for _ in range(5):
+            self.assertEqual(find_and_decode_row(DriftingMockImage(0x14, 0x2c, phase=9.3)), (0x14, 0x2c))
+        self.assertAlmostEqual(lib.cc_decode.lastPreambleOffset, 9.3, delta=0.5)
+
+    def test_follows_drift(self):
+        # 4% stretched, drifting half a pixel a frame - a fixed 27 pixel pitch misreads the later bits
+        self.assertNotEqual(decode_row(DriftingMockImage(0x5a, 0x3c, phase=-5, pitch=28.1), row_number=0),
+                            (0x5a, 0x3c))
+        for frame in range(50):
+            image = DriftingMockImage(0x5a, 0x3c, phase=-5 + frame * 0.5, pitch=28.1)
+            self.assertEqual(find_and_decode_row(image), (0x5a, 0x3c), 'frame %d' % frame)
+        self.assertAlmostEqual(lib.cc_decode.lastBitPitch, 28.1, delta=0.3)
+        self.assertAlmostEqual(lib.cc_decode.lastPreambleOffset, 19.5, delta=1)
+
+    def test_checkpoint_keeps_pitch(self):
+        for _ in range(10):
+            find_and_decode_row(DriftingMockImage(0x14, 0x2c, pitch=26))
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        checkpoint = DecodeCheckpoint(path)
+        checkpoint.save('raw', 10)
+        pitch = lib.cc_decode.lastBitPitch
+        reset_row_lock()
+        checkpoint.load()
+        os.unlink(path)
+        self.assertEqual(lib.cc_decode.lastBitPitch, pitch)
+        self.assertNotEqual(pitch, BIT_PITCH)
+
+
+class CountingMockImage(MockImage):
+    reads = 0
+
+    def get_pixel_luma(self, x, y):
+        CountingMockImage.reads += 1
+        return self.val
+
+
+class TestRowSearchBackOff(TestCase):
+    def setUp(self):
+        reset_row_lock()
+        CountingMockImage.reads = 0
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def blank_frame_reads(self, frames):
+        CountingMockImage.reads = 0
+        for _ in range(frames):
+            self.assertEqual(find_and_decode_row(CountingMockImage(0, h=20)), (None, None))
+        return CountingMockImage.reads
+
+    def test_backs_off_while_absent(self):
+        backed_off = self.blank_frame_reads(160)
+        reset_row_lock()
+        max_interval, lib.cc_decode.ROW_SEARCH_MAX_INTERVAL = lib.cc_decode.ROW_SEARCH_MAX_INTERVAL, 1
+        try:
+            every_frame = self.blank_frame_reads(160)
+        finally:
+            lib.cc_decode.ROW_SEARCH_MAX_INTERVAL = max_interval
+        self.assertLess(backed_off * 4, every_frame)
+
+    def test_relocks_on_last_row_immediately(self):
+        find_and_decode_row(MockImageWithBytes(0x14, 0x2c, h=1))
+        self.blank_frame_reads(100)
+        self.assertEqual(find_and_decode_row(MockImageWithBytes(0x14, 0x2c, h=1)), (0x14, 0x2c))
+
+    def test_finds_new_row_within_interval(self):
+        class MovedImage(MockImageWithBytes):
+            def get_pixel_luma(self, x, y):
+                return super().get_pixel_luma(x, 0) if y == 5 else 0
+
+        self.blank_frame_reads(100)
+        found = [find_and_decode_row(MovedImage(0x14, 0x2c, h=20)) for _ in range(16)]
+        self.assertIn((0x14, 0x2c), found)
+        self.assertEqual(found[-1], (0x14, 0x2c))  # Locked on from then on
+        self.assertEqual(lib.cc_decode.lastRowFound, 5)
+
+
+class TestFrameWidths(TestCase):
+    def setUp(self):
+        reset_row_lock()
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def test_any_width(self):
+        for width in (1920, 1440, 960, 704, 640, 352):
+            reset_row_lock()
+            for phase in (0, 6.5):
+                image = ScaledMockImage(DriftingMockImage(0x5a, 0x3c, phase=phase), width)
+                self.assertEqual(find_and_decode_row(image), (0x5a, 0x3c), 'width %d phase %s' % (width, phase))
+
+    def test_width_change_mid_stream(self):
+        self.assertEqual(find_and_decode_row(DriftingMockImage(0x14, 0x2c, phase=3)), (0x14, 0x2c))
+        image = ScaledMockImage(DriftingMockImage(0x14, 0x2f, phase=3), 1280)
+        self.assertEqual(find_and_decode_row(image), (0x14, 0x2f))
+
+
+class RowMockImage(MockImage):
+    """ Serves rows of another mock image as bytes, counting any per-pixel reads """
+    def __init__(self, image):
+        super().__init__(None, h=image.height, w=image.width)
+        self.image = image
+        self.pixel_reads = 0
+
+    def get_row(self, y):
+        return bytes(min(255, max(0, int(round(self.image.get_pixel_luma(x, y))))) for x in range(self.width))
+
+    def get_pixel_luma(self, x, y):
+        self.pixel_reads += 1
+        return self.image.get_pixel_luma(x, y)
+
+
+class TestRowFastPath(TestCase):
+    def setUp(self):
+        reset_row_lock()
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def test_row_matches_pixels(self):
+        for val1, val2 in ((0x14, 0x2c), (0x5a, 0x3c), (0x00, 0x7f)):
+            for image in (MockImageWithBytes(val1, val2, h=1), DriftingMockImage(val1, val2, phase=4.5)):
+                reset_row_lock()
+                expected = find_and_decode_row(image)
+                reset_row_lock()
+                row_image = RowMockImage(image)
+                self.assertEqual(find_and_decode_row(row_image), expected)
+                self.assertEqual(decode_byte(row_image, BYTE1_LOCATIONS, 3, 0), decode_byte(image, BYTE1_LOCATIONS, 3, 0))
+
+    def test_no_pixel_reads(self):
+        image = RowMockImage(MockImageWithBytes(0x14, 0x2c, h=1))
+        self.assertEqual(find_and_decode_row(image), (0x14, 0x2c))
+        self.assertEqual(find_and_decode_row(image), (0x14, 0x2c))
+        self.assertEqual(image.pixel_reads, 0)
+
+    def test_any_width(self):
+        for width in (1920, 704, 352):
+            reset_row_lock()
+            image = RowMockImage(ScaledMockImage(DriftingMockImage(0x5a, 0x3c, phase=2), width))
+            self.assertEqual(find_and_decode_row(image), (0x5a, 0x3c), 'width %d' % width)
+
+
+class TestDemux(TestCase):
+    def setUp(self):
+        reset_row_lock()
+
+    def test_channels(self):
+        pairs = [(0x14, 0x20), (0x41, 0x42), (0x1c, 0x20), (0x43, 0x44), (0x01, 0x03), (0x41, 0x41), (0x14, 0x2f),
+                 (0, 0)]
+        images = [MockImageWithBytes(b1, b2, h=1) for b1, b2 in pairs] + [MockImage(0, h=1)]
+        frames, channels = demux_caption_channels(images)
+        self.assertEqual(channels, [1, 2])
+        self.assertEqual([channel for _, _, channel in frames], [1, 1, 2, 2, None, None, 1, None, None])
+        self.assertEqual([frame.caption_bytes for frame in channel_frames(frames, 2)],
+                         [(0, 0), (0, 0), (0x1c, 0x20), (0x43, 0x44), (0, 0), (0, 0), (0, 0), (0, 0), (None, None)])
+        self.assertEqual(extract_closed_caption_bytes(next(channel_frames(frames, 1))), ('CC1 Resume Caption Loading',
+                                                                                         True, 0x14, 0x20))
+
+    def test_second_field_channels_refused(self):
+        images = [MockImageWithBytes(0x14, 0x20, h=1)]
+        self.assertEqual([caption.text for caption in iter_captions(images, ccfilter=2)], [])
+        for ccfilter in (3, 4):
+            with self.assertRaises(ValueError):  # Not quietly decoded as CC1 and CC2
+                list(iter_captions(images, ccfilter=ccfilter))
+
+
+class TestPreroll(TestCase):
+    def setUp(self):
+        reset_row_lock()
+        padding = [(0, 0)] * 5
+        # A shows at frame 3, B is loaded at frames 10-12 and replaces it at 20, cleared at 30
+        self.pairs = (caption_pairs((0x14, 0x20), 'AA', (0x14, 0x2f)) + padding + caption_pairs((0x14, 0x20), 'BB') +
+                      padding + [(0, 0)] * 2 + caption_pairs((0x14, 0x2f)) + padding + [(0, 0)] * 3 +
+                      caption_pairs((0x14, 0x2c)) + padding)
+
+    def captions(self, first_frame=0, preroll=0):
+        images = [DecodedFrame(b1, b2) for b1, b2 in self.pairs[first_frame:]]
+        return [(caption.text, caption.start_frame, caption.end_frame)
+                for caption in iter_captions(images, first_frame=first_frame, preroll=preroll)]
+
+    def test_whole(self):
+        self.assertEqual(self.captions(), [('AA', 3, 20), ('BB', 20, 30)])
+
+    def test_loaded_in_preroll(self):
+        self.assertEqual(self.captions(first_frame=15), [])  # Without a preroll, BB was never loaded
+        self.assertEqual(self.captions(first_frame=8, preroll=7), [('BB', 20, 30)])
+
+    def test_showing_at_start(self):
+        self.assertEqual(self.captions(first_frame=0, preroll=15), [('AA', 15, 20), ('BB', 20, 30)])
+
+    def test_nothing_written_for_preroll(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decode_image_list_to_srt([DecodedFrame(b1, b2) for b1, b2 in self.pairs], preroll=15)
+        # AA is clipped to the end of the preroll, times stay those of the whole video
+        self.assertEqual(output.getvalue(), '1\n00:00:00,500 --> 00:00:00,667\nAA\n\n'
+                                            '2\n00:00:00,667 --> 00:00:01,001\nBB\n\n')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decode_captions_to_scc([DecodedFrame(b1, b2) for b1, b2 in self.pairs], preroll=21)
+        # Only B, which was loaded during the preroll and shown after it
+        self.assertEqual(output.getvalue().count('942f 942f'), 1)
+        self.assertIn('9420 9420 c2c2', output.getvalue())
+
+    def test_bytes_numbered_from_start(self):
+        images = [DecodedFrame(b1, b2) for b1, b2 in self.pairs[8:]]
+        pairs = list(iter_caption_bytes(images, first_frame=8, preroll=7))
+        self.assertEqual(pairs[0].frame, 15)
+
+
+def telecine(pairs):
+    """ Frames for pairs as 3:2 pulldown of film turns out, every fourth frame shown twice """
+    frames = []
+    for i, pair in enumerate(pairs):
+        frames += [pair, pair] if i % 4 == 3 else [pair]
+    return frames
+
+
+class TestPulldown(TestCase):
+    def setUp(self):
+        reset_row_lock()
+        self.pairs = caption_pairs((0x14, 0x20), 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789abcdefghij', (0x14, 0x2f))
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def read(self, pairs, **kwargs):
+        images = skip_pulldown_repeats([RowMockImage(MockImageWithBytes(b1, b2, h=1)) for b1, b2 in pairs], **kwargs)
+        frames = [(isinstance(image, RepeatedFrame), extract_closed_caption_bytes(image, drop_repeats=False)[2:])
+                  for image in images]
+        return [repeat for repeat, _ in frames], [pair for _, pair in frames]
+
+    def padded(self, frames, repeats):
+        """ What is read of frames, the repeats being padding """
+        return [(0, 0) if repeat else pair for pair, repeat in zip(frames, repeats)]
+
+    def test_skips_on_cadence(self):
+        frames = telecine(self.pairs)
+        repeats, read = self.read(frames)
+        self.assertEqual([i for i, repeat in enumerate(repeats) if repeat], [19, 24, 29])  # After 3 cycles of 5
+        self.assertEqual(read, self.padded(frames, repeats))  # Sent once, so read once
+        self.assertNotEqual(frames[19], (0, 0))
+        self.assertEqual(lib.cc_decode.decodeStats.repeated_frames, 3)
+        self.assertEqual(lib.cc_decode.decodeStats.locked_frames, len(frames))
+
+    def test_cadence_broken(self):
+        frames = telecine(self.pairs)
+        frames[24:25] = [(0x41, 0x41)]  # The cut of a film edit, not a duplicate
+        repeats, read = self.read(frames)
+        self.assertEqual(read, self.padded(frames, repeats))
+        self.assertEqual([i for i, repeat in enumerate(repeats) if repeat], [19])
+
+    def test_still(self):
+        # Every frame repeats, so every point of the cycle locks on after 3 cycles
+        frames = self.pairs + [(0x14, 0x2c)] * 20
+        repeats, read = self.read(frames)
+        self.assertEqual(read, self.padded(frames, repeats))
+        self.assertEqual(repeats.count(True), 5)
+
+    def test_no_rows(self):
+        for image in skip_pulldown_repeats([MockImageWithBytes(b1, b2, h=1) for b1, b2 in telecine(self.pairs)]):
+            self.assertNotIsInstance(image, RepeatedFrame)
+            extract_closed_caption_bytes(image)
+
+
+class TestParity(TestCase):
+    def setUp(self):
+        reset_row_lock()
+
+    def tearDown(self):
+        reset_row_lock()
+
+    def extract(self, pairs, **kwargs):
+        return [extract_closed_caption_bytes(MockImageWithBytes(b1, b2, h=1), **kwargs) for b1, b2 in pairs]
+
+    def test_control_code_failing_parity_dropped(self):
+        # 0xaf is 0x2f with the wrong parity bit, the copy sent in the next frame is used instead
+        first, second = self.extract([(0x14, 0xaf), (0x14, 0x2f)])
+        self.assertEqual(first, ('', False, 0, 0))
+        self.assertEqual(second, ('CC1 End of Caption (flip memory)', True, 0x14, 0x2f))
+        self.assertEqual(lib.cc_decode.lastParityErrors, (False, False))
+        self.assertEqual((lib.cc_decode.decodeStats.parity_errors, lib.cc_decode.decodeStats.captions), (1, 1))
+
+    def test_character_failing_parity_shown_as_block(self):
+        self.assertEqual(self.extract([(0xc3, 0x41)]), [('■A', False, 0x7f, 0x41)])  # 0xc3 is a C failing parity
+        self.assertEqual(lib.cc_decode.lastParityErrors, (True, False))
+
+    def test_repeated_control_code_dropped(self):
+        pairs = [(0x14, 0x2f)] * 3 + [(0x41, 0x42), (0x14, 0x2f)]
+        eoc = ('CC1 End of Caption (flip memory)', True, 0x14, 0x2f)
+        self.assertEqual(self.extract(pairs), [eoc, ('', False, 0, 0), ('', False, 0, 0), ('AB', False, 0x41, 0x42),
+                                               eoc])
+        self.assertEqual(lib.cc_decode.decodeStats.captions, 2)
+        reset_row_lock()
+        self.assertEqual(self.extract(pairs, drop_repeats=False)[:3], [eoc] * 3)
+
+    def test_tripled_control_codes(self):
+        # A duplicated frame turns the two copies of each control code into three, the third isn't a new code
+        pairs = ([(0x14, 0x20)] * 2 + [(0x41, 0x42)] + [(0x14, 0x2f)] * 3 + [(0, 0)] * 20 + [(0x14, 0x20)] * 2 +
+                 [(0x43, 0x44)] + [(0x14, 0x2c)] * 3 + [(0x14, 0x2f)] * 2 + [(0, 0)] * 20 + [(0x14, 0x2c)] * 2)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decode_image_list_to_srt([MockImageWithBytes(b1, b2, h=1) for b1, b2 in pairs], delete_image_after=False)
+        self.assertEqual(output.getvalue().split('\n\n')[:2],
+                         ['1\n00:00:00,100 --> 00:00:00,967\nAB', '2\n00:00:01,067 --> 00:00:01,801\nCD'])
+
+    def test_scc_ends_sequence_on_repeat(self):
+        pairs = [(0x14, 0x20)] * 2 + [(0x41, 0x42)] + [(0x14, 0x2f)] * 3 + [(0x14, 0x2c), (0x41, 0x41), (0x14, 0x2c)]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            decode_captions_to_scc([MockImageWithBytes(b1, b2, h=1) for b1, b2 in pairs], delete_image_after=False)
+        # The third EOC is dropped rather than starting a sequence. An EDM without its copy ends one anyway
+        self.assertEqual(output.getvalue().splitlines()[2:], ['00:00:00;00\t9420 9420 c1c2 942f 942f ',
+                                                              '00:00:00;06\t942c ', '00:00:00;07\tc1c1 942c '])
+
+    def test_filter(self):
+        repeats = RepeatedControlFilter()
+        self.assertEqual([repeats.is_repeat(b1, b2) for b1, b2 in [(0x14, 0x20), (0x14, 0x20), (0x14, 0x20),
+                                                                   (0, 0), (0x14, 0x20), (0x14, 0x2c), (0x41, 0x41),
+                                                                   (0x14, 0x2c)]],
+                         [False, True, True, False, True, False, False, False])
+
+    def test_caption_bytes_flag_errors(self):
+        images = [MockImageWithBytes(b1, b2, h=1) for b1, b2 in [(0x14, 0x2f), (0x14, 0x2f), (0xc3, 0x41)]]
+        found = [(item.byte1, item.byte2, item.parity_error) for item in iter_caption_bytes(images,
+                                                                                        delete_image_after=False)]
+        self.assertEqual(found, [(0x14, 0x2f, False), (0x14, 0x2f, False), (0x7f, 0x41, True)])
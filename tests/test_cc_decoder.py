@@ -0,0 +1,375 @@
+import atexit
+import contextlib
+import io
+import json
+import os
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock, skipIf
+from cc_decoder import decode_file, ClosedCaptionFileDecoder
+import lib.cc_decode
+from lib.cc_decode import Caption, CaptionBytes, CaptionEvent, POP_ON
+from tests.test_cc_decode import caption_pairs, telecine
+from lib.cc_frames import FollowedFile
+from tests.test_cc_frames import render_cc_row
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SECONDS_BUDGET = 0.5  # Typically well under 0.1, even without cached bytecode
+
+
+def write_y4m(pairs, width=720, height=2):
+    """ A YUV4MPEG2 file with a frame carrying each of the passed byte pairs on its top row """
+    handle, path = tempfile.mkstemp(suffix='.y4m')
+    with os.fdopen(handle, 'wb') as f:
+        f.write(b'YUV4MPEG2 W%d H%d F30000:1001 Ip A0:0 Cmono\n' % (width, height))
+        for byte1, byte2 in pairs:
+            f.write(b'FRAME\n' + render_cc_row(byte1, byte2, width) + bytes([16] * width * (height - 1)))
+    return path
+
+
+class TestDecodeFile(TestCase):
+    def setUp(self):
+        self.path = write_y4m(caption_pairs((0x14, 0x20), 'HI', (0x14, 0x2f), (0x80, 0x80), (0x14, 0x2c)) +
+                              [(0x80, 0x80)] * 3)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_import_has_no_side_effects(self):
+        result = subprocess.run([sys.executable, '-c', 'import cc_decoder'], cwd=ROOT, capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout, b'')
+        self.assertEqual(result.stderr, b'')
+
+    def test_import_is_quick(self):
+        # Batches start the decoder thousands of times on short clips, so startup matters. What only some runs need
+        # is imported when it is needed
+        code = ('import sys, time\nstarted = time.perf_counter()\nimport cc_decoder\n'
+                'print(time.perf_counter() - started)\nprint(" ".join(sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, check=True)
+        seconds, modules = result.stdout.decode('utf-8').splitlines()
+        self.assertEqual(set(modules.split()) & {'PIL', 'argparse', 'subprocess', 'json', 'http.server',
+                                                 'multiprocessing', 'concurrent.futures', 'ctypes', 'lib.cc_jobs',
+                                                 'lib.cc_bench'}, set())
+        self.assertLess(float(seconds), IMPORT_SECONDS_BUDGET)
+
+    def test_captions(self):
+        captions = list(decode_file(self.path, lines=2))
+        self.assertEqual(len(captions), 1)
+        caption = captions[0]
+        self.assertIsInstance(caption, Caption)
+        self.assertEqual((caption.index, caption.channel, caption.text), (1, 'CC1', 'HI'))
+        self.assertEqual((caption.start_frame, caption.end_frame), (3, 7))
+        self.assertAlmostEqual(caption.start_time, 3 * 1001 / 30000)
+
+    def test_events(self):
+        events = list(decode_file(self.path, format='events', lines=2))
+        self.assertTrue(all(isinstance(event, CaptionEvent) for event in events))
+        self.assertEqual([(event.frame, event.mode, event.lines) for event in events],
+                         [(3, POP_ON, ((14, 0, 'HI'),)), (7, POP_ON, ())])
+
+    def test_bytes(self):
+        pairs = list(decode_file(self.path, format='bytes', lines=2))
+        self.assertTrue(all(isinstance(pair, CaptionBytes) for pair in pairs))
+        self.assertEqual([pair.frame for pair in pairs[:3]], [0, 1, 2])
+
+    def test_lazy_and_repeatable(self):
+        iterator = decode_file(self.path, lines=2)
+        self.assertFalse(isinstance(iterator, list))
+        for _ in range(3):  # Nothing left over from one call affects the next
+            self.assertEqual([caption.text for caption in decode_file(self.path, lines=2)], ['HI'])
+
+    def test_one_decode_at_a_time(self):
+        first = decode_file(self.path, format='bytes', lines=2)
+        next(first)
+        second = decode_file(self.path, lines=2)
+        with self.assertRaises(RuntimeError):  # Would have reset the first's row lock and stats part way through
+            next(second)
+        with self.assertRaises(RuntimeError):
+            ClosedCaptionFileDecoder(lines=2, output_path=os.devnull).decode(self.path)
+        first.close()
+        self.assertEqual([caption.text for caption in decode_file(self.path, lines=2)], ['HI'])
+
+    def test_unknown_format(self):
+        with self.assertRaises(RuntimeError):
+            ClosedCaptionFileDecoder().iter_decode(self.path, format='nope')
+
+    def test_part(self):
+        # Loaded before the part wanted and still showing at its start, so found by the preroll
+        captions = list(decode_file(self.path, lines=2, start=4, preroll=0.2))
+        self.assertEqual([(caption.text, caption.start_frame, caption.end_frame) for caption in captions],
+                         [('HI', 4, 7)])
+        captions = list(decode_file(self.path, lines=2, start='0:00.1', end=5, preroll=0))
+        self.assertEqual(captions, [])
+        with self.assertRaises(RuntimeError):
+            list(decode_file(self.path, lines=2, start=6, end=5))
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            metrics_path = os.path.join(tempdir, 'metrics.json')
+            decoder = ClosedCaptionFileDecoder(lines=2, output_path=os.path.join(tempdir, 'out.srt'),
+                                               metrics_path=metrics_path)
+            decoder.decode(self.path)
+            with open(metrics_path) as f:
+                metrics = json.load(f)
+        self.assertEqual((metrics['frames_decoded'], metrics['frames_total'], metrics['captions'], metrics['done']),
+                         (12, 12, 1, True))
+        self.assertEqual(metrics['lock_ratio'], 1.0)
+
+
+class TestPulldown(TestCase):
+    def test_same_captions(self):
+        path = write_y4m(telecine(caption_pairs((0x14, 0x20), 'FILM SOURCED CAPTIONS, FROM A LASERDISC',
+                                                (0x14, 0x2f))) + [(0x80, 0x80)] * 30 + [(0x14, 0x2c)] * 2)
+        self.addCleanup(os.unlink, path)
+        outputs = []
+        with tempfile.TemporaryDirectory() as tempdir:
+            for ccformat in ('srt', 'scc'):
+                for skip_pulldown in (False, True):
+                    output = os.path.join(tempdir, 'out.' + ccformat)
+                    ClosedCaptionFileDecoder(ccformat=ccformat, lines=2, output_path=output,
+                                             skip_pulldown=skip_pulldown).decode(path)
+                    with open(output) as f:
+                        outputs.append(f.read())
+                    outputs.append(lib.cc_decode.decodeStats.repeated_frames)
+        self.assertEqual(outputs[0], outputs[2])
+        self.assertEqual(outputs[1], 0)
+        self.assertGreater(outputs[3], 4)  # Pulldown repeats in the captions, and of the padding after
+        self.assertIn('4649', outputs[6])  # FI
+        # Once the cadence is locked on, a pair shown on two frames is only read once
+        self.assertIn('cd20 cd20', outputs[4])
+        self.assertNotIn('cd20 cd20', outputs[6])
+        self.assertEqual(outputs[6].count('942c'), 1)  # The EDM's copy was a pulldown repeat, the EDM still ends
+
+
+class TestDemux(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        pairs = caption_pairs((0x14, 0x20), 'HI', (0x1c, 0x20), 'HOLA', (0x14, 0x2f), (0x1c, 0x2f), (0x80, 0x80),
+                              (0x14, 0x2c), (0x1c, 0x2c)) + [(0x80, 0x80)] * 3
+        self.path = write_y4m(pairs)
+        self.addCleanup(os.unlink, self.path)
+
+    def decode(self, ccformat):
+        output = os.path.join(self.tempdir.name, 'bilingual' + {'scc': '.scc'}.get(ccformat, '.srt'))
+        decoder = ClosedCaptionFileDecoder(ccformat=ccformat, lines=2, output_path=output, demux=True)
+        paths = decoder.decode(self.path)
+        contents = []
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                contents.append(f.read())
+        return [os.path.basename(path) for path in paths], contents
+
+    def test_srt(self):
+        names, (cc1, cc2) = self.decode('srt')
+        self.assertEqual(names, ['bilingual.cc1.srt', 'bilingual.cc2.srt'])
+        self.assertIn('HI', cc1)
+        self.assertNotIn('HOLA', cc1)
+        self.assertIn('HOLA', cc2)
+        self.assertNotIn('HI\n', cc2)
+        for ccfilter, demuxed in ((1, cc1), (2, cc2)):  # Just as decoding each channel separately would
+            output = os.path.join(self.tempdir.name, 'filtered.srt')
+            ClosedCaptionFileDecoder(lines=2, output_path=output, ccfilter=ccfilter).decode(self.path)
+            with open(output, encoding='utf-8') as f:
+                self.assertEqual(f.read(), demuxed)
+
+    def test_every_format(self):
+        for ccformat in sorted(ClosedCaptionFileDecoder.DECODERS):
+            if ccformat == 'xds':
+                with self.assertRaises(RuntimeError):
+                    self.decode(ccformat)
+                continue
+            names, (cc1, cc2) = self.decode(ccformat)
+            self.assertEqual(len(names), 2, ccformat)
+            self.assertNotEqual(cc1, cc2, ccformat)
+
+    def test_scc(self):
+        _, (cc1, cc2) = self.decode('scc')
+        self.assertIn('9420', cc1)
+        self.assertNotIn('1c20', cc1)
+        self.assertIn('1c20', cc2)
+        self.assertNotIn('9420', cc2)
+
+    def test_named_after_video(self):
+        decoder = ClosedCaptionFileDecoder(lines=2, demux=True)
+        paths = decoder.decode(self.path)
+        for path in paths:
+            self.addCleanup(os.unlink, path)
+        self.assertEqual(paths, [os.path.splitext(self.path)[0] + ending for ending in ('.cc1.srt', '.cc2.srt')])
+
+
+class TestSeveralOutputs(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        pairs = caption_pairs((0x14, 0x20), 'HI', (0x1c, 0x20), 'HOLA', (0x14, 0x2f), (0x1c, 0x2f), (0x80, 0x80),
+                              (0x14, 0x2c), (0x1c, 0x2c)) + [(0x80, 0x80)] * 3
+        self.path = write_y4m(pairs)
+        self.addCleanup(os.unlink, self.path)
+
+    def read(self, path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+    def test_same_as_separate_decodes(self):
+        output = os.path.join(self.tempdir.name, 'both.srt')
+        metrics_path = os.path.join(self.tempdir.name, 'metrics.json')
+        paths = ClosedCaptionFileDecoder(ccformat='srt:1,srt:2,scc,xds', lines=2, output_path=output,
+                                         metrics_path=metrics_path, ring_frames=4).decode(self.path)
+        self.assertEqual([os.path.basename(path) for path in paths], ['both.cc1.srt', 'both.cc2.srt', 'both.scc',
+                                                                       'both.txt'])
+        for path, (ccformat, ccfilter) in zip(paths, [('srt', 1), ('srt', 2), ('scc', 0), ('xds', 0)]):
+            separate = os.path.join(self.tempdir.name, 'separate')
+            ClosedCaptionFileDecoder(ccformat=ccformat, ccfilter=ccfilter, lines=2,
+                                     output_path=separate).decode(self.path)
+            self.assertEqual(self.read(path), self.read(separate), ccformat)
+        self.assertIn('HOLA', self.read(paths[1]))
+        metrics = json.loads(self.read(metrics_path))  # Reported by the first output
+        self.assertEqual((metrics['frames_decoded'], metrics['captions'], metrics['done']), (20, 2, True))
+
+    def test_bad_outputs(self):
+        for ccformat in ('srt,nope', 'scc:1,srt', 'srt:5,scc', 'srt:3', 'webvtt:4', 'srt:x', 'srt,srtroll'):
+            with self.assertRaises(RuntimeError, msg=ccformat):
+                ClosedCaptionFileDecoder(ccformat=ccformat, lines=2,
+                                         output_path=os.path.join(self.tempdir.name, 'out.srt')).decode(self.path)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+
+class TestFollow(TestCase):
+    def test_growing_y4m(self):
+        pairs = caption_pairs((0x14, 0x20), 'HI', (0x14, 0x2f), (0x80, 0x80), (0x14, 0x2c)) + [(0x80, 0x80)] * 3
+        complete = write_y4m(pairs)
+        self.addCleanup(os.unlink, complete)
+        with open(complete, 'rb') as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'recording.y4m')
+            output_path = os.path.join(tempdir, 'recording.srt')
+            with open(path, 'wb') as f:
+                f.write(data[:100])  # Part way through the header
+
+            def record():
+                for start in range(100, len(data), 1000):
+                    time.sleep(0.01)
+                    with open(path, 'ab') as f:
+                        f.write(data[start:start + 1000])
+            recorder = threading.Thread(target=record)
+            recorder.start()
+            decoder = ClosedCaptionFileDecoder(lines=2, output_path=output_path, follow=True, follow_idle=0.5)
+            decoder.decode(path)
+            recorder.join()
+            with open(output_path) as f:
+                followed = f.read()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            ClosedCaptionFileDecoder(lines=2).decode(complete)
+        self.assertIn('HI', followed)
+        self.assertEqual(followed, output.getvalue())
+        self.assertIsNone(decoder.count_frames(path))
+
+
+class FakeFrame(object):
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def unlink(self):
+        os.unlink(self.file_name)
+
+
+@skipIf(os.name == 'nt', 'Fake ffmpeg is a shell script')
+class TestFfmpegPipeline(TestCase):
+    def fake_ffmpeg(self, script):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(path, stat.S_IRWXU)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_frames(self):
+        args = tempfile.mktemp()
+        self.addCleanup(lambda: os.path.exists(args) and os.unlink(args))
+        ffmpeg = self.fake_ffmpeg('echo "$@" > %s\nfor out; do :; done\n'
+                                  'for i in 1 2 3; do echo x > "$(printf "$out" $i)"; done\n' % args)
+        decoder = ClosedCaptionFileDecoder(ffmpeg_path=ffmpeg, temp_path=tempfile.gettempdir(),
+                                           ffmpeg_profile='h264')
+        with mock.patch.object(atexit, 'register', wraps=atexit.register) as register, \
+                mock.patch.object(atexit, 'unregister', wraps=atexit.unregister) as unregister:
+            for _ in range(3):
+                frames = list(decoder.stream_decode_file_list("it's a.mpg", image_wrapper=FakeFrame))
+                self.assertEqual(len(frames), 3)
+                self.assertFalse(os.path.exists(os.path.dirname(frames[0].file_name)))  # Cleaned up
+            # Exit handlers don't pile up
+            self.assertEqual(register.call_args_list, [mock.call(decoder._cleanup)] * 3)
+            self.assertEqual(unregister.call_args_list, register.call_args_list)
+        with open(args) as f:
+            args = f.read()
+        self.assertIn("-skip_loop_filter all -i it's a.mpg -map 0:v:0 -an -sn -dn", args)
+        self.assertIn('-vf crop=iw:5:0:0 ', args)  # Just the caption lines, never rescaled
+
+    def test_followed_input_is_piped(self):
+        received = tempfile.mktemp()
+        self.addCleanup(lambda: os.path.exists(received) and os.unlink(received))
+        ffmpeg = self.fake_ffmpeg('cat > %s\nfor out; do :; done\necho x > "$(printf "$out" 1)"\n' % received)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'recording.ts')
+            with open(path, 'wb') as f:
+                f.write(b'recorded')
+            decoder = ClosedCaptionFileDecoder(ffmpeg_path=ffmpeg, temp_path=tempfile.gettempdir())
+            with FollowedFile(path, idle_seconds=0.2) as followed:
+                frames = list(decoder.stream_decode_file_list(path, image_wrapper=FakeFrame, input_stream=followed))
+        self.assertEqual(len(frames), 1)
+        with open(received, 'rb') as f:
+            self.assertEqual(f.read(), b'recorded')
+
+    def test_no_ffmpeg(self):
+        with mock.patch('cc_decoder.FFMPEG_LOC', {}), mock.patch.dict(os.environ, {'PATH': ''}):
+            decoder = ClosedCaptionFileDecoder()
+        self.assertIsNone(decoder.ffmpeg_path)
+        with self.assertRaises(RuntimeError) as raised:
+            list(decoder.stream_decode_file_list('in.mpg', image_wrapper=FakeFrame))
+        self.assertIn('--ffmpeg', str(raised.exception))
+        self.assertIsNone(decoder.count_frames('in.mpg'))
+
+    def test_failure_is_raised(self):
+        ffmpeg = self.fake_ffmpeg('echo "No such file or directory" >&2\nexit 1\n')
+        decoder = ClosedCaptionFileDecoder(ffmpeg_path=ffmpeg, temp_path=tempfile.gettempdir())
+        with self.assertRaises(RuntimeError) as raised:
+            list(decoder.stream_decode_file_list('missing.mpg', image_wrapper=FakeFrame))
+        self.assertIn('No such file', str(raised.exception))
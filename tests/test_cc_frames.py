@@ -0,0 +1,427 @@
+import io
+import json
+import os
+import signal
+import stat
+import tempfile
+import threading
+import time
+from random import random
+from unittest import TestCase, skipIf
+from lib.cc_frames import DirectoryWatcher, BacklogThrottle, prefetch, read_y4m_frames, read_raw_luma_frames, \
+    parse_y4m_header, STUDIO_TO_FULL_RANGE, FfmpegProfile, ffmpeg_profile, ProgressMeter, prometheus_metrics, \
+    probe_video, ffprobe_path, count_y4m_frames, FollowedFile, position_to_frame
+from lib.cc_decode import DecodeStats
+from lib.cc_decode import decode_row, is_cc_present, BYTE1_LOCATIONS, BYTE2_LOCATIONS, SYNC_SIGNAL_LOCATIONS_HIGH, \
+    NO_PARITY_TO_ODD_PARITY
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+
+
+class MockProcess(object):
+    def __init__(self):
+        self.signals = []
+
+    def poll(self):
+        return None
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+
+
+class TestDirectoryWatcher(TestCase):
+    def check_wakes_on_new_file(self, poll_interval):
+        with tempfile.TemporaryDirectory() as tempdir:
+            watcher = DirectoryWatcher(tempdir, poll_interval=poll_interval)
+            writer = threading.Timer(0.05, lambda: open(os.path.join(tempdir, 'frame.tif'), 'wb').close())
+            writer.start()
+            start = time.time()
+            while not os.path.exists(os.path.join(tempdir, 'frame.tif')):
+                watcher.wait(timeout=5)
+            self.assertLess(time.time() - start, 2)
+            writer.join()
+            watcher.close()
+
+    def test_wakes_on_new_file(self):
+        self.check_wakes_on_new_file(poll_interval=0.01)
+
+    def test_polling_fallback(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            watcher = DirectoryWatcher(tempdir, poll_interval=0.01)
+            watcher.close()  # No notifications - we should still return promptly
+            start = time.time()
+            watcher.wait(timeout=5)
+            self.assertLess(time.time() - start, 1)
+
+
+class TestFollowedFile(TestCase):
+    def write_later(self, writes, delay=0.05):
+        """ Append each (path, data) to its file, a short delay apart, on a thread """
+        def writer():
+            for path, data in writes:
+                time.sleep(delay)
+                with open(path, 'ab') as f:
+                    f.write(data)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_growing_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'capture.ts')
+            with open(path, 'wb') as f:
+                f.write(b'a')
+            self.write_later([(path, b'b'), (path, b'c'), (path, b'd')])
+            with FollowedFile(path, idle_seconds=0.5, poll_interval=0.02) as followed:
+                self.assertEqual(followed.read(), b'abcd')  # Only ends once the writes stop
+
+    def test_segments(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            def segment(number):
+                return os.path.join(tempdir, 'capture-%03d.ts' % number)
+            with open(segment(1), 'wb') as f:
+                f.write(b'1')
+            self.write_later([(segment(1), b'1'), (segment(2), b'2'), (segment(2), b'2'), (segment(3), b'3')])
+            with FollowedFile(os.path.join(tempdir, 'capture-*.ts'), idle_seconds=0.5, poll_interval=0.02) as followed:
+                self.assertEqual(followed.read(), b'11223')
+
+    def test_waits_for_file(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'capture.ts')
+            self.write_later([(path, b'late')], delay=0.1)
+            with FollowedFile(path, idle_seconds=0.5, poll_interval=0.02) as followed:
+                self.assertEqual(followed.read(), b'late')
+
+
+class TestBacklogThrottle(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def file_name(self, frame):
+        return os.path.join(self.tempdir.name, 'frame%07d.tif' % frame)
+
+    def write_frames(self, first, last, size=100):
+        for frame in range(first, last + 1):
+            with open(self.file_name(frame), 'wb') as f:
+                f.write(b'\0' * size)
+
+    def test_pause_and_resume(self):
+        if not hasattr(signal, 'SIGSTOP'):
+            self.skipTest('No SIGSTOP on this platform')
+        process = MockProcess()
+        throttle = BacklogThrottle(process, self.file_name, max_frames=10)
+        self.write_frames(1, 5)
+        throttle.update(1)
+        self.assertEqual(process.signals, [])
+        self.write_frames(6, 11)
+        throttle.update(1)
+        self.assertEqual(process.signals, [signal.SIGSTOP])
+        throttle.update(3)  # Still more than half the limit waiting
+        self.assertTrue(throttle.paused)
+        throttle.update(7)
+        self.assertEqual(process.signals, [signal.SIGSTOP, signal.SIGCONT])
+        self.assertFalse(throttle.paused)
+
+    def test_byte_limit(self):
+        if not hasattr(signal, 'SIGSTOP'):
+            self.skipTest('No SIGSTOP on this platform')
+        process = MockProcess()
+        throttle = BacklogThrottle(process, self.file_name, max_frames=0, max_bytes=400)
+        self.write_frames(1, 5)
+        throttle.update(1)
+        self.assertEqual(throttle.limit, 4)
+        self.assertEqual(process.signals, [signal.SIGSTOP])
+
+    def test_disabled(self):
+        process = MockProcess()
+        throttle = BacklogThrottle(process, self.file_name, max_frames=0, max_bytes=0)
+        self.write_frames(1, 5)
+        throttle.update(1)
+        self.assertEqual(process.signals, [])
+
+
+class TestPrefetch(TestCase):
+    def test_order_preserved(self):
+        def slow_loader(item):
+            time.sleep(random() * 0.01)
+            return item * 2
+        self.assertEqual(list(prefetch(range(50), slow_loader, depth=8)), [i * 2 for i in range(50)])
+
+    def test_no_prefetch(self):
+        loaded = []
+        frames = prefetch(range(5), lambda item: loaded.append(item) or item, depth=0)
+        self.assertEqual(next(frames), 0)
+        self.assertEqual(loaded, [0])
+        self.assertEqual(list(frames), [1, 2, 3, 4])
+
+    def test_reads_ahead(self):
+        loaded = []
+        frames = prefetch(range(20), lambda item: loaded.append(item) or item, depth=4)
+        self.assertEqual(next(frames), 0)
+        deadline = time.time() + 2
+        while len(loaded) < 5 and time.time() < deadline:  # Loads ahead happen without us asking
+            time.sleep(0.01)
+        self.assertEqual(sorted(loaded), [0, 1, 2, 3, 4])
+        frames.close()
+        self.assertLess(len(loaded), 20)
+
+
+def render_cc_row(byte1, byte2, width=720, high=200, low=16):
+    """ A row of studio swing luma carrying the run-in and the two passed bytes, with their odd parity bits """
+    row = bytearray([low] * width)
+    byte1, byte2 = NO_PARITY_TO_ODD_PARITY[byte1 & 0x7f], NO_PARITY_TO_ODD_PARITY[byte2 & 0x7f]
+    bits = [(loc, True) for loc in SYNC_SIGNAL_LOCATIONS_HIGH]
+    bits += [(loc, byte1 & (1 << i)) for i, loc in enumerate(BYTE1_LOCATIONS)]
+    bits += [(loc, byte2 & (1 << i)) for i, loc in enumerate(BYTE2_LOCATIONS)]
+    for loc, bit in bits:
+        if bit:
+            row[loc - 4:loc + 5] = bytes([high]) * 9
+    return bytes(row)
+
+
+class TestY4MFrames(TestCase):
+    def y4m_data(self, frames, width=720, height=4, colour_space='mono'):
+        data = b'YUV4MPEG2 W%d H%d F30000:1001 Ip A0:0 C%s\n' % (width, height, colour_space.encode())
+        chroma = {'mono': 0, '420jpeg': (width // 2) * (height // 2) * 2}[colour_space]
+        for byte1, byte2 in frames:
+            data += b'FRAME\n' + bytes([16] * width) + render_cc_row(byte1, byte2, width)
+            data += bytes([16] * width * (height - 2)) + bytes([128] * chroma)
+        return data
+
+    def decode(self, images):
+        codes = []
+        for image in images:
+            self.assertTrue(is_cc_present(image, row_number=0))
+            codes.append(decode_row(image, row_number=0))
+            image.unlink()
+        return codes
+
+    def test_parse_header(self):
+        self.assertEqual(parse_y4m_header(b'YUV4MPEG2 W720 H480 F30000:1001 Ip'), (720, 480, 360 * 240 * 2, False))
+        self.assertEqual(parse_y4m_header(b'YUV4MPEG2 W720 H480 Cmono XCOLORRANGE=FULL'), (720, 480, 0, True))
+        self.assertRaises(RuntimeError, parse_y4m_header, b'YUV4MPEG2 W720 H480 C420p10')
+        self.assertRaises(RuntimeError, parse_y4m_header, b'P5 720 480')
+
+    def test_mapped_file(self):
+        frames = [(0x14, 0x20), (0x41, 0x42), (0x14, 0x2f)]
+        for colour_space in ['mono', '420jpeg']:
+            with tempfile.TemporaryDirectory() as tempdir:
+                path = os.path.join(tempdir, 'capture.y4m')
+                with open(path, 'wb') as f:
+                    f.write(self.y4m_data(frames, colour_space=colour_space))
+                self.assertEqual(self.decode(read_y4m_frames(path, start_line=1, lines=2)), frames)
+                self.assertEqual(self.decode(read_y4m_frames(path, start_line=1, lines=2, start_frame=2)), frames[2:])
+
+    def test_stream(self):
+        frames = [(0x14, 0x20), (0x41, 0x42)]
+        stream = io.BytesIO(self.y4m_data(frames, colour_space='420jpeg'))
+        self.assertEqual(self.decode(read_y4m_frames(stream, start_line=1, lines=1)), frames)
+
+    def test_studio_range(self):
+        image = next(read_y4m_frames(io.BytesIO(self.y4m_data([(0, 0)])), lines=1))
+        self.assertEqual(image.get_pixel_luma(0, 0), 0)
+        self.assertEqual(STUDIO_TO_FULL_RANGE[235], 255)
+
+    def test_get_row(self):
+        images = read_y4m_frames(io.BytesIO(self.y4m_data([(0x14, 0x2c)])), start_line=1, lines=1)
+        image = next(images)
+        row = image.get_row(0)
+        self.assertIsInstance(row, bytes)
+        self.assertEqual(list(row), [image.get_pixel_luma(x, 0) for x in range(720)])
+        self.assertEqual(min(row), 0)  # Studio range black
+        image.unlink()
+
+
+class TestRawLumaFrames(TestCase):
+    def test_mapped_file(self):
+        frames = [(0x14, 0x2c), (0x20, 0x20)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'capture.gray')
+            with open(path, 'wb') as f:
+                for byte1, byte2 in frames:
+                    f.write(render_cc_row(byte1, byte2, high=255, low=0) + bytes(720 * 3))
+            images = read_raw_luma_frames(path, 720, 4, lines=1, full_range=True)
+            codes = [decode_row(image, row_number=0) for image in images]
+        self.assertEqual(codes, frames)
+
+    def test_stream_with_chroma(self):
+        frame = bytes(720) + render_cc_row(0x14, 0x20) + bytes(720 * 2) + bytes(360 * 2 * 2)
+        images = read_raw_luma_frames(io.BytesIO(frame * 3), 720, 4, start_line=1, lines=1, start_frame=1,
+                                      frame_bytes=len(frame))
+        self.assertEqual([decode_row(image, row_number=0) for image in images], [(0x14, 0x20)] * 2)
+
+
+class TestFfmpegProfile(TestCase):
+    def test_default(self):
+        argv = ffmpeg_profile().argv('ffmpeg', 'in.mpg', 'out%07d.tif', 'crop=iw:3:0:0')
+        self.assertEqual(argv[:5], ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error'])
+        self.assertEqual(argv[argv.index('-i'):], ['-i', 'in.mpg', '-map', '0:v:0', '-an', '-sn', '-dn',
+                                                  '-vf', 'crop=iw:3:0:0', '-pix_fmt', 'rgb24', '-f', 'image2',
+                                                  'out%07d.tif'])
+        self.assertNotIn('-threads', argv)
+
+    def test_awkward_paths_stay_whole(self):
+        argv = FfmpegProfile().argv('/opt/ff mpeg/ffmpeg', 'Bob\'s "best" tape.mkv', '/tmp/a b/%07d.tif', 'null')
+        self.assertIn('Bob\'s "best" tape.mkv', argv)
+        self.assertEqual(argv[0], '/opt/ff mpeg/ffmpeg')
+
+    def test_preset_and_overrides(self):
+        profile = ffmpeg_profile('h264', threads=1, stream=2, filter_args=None)
+        argv = profile.argv('ffmpeg', 'in.mp4', 'out.tif', 'crop=iw:3:0:0', seek=10.5)
+        self.assertLess(argv.index('-skip_loop_filter'), argv.index('-i'))
+        self.assertEqual(argv[argv.index('-threads') + 1], '1')
+        self.assertEqual(argv[argv.index('-ss') + 1], '10.500000')
+        self.assertLess(argv.index('-ss'), argv.index('-i'))
+        self.assertIn('0:v:2', argv)
+
+    def test_extra_filters_and_streams(self):
+        profile = FfmpegProfile(skip_other_streams=False, filter_args=['yadif'], output_args=['-vsync', '0'])
+        argv = profile.argv('ffmpeg', 'in.mpg', 'out.tif', 'crop=iw:3:0:0')
+        self.assertNotIn('-an', argv)
+        self.assertEqual(argv[argv.index('-vf') + 1], 'crop=iw:3:0:0,yadif')
+        self.assertEqual(argv[-6:-3], ['rgb24', '-vsync', '0'])
+
+    def test_unknown_preset(self):
+        with self.assertRaises(RuntimeError):
+            ffmpeg_profile('betamax')
+
+    def test_frame_limit(self):
+        argv = ffmpeg_profile().argv('ffmpeg', 'in.mpg', 'out.tif', 'crop=iw:3:0:0', seek=60, frames=300)
+        self.assertEqual(argv[argv.index('-frames:v') + 1], '300')
+        self.assertGreater(argv.index('-frames:v'), argv.index('-i'))  # An output option
+
+
+class TestPositionToFrame(TestCase):
+    def test_positions(self):
+        self.assertEqual(position_to_frame(1234), 1234)
+        self.assertEqual(position_to_frame('1234'), 1234)
+        self.assertEqual(position_to_frame('1:00', fps=25), 1500)
+        self.assertEqual(position_to_frame('01:02:03.5', fps=25), 93088)
+        self.assertEqual(position_to_frame('0:10'), 300)  # 29.97 fps
+
+    def test_bad_positions(self):
+        for position in ['ten', '1.5', '1:2:3:4', '1:xx']:
+            with self.assertRaises(ValueError):
+                position_to_frame(position)
+
+
+class TestProgress(TestCase):
+    def meter(self, **kwargs):
+        self.stats = DecodeStats()
+        self.output = io.StringIO()
+        return ProgressMeter(self.stats, name='tape.mpg', output=self.output, **kwargs)
+
+    def decode(self, images, delay=0):
+        for frame, image in enumerate(images):
+            time.sleep(delay)
+            self.stats.update(*([(0x14, 0x2f), (0x14, 0x2f), (0x41, 0x41), (None, None)][frame % 4]),
+                              duplicate=frame % 4 == 1)
+
+    def test_report(self):
+        meter = self.meter(total_frames=100, interval=0.001)
+        self.decode(meter.watch(range(40)), delay=0.002)
+        lines = self.output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'tape.mpg: 100 frames, 0:00:03')
+        self.assertIn('ETA', lines[1])
+        self.assertTrue(lines[-1].startswith('frame 40/100 (40.0%), '))
+        self.assertIn('locked 75.0%, 10 captions, done in', lines[-1])
+
+    def test_metrics(self):
+        meter = self.meter(total_frames=200, interval=0, start_frame=100)
+        meter.start()
+        self.decode(range(50), delay=0.002)
+        metrics = meter.metrics()
+        self.assertEqual((metrics['frames_decoded'], metrics['lock_ratio'], metrics['captions']), (150, 0.76, 13))
+        self.assertGreater(metrics['realtime_factor'], 0)
+        self.assertGreater(metrics['eta_seconds'], 0)
+        self.assertEqual(self.output.getvalue(), '')
+
+    def test_metrics_files(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for name in ('metrics.json', 'metrics.prom'):
+                path = os.path.join(tempdir, name)
+                meter = self.meter(interval=0, metrics_path=path, metrics_interval=0)
+                self.decode(meter.watch(range(8)))
+                with open(path) as f:
+                    text = f.read()
+                if name.endswith('.json'):
+                    metrics = json.loads(text)
+                    self.assertEqual((metrics['frames_decoded'], metrics['done'], metrics['frames_total']),
+                                     (8, True, None))
+                else:
+                    self.assertIn('cc_decoder_frames_decoded{input="tape.mpg"} 8.0\n', text)
+                    self.assertIn('# TYPE cc_decoder_captions counter', text)
+                    self.assertNotIn('frames_total', text)  # Not known
+
+    def test_prometheus_label_escaping(self):
+        text = prometheus_metrics(dict(input='a "b"\\c', frames_decoded=1, frames_total=None, elapsed_seconds=1,
+                                       realtime_factor=1, lock_ratio=1, repeated_frames=0, parity_errors=0, captions=0,
+                                       eta_seconds=None, done=False))
+        self.assertIn('{input="a \\"b\\"\\\\c"}', text)
+
+
+@skipIf(os.name == 'nt', 'Fake ffprobe is a shell script')
+class TestProbe(TestCase):
+    def fake_ffprobe(self, output):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        path = os.path.join(tempdir.name, 'ffprobe')
+        with open(path, 'w') as f:
+            f.write("#!/bin/sh\ncat <<'EOF'\n%s\nEOF\n" % json.dumps(output))
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def test_frame_count(self):
+        ffprobe = self.fake_ffprobe({'streams': [{'nb_frames': '1800', 'avg_frame_rate': '30000/1001'}],
+                                     'format': {'duration': '60.06'}})
+        self.assertEqual(probe_video(ffprobe, 'in.mpg'), (60.06, 1800))
+
+    def test_frames_from_duration(self):
+        ffprobe = self.fake_ffprobe({'streams': [{'avg_frame_rate': '25/1', 'duration': '10.0'}]})
+        self.assertEqual(probe_video(ffprobe, 'in.mkv'), (10.0, 250))
+
+    def test_unknown(self):
+        self.assertEqual(probe_video('/nonexistent/ffprobe', 'in.mpg'), (None, None))
+        self.assertEqual(probe_video(self.fake_ffprobe({'streams': []}), 'in.mpg'), (None, None))
+
+    def test_ffprobe_path(self):
+        self.assertEqual(ffprobe_path(os.path.join('opt', 'ffmpeg.exe')), os.path.join('opt', 'ffprobe.exe'))
+
+    def test_count_y4m_frames(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'capture.y4m')
+            with open(path, 'wb') as f:
+                f.write(TestY4MFrames().y4m_data([(0, 0)] * 7, colour_space='420jpeg'))
+            self.assertEqual(count_y4m_frames(path), 7)
@@ -0,0 +1,390 @@
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from cc_decoder import run_decode_job
+from lib.cc_jobs import DecodeService, Job, make_server, HotFolder, JobJournal, ShardWorker, caption_path
+from tests.test_cc_decode import caption_pairs
+from tests.test_cc_decoder import write_y4m
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+
+def sleepy_job(input_path, ccformat, options, output_path):
+    time.sleep(options.get('sleep', 0))
+    with open(output_path, 'a') as f:
+        f.write('%s\n' % input_path)
+
+
+def failing_job(input_path, ccformat, options, output_path):
+    raise IOError('No such file %s' % input_path)
+
+
+def flaky_job(input_path, ccformat, options, output_path):
+    """ Fails the first time it sees a file """
+    if not os.path.exists(input_path + '.failed'):
+        open(input_path + '.failed', 'w').close()
+        raise IOError('ffmpeg went away')
+    sleepy_job(input_path, ccformat, options, output_path)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class TestDecodeService(TestCase):
+    def setUp(self):
+        handle, self.output = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.unlink(self.output)
+
+    def test_priority(self):
+        service = DecodeService(sleepy_job, workers=1)
+        try:
+            service.submit('first', options={'sleep': 0.2}, output_path=self.output)
+            time.sleep(0.05)  # Let the first job start, so the others queue behind it
+            low = service.submit('low', output_path=self.output)
+            high = service.submit('high', output_path=self.output, priority=5)
+            self.assertEqual(service.status()['queue_depth'], 2)
+            low.done.wait(5)
+            self.assertEqual(high.status, Job.DONE)
+            with open(self.output) as f:
+                self.assertEqual(f.read().split(), ['first', 'high', 'low'])
+            self.assertGreater(high.queue_seconds, low.run_seconds)
+        finally:
+            service.close()
+
+    def test_forgets_old_finished_jobs(self):
+        service = DecodeService(sleepy_job, workers=1, keep_finished=2)
+        try:
+            jobs = [service.submit('clip%d' % i, output_path=self.output) for i in range(4)]
+            jobs[-1].done.wait(5)
+            self.assertEqual([job.id for job in service.list_jobs()], [job.id for job in jobs[2:]])
+            self.assertIsNone(service.get_job(jobs[0].id))
+            self.assertEqual(service.status()['done'], 2)
+        finally:
+            service.close()
+
+    def test_cancel(self):
+        service = DecodeService(sleepy_job, workers=1)
+        try:
+            first = service.submit('first', options={'sleep': 0.2}, output_path=self.output)
+            queued = service.submit('queued', output_path=self.output)
+            time.sleep(0.05)  # Let the first job start
+            self.assertFalse(service.cancel(first))  # Already running
+            self.assertTrue(service.cancel(queued))
+            self.assertTrue(queued.done.is_set())
+            first.done.wait(5)
+            self.assertEqual((first.status, queued.status), (Job.DONE, Job.CANCELLED))
+            self.assertEqual(service.status()['cancelled'], 1)
+            time.sleep(0.05)
+            with open(self.output) as f:
+                self.assertEqual(f.read().split(), ['first'])
+        finally:
+            service.close()
+
+    def test_failure(self):
+        service = DecodeService(failing_job, workers=1)
+        try:
+            job = service.submit('missing.mpg', output_path=self.output)
+            job.done.wait(5)
+            self.assertEqual(job.status, Job.FAILED)
+            self.assertIn('missing.mpg', job.error)
+            self.assertEqual(service.status()['failed'], 1)
+        finally:
+            service.close()
+
+
+class TestDecodeServer(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.video = write_y4m(caption_pairs((0x14, 0x20), 'HI', (0x14, 0x2f), (0x80, 0x80), (0x14, 0x2c)))
+        cls.service = DecodeService(run_decode_job, workers=2, default_options={'lines': 2})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.close()
+        os.unlink(cls.video)
+
+    def start(self, address, output_root=None, formats=None):
+        server = make_server(self.service, address, output_root=output_root, formats=formats)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def request(self, connection, method, path, body=None, content_type='application/json'):
+        connection.request(method, path, body=json.dumps(body) if body else None,
+                           headers={'Content-Type': content_type} if body else {})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_stream_over_tcp(self):
+        server = self.start('localhost:0')
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        response, body = self.request(connection, 'POST', '/jobs', {'input': self.video, 'stream': True})
+        self.assertEqual(response.status, 200)
+        self.assertIn('HI', body.decode('utf-8'))
+        self.assertIn('-->', body.decode('utf-8'))
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        response, body = self.request(connection, 'GET', '/jobs/%s' % response.getheader('X-Job-Id'))
+        self.assertEqual(json.loads(body)['status'], Job.DONE)
+
+    def test_output_file_over_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cc.sock')
+        output = path + '.jsonl'
+        self.start(path, output_root=os.path.dirname(path))
+        response, body = self.request(UnixHTTPConnection(path), 'POST', '/jobs',
+                                      {'input': self.video, 'format': 'jsonl', 'output': output, 'wait': True})
+        self.assertEqual(response.status, 201)
+        job = json.loads(body)
+        self.assertEqual(job['status'], Job.DONE)
+        self.assertIsNotNone(job['run_seconds'])
+        with open(output) as f:
+            self.assertEqual(json.loads(f.readline())['lines'][0]['text'], 'HI')
+        os.unlink(output)
+        response, body = self.request(UnixHTTPConnection(path), 'GET', '/status')
+        self.assertEqual(json.loads(body)['queue_depth'], 0)
+
+    def test_bad_requests(self):
+        server = self.start('localhost:0')
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        response, body = self.request(connection, 'POST', '/jobs', {'input': self.video})
+        self.assertEqual(response.status, 400)  # No output, and not streaming
+        response, body = self.request(connection, 'GET', '/jobs/999')
+        self.assertEqual(response.status, 404)
+
+    def test_one_known_format(self):
+        server = self.start('localhost:0', formats=['scc', 'srt'])
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        for ccformat in ('srt,scc', 'nope', ['srt']):  # Several outputs would never write the one output file
+            response, body = self.request(connection, 'POST', '/jobs', {'input': self.video, 'format': ccformat,
+                                                                        'stream': True})
+            self.assertEqual(response.status, 400, ccformat)
+        response, body = self.request(connection, 'POST', '/jobs', {'input': self.video, 'format': 'srt:1',
+                                                                    'stream': True})
+        self.assertIn('HI', body.decode('utf-8'))
+
+    def test_refuses_what_jobs_may_not_do(self):
+        server = self.start('localhost:0')
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        beside = os.path.splitext(self.video)[0] + '.srt'
+        for request in [{'input': self.video, 'output': beside, 'options': {'ffmpeg_path': '/bin/sh'}},
+                        {'input': self.video, 'output': beside, 'options': {'temp_path': '/'}},
+                        {'input': self.video, 'output': '/etc/cc_decoder.srt'},
+                        {'input': self.video, 'output': self.video}]:
+            response, body = self.request(connection, 'POST', '/jobs', request)
+            self.assertEqual(response.status, 400, request)
+        # A form post from a web page
+        response, body = self.request(connection, 'POST', '/jobs', {'input': self.video, 'stream': True},
+                                      content_type='text/plain')
+        self.assertEqual(response.status, 415)
+        self.assertFalse(os.path.exists(beside))
+        self.assertNotIn(beside, [job.output_path for job in self.service.list_jobs()])
+
+    def test_output_root(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        server = self.start('localhost:0', output_root=root)
+        connection = http.client.HTTPConnection('localhost', server.server_address[1])
+        for output, status in (('../escaped.srt', 400), ('clip.srt', 201)):
+            response, body = self.request(connection, 'POST', '/jobs', {'input': self.video, 'output': output,
+                                                                        'options': {'lines': 2}, 'wait': True})
+            self.assertEqual(response.status, status, output)
+        self.assertEqual(os.listdir(root), ['clip.srt'])
+
+
+class TestHotFolder(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.services = []
+
+    def tearDown(self):
+        for service in self.services:
+            service.close()
+
+    def hot_folder(self, run_job, **kwargs):
+        service = DecodeService(run_job, workers=2)
+        self.services.append(service)
+        return HotFolder(self.folder, service, stable_seconds=0, **kwargs)
+
+    def add_video(self, name):
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(b'video')
+        return os.path.join(self.folder, name)
+
+    def run_until_idle(self, hot_folder, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if not hot_folder.poll() and not hot_folder.poll():  # Once to notice new files, once to start them
+                return
+            time.sleep(0.01)
+        self.fail('Hot folder did not go idle')
+
+    def test_one_output_per_video(self):
+        with self.assertRaises(ValueError):
+            self.hot_folder(sleepy_job, ccformat='srt,scc')
+        with self.assertRaises(ValueError):
+            ShardWorker(os.path.join(self.folder, 'manifest.txt'), self.services[0], ccformat='srt:1,srt:2')
+        self.assertEqual(caption_path(os.path.join(self.folder, 'clip.mpg'), 'srt:1'),
+                         os.path.join(self.folder, 'clip.srt'))
+
+    def test_decodes_next_to_video(self):
+        video = self.add_video('clip.mpg')
+        self.add_video('notes.txt')
+        self.run_until_idle(self.hot_folder(sleepy_job))
+        with open(os.path.join(self.folder, 'clip.srt')) as f:
+            self.assertEqual(f.read().strip(), video)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'notes.srt')))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'clip.srt.partial')))
+
+    def test_waits_for_file_to_finish_arriving(self):
+        hot_folder = self.hot_folder(sleepy_job)
+        hot_folder.stable_seconds = 60
+        self.add_video('clip.mpg')
+        self.assertEqual(hot_folder.poll(), 0)
+        self.assertEqual(hot_folder.poll(), 0)
+        self.assertFalse(hot_folder.running)
+
+    def test_journal_prevents_redo(self):
+        self.add_video('clip.mpg')
+        self.run_until_idle(self.hot_folder(sleepy_job))
+        os.unlink(os.path.join(self.folder, 'clip.srt'))
+        self.run_until_idle(self.hot_folder(sleepy_job))  # Restarted, with the same journal
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'clip.srt')))
+        video = self.add_video('clip.mpg')  # Replaced, so decode again
+        os.utime(video, (time.time() + 10, time.time() + 10))
+        self.run_until_idle(self.hot_folder(sleepy_job))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'clip.srt')))
+
+    def test_retry(self):
+        video = self.add_video('clip.mpg')
+        self.run_until_idle(self.hot_folder(flaky_job, backoff=0.01))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'clip.srt')))
+        journal = JobJournal(os.path.join(self.folder, '.cc_decoder_journal.jsonl'))
+        self.assertEqual((journal.entries[video]['status'], journal.entries[video]['attempts']), (Job.DONE, 2))
+
+    def test_gives_up(self):
+        video = self.add_video('clip.mpg')
+        self.run_until_idle(self.hot_folder(failing_job, retries=1, backoff=0.01))
+        journal = JobJournal(os.path.join(self.folder, '.cc_decoder_journal.jsonl'))
+        self.assertEqual((journal.entries[video]['status'], journal.entries[video]['attempts']), (Job.FAILED, 2))
+        self.assertIn('No such file', journal.entries[video]['error'])
+
+    def test_priority(self):
+        self.assertEqual(HotFolder(self.folder, None, priorities=[('*promo*', 10)]).priority('/a/big_promo.mpg'), 10)
+        self.assertEqual(HotFolder(self.folder, None, priorities=[('*promo*', 10)]).priority('/a/movie.mpg'), 0)
+
+
+def run_shard_worker(manifest, node):
+    service = DecodeService(sleepy_job, workers=2)
+    try:
+        ShardWorker(manifest, service, node=node, lease_seconds=5).run(poll_interval=0.01)
+    finally:
+        service.close()
+
+
+class TestShardWorker(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.videos = [os.path.join(self.folder, 'clip%d.mpg' % i) for i in range(8)]
+        self.manifest = os.path.join(self.folder, 'manifest.txt')
+        with open(self.manifest, 'w') as f:
+            f.write('# Videos to decode\n' + '\n'.join(self.videos) + '\n')
+
+    def test_workers_share_without_duplicates(self):
+        workers = [multiprocessing.Process(target=run_shard_worker, args=(self.manifest, 'node%d' % i))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+            self.assertEqual(worker.exitcode, 0)
+        for video in self.videos:
+            with open(caption_path(video, 'srt')) as f:
+                self.assertEqual(f.read().split(), [video])  # Decoded exactly once
+            with open(ShardWorker(self.manifest, None, node='checker').marker(video, 'done')) as f:
+                self.assertIn(json.load(f)['node'], ('node0', 'node1', 'node2'))
+        self.assertEqual(len(os.listdir(self.manifest + '.state')), len(self.videos))  # Only the done markers left
+
+    def test_live_and_dead_locks(self):
+        service = DecodeService(sleepy_job, workers=2)
+        self.addCleanup(service.close)
+        worker = ShardWorker(self.manifest, service, node='me', lease_seconds=5)
+        live, dead = worker.marker(self.videos[0], 'lock'), worker.marker(self.videos[1], 'lock')
+        for lock in (live, dead):
+            with open(lock, 'w') as f:
+                f.write('other')
+        os.utime(dead, (time.time() - 60, time.time() - 60))  # Stopped heartbeating a minute ago
+        end = time.time() + 10
+        while worker.poll() > 1 and time.time() < end:
+            time.sleep(0.01)
+        self.assertEqual(worker.poll(), 1)  # Only the live lock's file is left
+        self.assertFalse(os.path.exists(caption_path(self.videos[0], 'srt')))
+        self.assertTrue(os.path.exists(caption_path(self.videos[1], 'srt')))
+        with open(live) as f:
+            self.assertEqual(f.read(), 'other')
+
+    def test_lost_lease_result_thrown_away(self):
+        service = DecodeService(sleepy_job, workers=1, default_options={'sleep': 0.5})
+        self.addCleanup(service.close)
+        worker = ShardWorker(self.manifest, service, node='me', lease_seconds=5)
+        worker.poll()
+        video, job = next(iter(worker.running.items()))
+        self.assertEqual(job.output_path, caption_path(video, 'srt') + '.me.partial')
+        lock = worker.marker(video, 'lock')
+        with open(lock, 'w') as f:
+            f.write('other')  # Taken over while we were stalled
+        job.done.wait(5)
+        worker.poll()
+        self.assertNotIn(video, worker.running)
+        self.assertFalse(os.path.exists(caption_path(video, 'srt')))
+        self.assertFalse(os.path.exists(job.output_path))
+        self.assertFalse(os.path.exists(worker.marker(video, 'done')))
+        with open(lock) as f:
+            self.assertEqual(f.read(), 'other')  # Not released from under its new owner
+        worker.release(video)
+        self.assertTrue(os.path.exists(lock))
@@ -0,0 +1,102 @@
+import threading
+import time
+from unittest import TestCase
+from lib.cc_frames import LumaImageWrapper
+from lib.cc_ring import FrameRing, WRITE_SEQ, HEADER_FIELDS
+
+__author__ = "Max Smith"
+__copyright__ = "Copyright 2025 Max Smith"
+__credits__ = ["Max Smith"]
+__license__ = """
+This is free and unencumbered software released into the public domain.
+
+Anyone is free to copy, modify, publish, use, compile, sell, or
+distribute this software, either in source code form or as a compiled
+binary, for any purpose, commercial or non-commercial, and by any
+means.
+
+In jurisdictions that recognize copyright laws, the author or authors
+of this software dedicate any and all copyright interest in the
+software to the public domain. We make this dedication for the benefit
+of the public at large and to the detriment of our heirs and
+successors. We intend this dedication to be an overt act of
+relinquishment in perpetuity of all present and future rights to this
+software under copyright law.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+For more information, please refer to <http://unlicense.org/>
+"""
+
+
+def frame(value, width=8, height=2):
+    return LumaImageWrapper(bytes([value]) * (width * height), width, height, full_range=True)
+
+
+class TestFrameRing(TestCase):
+    def setUp(self):
+        self.ring = FrameRing.create(8, 2, consumers=2, slots=4)
+        self.addCleanup(self.ring.unlink)
+        self.addCleanup(self.ring.close)
+
+    def consume(self, ring, consumer, seen, delay=0):
+        def read():
+            for image in ring.frames(consumer):
+                ahead = ring.header[WRITE_SEQ] - ring.header[HEADER_FIELDS + consumer]  # Frames written, not yet read
+                seen.append((image.get_row(0)[0], image.get_row(1)[7], ahead))
+                time.sleep(delay)
+        thread = threading.Thread(target=read)
+        thread.start()
+        return thread
+
+    def test_every_consumer_reads_every_frame(self):
+        other = FrameRing.attach(self.ring.name)  # As another process would
+        self.addCleanup(other.close)
+        fast, slow = [], []
+        threads = [self.consume(self.ring, 0, fast), self.consume(other, 1, slow, delay=0.002)]
+        for value in range(20):
+            self.ring.put(frame(value))
+        self.ring.finish()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([value for value, _, _ in fast], list(range(20)))
+        self.assertEqual([(value, last) for value, last, _ in slow], [(value, value) for value in range(20)])
+        self.assertLessEqual(max(ahead for _, _, ahead in fast + slow), 4)  # Never more than the ring holds
+
+    def test_consumer_gone(self):
+        seen = []
+        self.ring.detach(1)  # Finished early, it holds nobody up
+        thread = self.consume(self.ring, 0, seen)
+        for value in range(10):
+            self.ring.put(frame(value))
+        self.ring.finish()
+        thread.join()
+        self.assertEqual(len(seen), 10)
+
+    def test_consumer_died(self):
+        # Consumer 1 never reads, once its process is found dead the writer stops waiting for it
+        seen = []
+        thread = self.consume(self.ring, 0, seen)
+        for value in range(10):
+            self.ring.put(frame(value), alive=lambda consumer: consumer == 0)
+        self.ring.finish()
+        thread.join()
+        self.assertEqual(len(seen), 10)
+
+    def test_writer_failed(self):
+        self.ring.put(frame(1))
+        self.ring.finish(failed=True)
+        frames = self.ring.frames(0)
+        next(frames)
+        with self.assertRaises(RuntimeError):
+            next(frames)
+
+    def test_wrong_size(self):
+        with self.assertRaises(RuntimeError):
+            self.ring.put(frame(1, width=4))